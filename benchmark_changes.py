@@ -0,0 +1,151 @@
+# notes:	Measures the peak memory of a backlog of coalesced CDC changes, with the compact db.Change
+#			records (after) and with the dictionary based records they replaced (before). The CDC
+#			records are generated, neither SQL Server nor arcpy are needed.
+#
+# usage:	benchmark_changes.py [--changes N] [--columns N] [--block-size N]
+#
+#			Every representation is measured in its own process, the peak RSS includes the
+#			interpreter (see the baseline line).
+import os, sys, time, argparse, subprocess
+from decimal import Decimal
+from datetime import datetime, timedelta
+from connector import db
+
+_CDC_COLUMNS = ['__$start_lsn', '__$seqval', '__$operation', '__$update_mask']
+
+###################################################################################################
+###################################################################################################
+#
+# class:	benchmark_changes.DictChange
+# purpose:	The change record as it was before db.Change got __slots__: the whole CDC row as a list,
+#			with the __$ columns and the hex __$CDCKEY, and a list of hex keys.
+#
+###################################################################################################
+
+class DictChange(object):
+	def __init__(self, op, key, row, cdcKey):
+		self.op = op
+		self.key = key
+		self.row = row
+		self.cdcKeys = [cdcKey]
+		self.error = None
+		return
+
+def parse_args():
+	parser = argparse.ArgumentParser(description = 'Measures the peak memory of a backlog of coalesced CDC changes.')
+	parser.add_argument('--changes', type = int, default = 1000000, help = 'Number of changes in the backlog')
+	parser.add_argument('--columns', type = int, default = 20, help = 'Number of data columns of the CDC table')
+	parser.add_argument('--block-size', type = int, default = 500, dest = 'blockSize', help = 'Number of CDC records coalesced at once, like fetchBlockSize')
+	parser.add_argument('--variant', choices = ['baseline', 'before', 'after'], help = 'Measure one representation in this process')
+	return parser.parse_args()
+
+def get_fields(args, cdcKey):
+	names = _CDC_COLUMNS + ['rep_id'] + ['C%d' % i for i in xrange(1, args.columns)]
+	if cdcKey:
+		names.append('__$CDCKEY')
+	fields = dict()
+	for i in xrange(len(names)):
+		fields[names[i]] = i
+	return fields
+
+########################################################################
+# Generator that yields blocks of CDC records like pyodbc returns them, every value is a new object.
+def get_blocks(args, cdcKey):
+	start = datetime(2020, 1, 1)
+	for first in xrange(0, args.changes, args.blockSize):
+		rows = []
+		for key in xrange(first, min(first + args.blockSize, args.changes)):
+			seqval = ('%020x' % key).decode('hex')
+			row = [bytearray(seqval), bytearray(seqval), 4, bytearray('\x00\x00'), key]
+			for i in xrange(1, args.columns):
+				kind = i % 4
+				if kind == 0:
+					row.append(u'Value %d of column %d' % (key, i))
+				elif kind == 1:
+					row.append(Decimal(key) / 100)
+				elif kind == 2:
+					row.append(start + timedelta(seconds = key))
+				else:
+					row.append(key * i)
+			if cdcKey:
+				row.append(seqval.encode('hex').upper())
+			rows.append(row)
+		yield rows
+
+def coalesce_before(rows, fields):
+	changes = []
+	cdcKeyIndex = fields['__$CDCKEY']
+	keyIndex = fields['rep_id']
+	for row in rows:
+		values = list(row)
+		for i in xrange(len(values)):
+			if isinstance(values[i], Decimal):
+				values[i] = float(values[i])
+		changes.append(DictChange('update', row[keyIndex], values, row[cdcKeyIndex]))
+	return changes
+
+def get_dataset():
+	config = {"name":"benchmark", "sqlServer":{"server":"", "database":""}, "tempPath":".", "exportPath":".", "lockFilePath":"benchmark.loc",
+		"deleteTempFiles":False, "autoReconcile":False, "stagingWorkspace":"", "productionWorkspace":"", "sqlserverEditVersion":"",
+		"stagingEditVersions":[], "stagingDefaultVersion":"",
+		"datasets":[{"cdcFunction":"", "sqlserverDataset":{"table":"cdc.benchmark_CT", "primaryKey":"rep_id"}, "sdeDataset":{"table":"benchmark", "primaryKey":"rep_id"}}]}
+	return db.Replicas([config]).replicas[0].datasets[0]
+
+########################################################################
+# Returns the peak resident set size of this process in MB.
+def get_peak_rss():
+	try:
+		import resource
+	except ImportError:
+		return get_peak_working_set()
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		return rss / 1048576.0
+	return rss / 1024.0
+
+def get_peak_working_set():
+	import ctypes
+	from ctypes import wintypes
+	class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+		_fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+			('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+			('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+			('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+			('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+	counters = PROCESS_MEMORY_COUNTERS()
+	counters.cb = ctypes.sizeof(counters)
+	ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+	return counters.PeakWorkingSetSize / 1048576.0
+
+def measure(args):
+	started = time.time()
+	backlog = []
+	if args.variant == 'before':
+		fields = get_fields(args, True)
+		for rows in get_blocks(args, True):
+			backlog.extend(coalesce_before(rows, fields))
+	elif args.variant == 'after':
+		dataset = get_dataset()
+		fields = get_fields(args, False)
+		for rows in get_blocks(args, False):
+			backlog.append(dataset.coalesce(rows, fields))
+	numChanges = len(backlog)
+	if args.variant == 'after':
+		numChanges = sum([len(batch) for batch in backlog])
+	print('%-8s %d changes, peak RSS %.1f MB, %.1f s' % (args.variant + ':', numChanges, get_peak_rss(), time.time() - started))
+	return
+
+def run(args):
+	print('%d changes with %d columns' % (args.changes, args.columns))
+	for variant in ['baseline', 'before', 'after']:
+		command = [sys.executable, os.path.abspath(__file__), '--variant', variant, '--changes', str(args.changes), '--columns', str(args.columns), '--block-size', str(args.blockSize)]
+		sys.stdout.flush()
+		subprocess.call(command)
+	return
+
+if __name__ == '__main__':
+	args = parse_args()
+	if args.variant is None:
+		run(args)
+	else:
+		measure(args)
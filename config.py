@@ -3,6 +3,9 @@ connector = {
 	"exportLogFile":r"[path]\logs\sde_to_warehouse.log",
 	"testLogFile":r"[path]\logs\test.log",
 	"clearCdc":True,
+	"maxParallelReplicas":1,
+	"reportPath":r"[path]\logs",
+	"maxRuntime":None,
 	"replicas":[
 		{
 			"name":"DBO.BGBASE_StagingToProduction",
@@ -21,10 +24,33 @@ connector = {
 			"sqlserverEditVersion":"DBO.BG-BASE",
 			"stagingEditVersions":["DBO.DESKTOP","DBO.MOBILE"],
 			"stagingDefaultVersion":"DBO.DEFAULT",
+			"stagingRepository":"Staging.dbo",
+			"fetchBlockSize":500,
+			"pipelineDepth":2,
+			"editBatchSize":500,
+			"editBatchSeconds":60,
+			"skipNoopUpdates":True,
+			"quarantineAttempts":3,
+			"quarantinePath":r"[path]\temp\quarantine.sqlite",
+			"reconcileRangeSize":10000,
+			"reconcileLeafSize":100,
+			"spillChanges":False,
+			"spillPath":r"[path]\temp\spill",
+			"adaptiveBatchSize":False,
+			"minBatchSize":50,
+			"maxBatchSize":5000,
+			"cycleSeconds":10,
+			"maxParallelDatasets":4,
+			"snapshotRatio":0.5,
+			"sink":{"type":"sde"},
+			"freshnessSeconds":900,
+			"maxRuntime":3600,
+			"slowQuerySeconds":10,
 			"datasets":[
 				{
 					"cdcFunction":"cdc.fn_cdc_get_all_changes_dbo_PLANTS_LOCATION",
 					"disabled":False,
+					"priority":10,
 					"sqlserverDataset":
 					{
 						"table":"Warehouse.cdc.dbo_PLANTS_LOCATION_CT",
@@ -41,6 +67,8 @@ connector = {
 				{
 					"cdcFunction":"cdc.fn_cdc_get_all_changes_dbo_PLANTS_CONDITION",
 					"disabled":False,
+					"dependsOn":["PLANTS_LOCATION"],
+					"applyMode":"sql",
 					"sqlserverDataset":
 					{
 						"table":"Warehouse.cdc.dbo_PLANTS_CONDITION_CT",
@@ -55,6 +83,8 @@ connector = {
 				{
 					"cdcFunction":"cdc.fn_cdc_get_all_changes_dbo_PLANTS_MEASURE_BY",
 					"disabled":False,
+					"dependsOn":["PLANTS_LOCATION"],
+					"shards":4,
 					"sqlserverDataset":
 					{
 						"table":"Warehouse.cdc.dbo_PLANTS_MEASURE_BY_CT",
@@ -67,12 +97,12 @@ connector = {
 					}
 				},
 				{
-					"cdcFunction":"cdc.fn_cdc_get_all_changes_dbo_PLANTS_LABEL_HAVE_TYPE_BY",
 					"disabled":True,
-					"disabledReason":"PLANTS_LABEL_HAVE_TYPE_BY does not have CDC turned on.",
+					"disabledReason":"Set sdeDataset to the staging table of PLANTS_LABEL_HAVE_TYPE_BY before enabling.",
+					"changeSource":"hash",
 					"sqlserverDataset":
 					{
-						"table":"Warehouse.cdc.dbo_PLANTS_LABEL_HAVE_TYPE_CT",
+						"table":"Warehouse.dbo.PLANTS_LABEL_HAVE_TYPE_BY",
 						"primaryKey":"rep_id"
 					},
 					"sdeDataset":
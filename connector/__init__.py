@@ -1 +1 @@
-__all__ = ["db","io","util"]
\ No newline at end of file
+__all__ = ["adaptive","checkpoint","db","diff","io","lag","odbc","pipeline","processes","profiling","quarantine","report","schedule","sink","spill","util","versions"]
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os, sys, traceback, logging
+from collections import OrderedDict
+
+#Relative change of the per-row time that counts as faster or slower, smaller changes are noise.
+_TOLERANCE = 0.1
+
+#Factors by which the size grows and shrinks.
+_GROW = 1.5
+_SHRINK = 0.5
+
+#Seconds of waiting in a batch below which rising waits are ignored.
+_MIN_WAIT_SECONDS = 0.5
+
+#Number of batches without a change of the time per row after which a larger size is tried.
+_PROBE_BATCHES = 5
+
+#Number of size changes that are kept for the report.
+_MAX_HISTORY = 50
+
+###################################################################################################
+###################################################################################################
+#
+# class:	adaptive.BatchSizer
+# purpose:	Chooses the size of the next batch of a stage, the CDC records fetched per block or the
+#			changes saved per edit session, from the time the previous batches took. The size grows
+#			while the time per row keeps falling and is halved when the waits of a batch (commit
+#			time, lock waits) rise or SQL Server reports blocked requests. A larger size is tried
+#			again after a few batches without change, and given up when it was slower.
+#
+# notes:	Batches that are less than half the current size, e.g. the last block of a table or
+#			an edit session saved after editBatchSeconds, say little about the size and only
+#			count when SQL Server reports blocking.
+#
+###################################################################################################
+
+class BatchSizer(object):
+	#name:		Name of the stage in the report, e.g. "fetch"
+	#size:		Size of the first batch
+	#minSize:	Smallest size that is chosen
+	#maxSize:	Largest size that is chosen
+	#isBlocked:	Function that returns True when SQL Server reports blocking, or None
+	def __init__(self, name, size, minSize, maxSize, isBlocked = None):
+		self.name = name
+		self.minSize = max(1, minSize)
+		self.maxSize = max(self.minSize, maxSize)
+		self.initialSize = self._bound(size)
+		self.size = self.initialSize
+		self.numBatches = 0
+		self.numRows = 0
+		self.seconds = 0.0
+		self.history = []
+		self._isBlocked = isBlocked
+		self._rowSeconds = None
+		self._waitSeconds = None
+		self._numSteady = 0
+		self._grew = False
+		return
+
+	def __str__(self):
+		return self.name
+
+	########################################################################
+	# Records a batch and chooses the size of the next one.
+	# rows: Number of rows in the batch
+	# seconds: Time the batch took
+	# waitSeconds: Part of seconds spent waiting, e.g. saving the edits
+	# returns the size of the next batch
+	def observe(self, rows, seconds, waitSeconds = 0.0):
+		func = 'BatchSizer.observe'
+		if rows <= 0:
+			return self.size
+		self.numBatches = self.numBatches + 1
+		self.numRows = self.numRows + rows
+		self.seconds = self.seconds + seconds
+		try:
+			if self._isBlocked is not None and self._isBlocked():
+				self._resize(self.size * _SHRINK, 'blocked')
+				return self.size
+			if rows < self.size // 2:
+				return self.size
+			rowSeconds = seconds / rows
+			rowWaitSeconds = waitSeconds / rows
+			previousRowSeconds = self._rowSeconds
+			previousWaitSeconds = self._waitSeconds
+			self._rowSeconds = rowSeconds
+			self._waitSeconds = rowWaitSeconds
+			if previousWaitSeconds is not None and waitSeconds >= _MIN_WAIT_SECONDS and rowWaitSeconds > previousWaitSeconds * (1 + _TOLERANCE):
+				self._resize(self.size * _SHRINK, 'waits')
+			elif previousRowSeconds is None:
+				self._numSteady = 0
+			elif rowSeconds < previousRowSeconds * (1 - _TOLERANCE):
+				self._resize(self.size * _GROW, 'faster')
+			elif rowSeconds > previousRowSeconds * (1 + _TOLERANCE) and self._grew:
+				#The last larger size didn't pay off.
+				self._resize(self.size / _GROW, 'slower')
+			else:
+				self._numSteady = self._numSteady + 1
+				if self._numSteady >= _PROBE_BATCHES:
+					self._resize(self.size * _GROW, 'probe')
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return self.size
+
+	def toDict(self):
+		d = OrderedDict()
+		d['min'] = self.minSize
+		d['max'] = self.maxSize
+		d['initial'] = self.initialSize
+		d['final'] = self.size
+		d['batches'] = self.numBatches
+		d['meanSize'] = self.numRows // max(1, self.numBatches)
+		d['rowsPerSecond'] = round(self.numRows / max(self.seconds, 0.001), 1)
+		d['changes'] = self.history
+		return d
+
+	def _resize(self, size, reason):
+		size = self._bound(size)
+		self._numSteady = 0
+		self._grew = size > self.size
+		if size == self.size:
+			return
+		if size < self.size:
+			#The time per row of the smaller size is measured again before it is compared.
+			self._rowSeconds = None
+			self._waitSeconds = None
+		logging.debug('Changing ' + self.name + ' batch size from ' + str(self.size) + ' to ' + str(size) + ' (' + reason + ')')
+		self.size = size
+		if len(self.history) < _MAX_HISTORY:
+			self.history.append([size, reason])
+		return
+
+	def _bound(self, size):
+		return int(min(self.maxSize, max(self.minSize, size)))
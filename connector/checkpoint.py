@@ -0,0 +1,194 @@
+import os, sys, traceback, logging
+import json, binascii
+from time import strftime
+
+###################################################################################################
+###################################################################################################
+#
+# class:	checkpoint.Checkpoint
+# purpose:	Remembers the datasets of a replica whose import was stopped by maxRuntime, and the
+#			position of the last CDC record of each that was saved to the geodatabase. The
+#			checkpoint is a JSON file in the replica's tempPath.
+#
+# notes:	The next run imports the stopped datasets first. When CDC is cleared, the records
+#			that were saved are already gone and the position is only reported. When it isn't,
+#			the next run reads the records after the position, see db.Dataset.getChanges.
+#			A dataset is removed from the checkpoint once an import of it has finished.
+#
+###################################################################################################
+
+class Checkpoint(object):
+	#replica: The db.Replica whose import is checkpointed
+	def __init__(self, replica):
+		self.replica = replica
+		name = ''.join([c if c.isalnum() else '_' for c in replica.name])
+		self.path = os.path.join(replica.tempPath, 'checkpoint_' + name + '.json')
+		self.datasets = self._load()
+		return
+
+	def __str__(self):
+		return self.path
+
+	def has(self, dataset):
+		return dataset.cdcTable in self.datasets
+
+	########################################################################
+	# Returns the ChangeBatch.position at which the import of a dataset stopped, or None.
+	def getPosition(self, dataset):
+		entry = self.datasets.get(dataset.cdcTable)
+		if entry is None or entry['position'] is None:
+			return None
+		lsn, seqval, operation = entry['position']
+		return (binascii.unhexlify(lsn), binascii.unhexlify(seqval), operation)
+
+	########################################################################
+	# Records that the import of a dataset stopped after position, keeps the previous position
+	# when position is None.
+	def set(self, dataset, position, numRecords):
+		entry = self.datasets.get(dataset.cdcTable)
+		if position is not None:
+			position = [binascii.hexlify(position[0]).upper(), binascii.hexlify(position[1]).upper(), position[2]]
+		elif entry is not None:
+			position = entry['position']
+		self.datasets[dataset.cdcTable] = {'position':position, 'records':numRecords, 'stopped':strftime('%Y-%m-%d %H:%M:%S')}
+		return
+
+	def clear(self, dataset):
+		if dataset.cdcTable in self.datasets:
+			del self.datasets[dataset.cdcTable]
+		return
+
+	########################################################################
+	# Writes the checkpoint, or deletes the file when no dataset was stopped.
+	def save(self):
+		func = 'Checkpoint.save'
+		try:
+			if len(self.datasets) == 0:
+				if os.path.exists(self.path):
+					os.remove(self.path)
+				return
+			with open(self.path, 'w') as f:
+				json.dump(self.datasets, f, indent = 1)
+			logging.info('Saved the checkpoint of ' + str(len(self.datasets)) + ' stopped datasets to ' + self.path)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+
+	def _load(self):
+		if not os.path.exists(self.path):
+			return dict()
+		try:
+			with open(self.path, 'r') as f:
+				return json.load(f)
+		except:
+			logging.warn('Could not read ' + self.path + ', the import starts without a checkpoint')
+		return dict()
+
+###################################################################################################
+###################################################################################################
+#
+# class:	checkpoint.Watermarks
+# purpose:	Remembers for every sink of a replica and every dataset the position of the last
+#			CDC block that the sink saved, its watermark, and the CDC keys of the changes that it
+#			could not save, its retries. The watermarks are a JSON file in the replica's tempPath.
+#
+# notes:	The CDC records of a change are only cleared once every sink saved it, so when one
+#			sink fails or falls behind the records stay in CDC and the next run reads them again.
+#			A sink is then only given the changes after its watermark and its retries, see
+#			io.FanOutEditor. getPosition and getRetries return the values of the previous run,
+#			update and discard change the values that save writes.
+#
+###################################################################################################
+
+class Watermarks(object):
+	#replica: The db.Replica whose sinks are tracked
+	def __init__(self, replica):
+		self.replica = replica
+		name = ''.join([c if c.isalnum() else '_' for c in replica.name])
+		self.path = os.path.join(replica.tempPath, 'watermarks_' + name + '.json')
+		self.sinks = self._load()
+		self._previous = json.loads(json.dumps(self.sinks))
+		return
+
+	def __str__(self):
+		return self.path
+
+	########################################################################
+	# Returns the ChangeBatch.position up to which the sink saved the changes of a dataset, or None.
+	def getPosition(self, sinkName, dataset):
+		entry = self._previous.get(sinkName, dict()).get(dataset.cdcTable)
+		if entry is None or entry['position'] is None:
+			return None
+		lsn, seqval, operation = entry['position']
+		return (binascii.unhexlify(lsn), binascii.unhexlify(seqval), operation)
+
+	########################################################################
+	# Returns the set of CDC keys of the changes of a dataset that the sink could not save.
+	def getRetries(self, sinkName, dataset):
+		entry = self._previous.get(sinkName, dict()).get(dataset.cdcTable)
+		if entry is None:
+			return set()
+		return set(entry['retry'])
+
+	########################################################################
+	# Records what a sink saved of a dataset. The watermark only moves forward.
+	#position:	ChangeBatch.position of the last block the sink saved, or None to keep the watermark
+	#committed:	CDC keys of the changes that the sink saved
+	#failed:	CDC keys of the changes that the sink could not save
+	def update(self, sinkName, dataset, position, committed, failed):
+		entry = self.sinks.setdefault(sinkName, dict()).setdefault(dataset.cdcTable, {'position':None, 'retry':[]})
+		if position is not None:
+			position = [binascii.hexlify(position[0]).upper(), binascii.hexlify(position[1]).upper(), position[2]]
+			if entry['position'] is None or position > entry['position']:
+				entry['position'] = position
+		retry = (set(entry['retry']) - set(committed)) | set(failed)
+		entry['retry'] = sorted(retry)
+		entry['updated'] = strftime('%Y-%m-%d %H:%M:%S')
+		return
+
+	########################################################################
+	# Forgets the retries of CDC records that were cleared, e.g. of quarantined changes.
+	def discard(self, dataset, cdcKeys):
+		cdcKeys = set(cdcKeys)
+		for datasets in self.sinks.values():
+			entry = datasets.get(dataset.cdcTable)
+			if entry is not None:
+				entry['retry'] = [cdcKey for cdcKey in entry['retry'] if not cdcKey in cdcKeys]
+		return
+
+	########################################################################
+	# Returns the watermark and retries of a dataset per sink name, e.g. of a worker process that
+	# imported the dataset, see setDataset.
+	def getDataset(self, dataset):
+		return dict([(sinkName, datasets[dataset.cdcTable]) for sinkName, datasets in self.sinks.items() if dataset.cdcTable in datasets])
+
+	def setDataset(self, dataset, entries):
+		for sinkName in entries:
+			self.sinks.setdefault(sinkName, dict())[dataset.cdcTable] = entries[sinkName]
+		return
+
+	def save(self):
+		func = 'Watermarks.save'
+		try:
+			with open(self.path, 'w') as f:
+				json.dump(self.sinks, f, indent = 1, sort_keys = True)
+			logging.debug('Saved the watermarks of ' + str(len(self.sinks)) + ' sinks to ' + self.path)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+
+	def _load(self):
+		if not os.path.exists(self.path):
+			return dict()
+		try:
+			with open(self.path, 'r') as f:
+				return json.load(f)
+		except:
+			logging.warn('Could not read ' + self.path + ', every sink gets every change')
+		return dict()
@@ -1,9 +1,14 @@
-import os, sys, arcpy, uuid
+import os, sys, uuid, binascii, hashlib
+import time, threading
 import traceback
 import logging
 import pyodbc
+from decimal import Decimal
+from datetime import datetime, date
 
 import util
+import odbc
+arcpy = util.LazyModule('arcpy')
 
 ###################################################################################################
 ###################################################################################################
@@ -32,6 +37,28 @@ class Replicas(object):
 				self.replicas.append(replica)
 		return
 		
+	########################################################################
+	# Groups the replicas that cannot be processed at the same time, because they share a
+	# production workspace or a lock file. Returns a list of lists of replicas, in config order.
+	def getGroups(self):
+		groups = []
+		for replica in self.replicas:
+			merged = [set([os.path.normcase(replica.productionWorkspace), os.path.normcase(replica.lockFilePath)]), []]
+			remaining = []
+			for group in groups:
+				if len(group[0] & merged[0]) > 0:
+					merged[0].update(group[0])
+					merged[1].extend(group[1])
+				else:
+					remaining.append(group)
+			merged[1].append(replica)
+			remaining.append(merged)
+			groups = remaining
+		order = dict((id(self.replicas[i]), i) for i in range(0, len(self.replicas)))
+		result = [sorted(group[1], key = lambda r: order[id(r)]) for group in groups]
+		result.sort(key = lambda group: order[id(group[0])])
+		return result
+		
 ###################################################################################################
 ###################################################################################################
 #
@@ -64,9 +91,81 @@ class Replica(object):
 	#	"sqlserverEditVersion":"DBO.BG-BASE",
 	#	"stagingEditVersions":["DBO.DESKTOP","DBO.MOBILE"],
 	#	"stagingDefaultVersion":"dbo.DEFAULT",
+	#	"stagingRepository":"Staging.dbo",
+	#	"fetchBlockSize":500,
+	#	"pipelineDepth":2,
+	#	"editBatchSize":500,
+	#	"editBatchSeconds":60,
+	#	"skipNoopUpdates":True,
+	#	"quarantineAttempts":3,
+	#	"quarantinePath":r"C:\Users\Public\Documents\BGBase Connector\temp\quarantine.sqlite",
+	#	"reconcileRangeSize":10000,
+	#	"reconcileLeafSize":100,
+	#	"spillChanges":False,
+	#	"spillPath":r"C:\Users\Public\Documents\BGBase Connector\temp\spill",
+	#	"adaptiveBatchSize":False,
+	#	"minBatchSize":50,
+	#	"maxBatchSize":5000,
+	#	"cycleSeconds":10,
+	#	"maxRuntime":3600,
+	#	"slowQuerySeconds":10,
+	#	"slowQueryLog":r"C:\Users\Public\Documents\BGBase Connector\temp\slow_queries.log",
+	#	"maxParallelDatasets":4,
+	#	"snapshotRatio":0.5,
+	#	"sqlEditVersion":"dbo.DEFAULT",
+	#	"sink":{"type":"geopackage", "path":r"C:\Users\Public\Documents\BGBase Connector\temp\mirror.gpkg", "srid":2249},
+	#	"sinks":[{"name":"staging", "type":"sde"}, {"name":"mirror", "type":"geopackage", "path":r"C:\Users\Public\Documents\BGBase Connector\temp\mirror.gpkg"}],
+	#	"freshnessSeconds":900,
 	#	"datasets":[array of Dataset config, see the Dataset class]
 	#}
+	#
+	#stagingRepository (optional): Database and schema of the staging SDE repository tables, used to read
+	#	version state IDs. The lastModified time from arcpy is used when it isn't set.
+	#fetchBlockSize (optional): Number of CDC records read from SQL Server per block.
+	#pipelineDepth (optional): Number of blocks that may wait between the fetch, transform and apply stages.
+	#editBatchSize (optional): Number of changes written to SDE per edit session before the edits are saved.
+	#editBatchSeconds (optional): Number of seconds after which the edits of an edit session are saved.
+	#skipNoopUpdates (optional): Compare updates with the SDE rows and skip the ones that don't change any value.
+	#quarantineAttempts (optional): Number of runs a change may fail before it is quarantined and cleared from CDC.
+	#quarantinePath (optional): SQLite file of the quarantine, defaults to quarantine.sqlite in tempPath.
+	#reconcileRangeSize (optional): Number of Warehouse rows per key range whose checksums are compared by --reconcile.
+	#reconcileLeafSize (optional): Number of rows below which a differing key range is compared row by row.
+	#spillChanges (optional): Write the CDC records that are read from SQL Server to columnar files, so that
+	#	an import can be repeated from disk with sqlserver_to_sde.py --from-spill.
+	#spillPath (optional): Folder of the spilled CDC records, defaults to the spill folder in tempPath.
+	#adaptiveBatchSize (optional): Adjust fetchBlockSize and editBatchSize during the import to the time
+	#	per row and the waits of the previous batches, and shrink them when SQL Server reports blocking.
+	#minBatchSize, maxBatchSize (optional): Bounds of the adjusted sizes.
+	#cycleSeconds (optional): Interleave the imports of the datasets. Every cycle of this many seconds is
+	#	shared by the datasets that have changes, in proportion to their priority, so the changes of a
+	#	small dataset are not held up by the backlog of a large one. Without it the datasets are imported
+	#	one after the other, highest priority first.
+	#maxRuntime (optional): Seconds after which the import of the replica stops. The current batch is
+	#	finished, the saved changes are cleared from CDC and synchronized, and a checkpoint is written
+	#	from which the next run continues.
+	#slowQuerySeconds (optional): Seconds after which a SQL Server statement is logged as slow, see odbc.QueryStats.
+	#slowQueryLog (optional): File to which the slow statements are appended, defaults to slow_queries.log in tempPath.
+	#maxParallelDatasets (optional): Number of datasets that are imported at the same time when the datasets
+	#	have dependencies, see the dependsOn option of Dataset. Defaults to 1. With more than one, every
+	#	dataset is imported in a worker process of its own.
+	#snapshotRatio (optional): When the CDC table of a dataset has more records than this ratio of the rows
+	#	of its source table, staging is reloaded from the source table instead of replaying the records.
+	#	The CDC records up to the snapshot are cleared with one range delete, and only the records after
+	#	it are imported. Without it the CDC records are always replayed.
+	#sqlEditVersion (optional): Version of staging that datasets with applyMode "sql" edit through their
+	#	versioned views, defaults to stagingDefaultVersion. Another version is edited in an edit_version
+	#	session, which needs stagingRepository.
+	#sink (optional): Where the changes are written, see io.openSinks. "sde" writes them to stagingWorkspace
+	#	and synchronizes production, "sqlite" and "geopackage" write them to the tables of the file at path,
+	#	without arcpy and without synchronizing production. srid is the spatial reference system of the
+	#	points of a GeoPackage. Defaults to "sde".
+	#sinks (optional): Several sinks, instead of sink, that are written from a single read of the CDC records,
+	#	see io.FanOutEditor. Every sink needs a name, which defaults to its type, and only one can be "sde".
+	#freshnessSeconds (optional): Target for the seconds from the commit of a change in Warehouse until it
+	#	is in production. The run report counts the CDC records that took longer and a warning is logged
+	#	when the p95 of a dataset is above it, see lag.LagTracker.
 	def __init__(self, config):
+		self.config = config
 		self.name = config['name']
 		self.datasets = []
 		
@@ -86,12 +185,149 @@ class Replica(object):
 		self.stagingEditVersions = config['stagingEditVersions']
 		self.stagingDefaultVersion = config['stagingDefaultVersion']
 		
+		if 'stagingRepository' in config:
+			self.stagingRepository = config['stagingRepository']
+		else:
+			self.stagingRepository = None
+		
+		if 'fetchBlockSize' in config:
+			self.fetchBlockSize = config['fetchBlockSize']
+		else:
+			self.fetchBlockSize = 500
+		
+		if 'pipelineDepth' in config:
+			self.pipelineDepth = config['pipelineDepth']
+		else:
+			self.pipelineDepth = 2
+		
+		if 'editBatchSize' in config:
+			self.editBatchSize = config['editBatchSize']
+		else:
+			self.editBatchSize = 500
+		
+		if 'editBatchSeconds' in config:
+			self.editBatchSeconds = config['editBatchSeconds']
+		else:
+			self.editBatchSeconds = 60
+		
+		if 'skipNoopUpdates' in config:
+			self.skipNoopUpdates = config['skipNoopUpdates']
+		else:
+			self.skipNoopUpdates = False
+		
+		if 'quarantineAttempts' in config:
+			self.quarantineAttempts = config['quarantineAttempts']
+		else:
+			self.quarantineAttempts = 3
+		
+		if 'quarantinePath' in config:
+			self.quarantinePath = config['quarantinePath']
+		else:
+			self.quarantinePath = os.path.join(self.tempPath, 'quarantine.sqlite')
+		
+		if 'reconcileRangeSize' in config:
+			self.reconcileRangeSize = config['reconcileRangeSize']
+		else:
+			self.reconcileRangeSize = 10000
+		
+		if 'reconcileLeafSize' in config:
+			self.reconcileLeafSize = config['reconcileLeafSize']
+		else:
+			self.reconcileLeafSize = 100
+		
+		if 'spillChanges' in config:
+			self.spillChanges = config['spillChanges']
+		else:
+			self.spillChanges = False
+		
+		if 'spillPath' in config:
+			self.spillPath = config['spillPath']
+		else:
+			self.spillPath = os.path.join(self.tempPath, 'spill')
+		
+		if 'adaptiveBatchSize' in config:
+			self.adaptiveBatchSize = config['adaptiveBatchSize']
+		else:
+			self.adaptiveBatchSize = False
+		
+		if 'minBatchSize' in config:
+			self.minBatchSize = config['minBatchSize']
+		else:
+			self.minBatchSize = 50
+		
+		if 'maxBatchSize' in config:
+			self.maxBatchSize = config['maxBatchSize']
+		else:
+			self.maxBatchSize = 5000
+		
+		if 'cycleSeconds' in config:
+			self.cycleSeconds = config['cycleSeconds']
+		else:
+			self.cycleSeconds = None
+		
+		if 'maxRuntime' in config:
+			self.maxRuntime = config['maxRuntime']
+		else:
+			self.maxRuntime = None
+		
+		if 'slowQuerySeconds' in config:
+			self.slowQuerySeconds = config['slowQuerySeconds']
+		else:
+			self.slowQuerySeconds = 10
+		
+		if 'slowQueryLog' in config:
+			self.slowQueryLog = config['slowQueryLog']
+		else:
+			self.slowQueryLog = os.path.join(self.tempPath, 'slow_queries.log')
+		
+		if 'maxParallelDatasets' in config:
+			self.maxParallelDatasets = config['maxParallelDatasets']
+		else:
+			self.maxParallelDatasets = 1
+		
+		if 'snapshotRatio' in config:
+			self.snapshotRatio = config['snapshotRatio']
+		else:
+			self.snapshotRatio = None
+		
+		if 'sqlEditVersion' in config:
+			self.sqlEditVersion = config['sqlEditVersion']
+		else:
+			self.sqlEditVersion = self.stagingDefaultVersion
+		
+		if 'sinks' in config:
+			self.sinks = config['sinks']
+		elif 'sink' in config:
+			self.sinks = [config['sink']]
+		else:
+			self.sinks = []
+		for sink in self.sinks:
+			if not sink.get('type') in _SINKS:
+				raise ValueError(self.name + ': sink type must be one of ' + ', '.join(_SINKS))
+		names = [sink.get('name', sink['type']) for sink in self.sinks]
+		if len(set(names)) < len(names):
+			raise ValueError(self.name + ': every sink needs a name of its own')
+		if len([sink for sink in self.sinks if sink['type'] == 'sde']) > 1:
+			#arcpy can't edit the workspace in several sessions of one process at the same time.
+			raise ValueError(self.name + ': only one sink can be of type sde')
+		
+		if 'freshnessSeconds' in config:
+			self.freshnessSeconds = config['freshnessSeconds']
+		else:
+			self.freshnessSeconds = None
+		
 		server = config['sqlServer']['server']
 		database = config['sqlServer']['database']
+		self._database = database
 		self._connectionString = "DRIVER={SQL Server};SERVER=${server};DATABASE=${database};Trusted_Connection=yes".replace('${server}', server).replace('${database}', database)
 		
 		self._connection = None
+		self._monitorConnection = None
+		self._monitorLock = threading.Lock()
+		self._blockingChecked = 0
+		self._blocked = False
 		self.dbutil = util.DBUtil()
+		self.queryStats = odbc.QueryStats(self.name, self.slowQuerySeconds, self.slowQueryLog)
 
 		if not self.disabled:
 			for i in range(0, len(config['datasets'])):
@@ -100,6 +336,7 @@ class Replica(object):
 					logging.info(str(dataset) + ' is disabled.')
 				else:
 					self.datasets.append(dataset)
+		self._dependencyProblems = self._resolveDependencies()
 		return
 		
 	def __del__(self):
@@ -121,7 +358,7 @@ class Replica(object):
 	def connect(self):
 		func = 'Replica._connect'
 		try:
-			self._connection = pyodbc.connect(self._connectionString)
+			self._connection = odbc.InstrumentedConnection(pyodbc.connect(self._connectionString), self.queryStats)
 			return True
 		except:
 			self._connection = None
@@ -131,7 +368,24 @@ class Replica(object):
 			logging.error(msg);
 		return False
 		
+	########################################################################
+	# Returns a new connection to the replica's database, or None if it could not be opened.
+	def openConnection(self):
+		func = 'Replica.openConnection'
+		try:
+			return odbc.InstrumentedConnection(pyodbc.connect(self._connectionString), self.queryStats)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg);
+		return None
+		
 	def closeConnection(self):
+		with self._monitorLock:
+			if self._monitorConnection is not None:
+				self.close(self._monitorConnection)
+				self._monitorConnection = None
 		if self.isConnected():
 			try:
 				self._connection.close()
@@ -145,6 +399,381 @@ class Replica(object):
 		
 	def getConnection(self):
 		return self._connection
+		
+	########################################################################
+	# Returns the datasets whose sdeTable, cdcTable or sourceTable is name, or whose source table
+	# has the name without database and schema, e.g. PLANTS_LOCATION.
+	def getDatasets(self, name):
+		name = name.upper()
+		datasets = []
+		for dataset in self.datasets:
+			names = [dataset.sdeTable, dataset.cdcTable, dataset.sourceTable, dataset.sourceTable.split('.')[-1]]
+			if name in [n.upper() for n in names]:
+				datasets.append(dataset)
+		return datasets
+		
+	def hasDependencies(self):
+		return True in [len(dataset.parents) > 0 for dataset in self.datasets]
+		
+	########################################################################
+	# Returns the datasets parents first, or None if the dependencies have a cycle.
+	def getDependencyOrder(self):
+		ordered = []
+		remaining = list(self.datasets)
+		while len(remaining) > 0:
+			ready = [dataset for dataset in remaining if not True in [parent in remaining for parent in dataset.parents]]
+			if len(ready) == 0:
+				return None
+			ordered.extend(ready)
+			remaining = [dataset for dataset in remaining if not dataset in ready]
+		return ordered
+		
+	########################################################################
+	# Sets the parents of the datasets from their dependsOn names.
+	# returns a list of problems
+	def _resolveDependencies(self):
+		problems = []
+		for dataset in self.datasets:
+			for name in dataset.dependsOn:
+				parents = [parent for parent in self.getDatasets(name) if parent is not dataset]
+				if len(parents) == 0:
+					problems.append(str(dataset) + ': depends on ' + name + ', which is not a dataset of ' + self.name)
+				for parent in parents:
+					if not parent in dataset.parents:
+						dataset.parents.append(parent)
+		if self.getDependencyOrder() is None:
+			problems.append('The dependencies of the datasets have a cycle')
+		for problem in problems:
+			logging.error(self.name + ': ' + problem)
+		return problems
+		
+	########################################################################
+	# Returns True if SQL Server has requests in Warehouse or the staging database that waited
+	# longer than _BLOCKED_WAIT_MS for a lock held by another session. The result is kept for
+	# _BLOCKING_CHECK_SECONDS. A separate connection is used, because the CDC query may still
+	# be reading on the replica's connection.
+	def isBlocked(self):
+		func = 'Replica.isBlocked'
+		with self._monitorLock:
+			if time.time() - self._blockingChecked < _BLOCKING_CHECK_SECONDS:
+				return self._blocked
+			self._blockingChecked = time.time()
+			cursor = None
+			try:
+				if self._monitorConnection is None:
+					self._monitorConnection = odbc.InstrumentedConnection(pyodbc.connect(self._connectionString, autocommit = True), self.queryStats)
+				databases = [self._database]
+				if self.stagingRepository is not None:
+					databases.append(self.stagingRepository.split('.')[0])
+				sql = 'SELECT COUNT(*) FROM sys.dm_exec_requests WHERE blocking_session_id <> 0 AND wait_time >= ? AND database_id IN (' + ', '.join(['DB_ID(?)'] * len(databases)) + ')'
+				cursor = self._monitorConnection.cursor()
+				cursor.execute(sql, _BLOCKED_WAIT_MS, *databases)
+				self._blocked = cursor.fetchone()[0] > 0
+				if self._blocked:
+					logging.debug('SQL Server reports blocked requests in ' + ', '.join(databases))
+			except:
+				#Without VIEW SERVER STATE the blocking is never reported, don't ask again.
+				self._blockingChecked = sys.maxint
+				self._blocked = False
+				tb = sys.exc_info()[2]
+				tbinfo = traceback.format_tb(tb)[0]
+				msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+				logging.warn(msg)
+			finally:
+				self.close(cursor)
+			return self._blocked
+		
+	########################################################################
+	# Returns the seconds since the commit of the transactions of the CDC records with a
+	# __$start_lsn from firstLsn to lastLsn, read from the lsn_time_mapping table of CDC with one
+	# range query instead of sys.fn_cdc_map_lsn_to_time for every LSN. The age is computed on
+	# the clock of SQL Server, which need not agree with the local clock.
+	# lsnTimeMapping: The lsn_time_mapping table, see Dataset.lsnTimeMapping
+	# returns a dictionary of __$start_lsn to seconds, or None if the table can't be read
+	def getCommitAges(self, lsnTimeMapping, firstLsn, lastLsn):
+		func = 'Replica.getCommitAges'
+		with self._monitorLock:
+			cursor = None
+			try:
+				if self._monitorConnection is None:
+					self._monitorConnection = odbc.InstrumentedConnection(pyodbc.connect(self._connectionString, autocommit = True), self.queryStats)
+				sql = 'SELECT start_lsn, DATEDIFF(second, tran_end_time, GETDATE()) FROM ' + lsnTimeMapping + ' WHERE start_lsn BETWEEN ? AND ?'
+				cursor = self._monitorConnection.cursor()
+				cursor.execute(sql, bytearray(firstLsn), bytearray(lastLsn))
+				return dict([(str(row[0]), row[1]) for row in cursor.fetchall() if row[1] is not None])
+			except:
+				tb = sys.exc_info()[2]
+				tbinfo = traceback.format_tb(tb)[0]
+				msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+				logging.warn(msg)
+			finally:
+				self.close(cursor)
+			return None
+		
+	########################################################################
+	# Checks the configuration of the replica without arcpy: the folders and connection files
+	# exist, the replica isn't locked, and the CDC tables of the datasets can be read.
+	# returns a list of problems, empty if the replica is ready to run
+	def check(self):
+		problems = []
+		for name in ['tempPath', 'exportPath']:
+			if not os.path.isdir(getattr(self, name)):
+				problems.append(name + ' ' + getattr(self, name) + ' does not exist')
+		for name in ['stagingWorkspace', 'productionWorkspace']:
+			if not os.path.exists(getattr(self, name)):
+				problems.append(name + ' ' + getattr(self, name) + ' does not exist')
+		if os.path.exists(self.lockFilePath):
+			problems.append('Locked by ' + self.lockFilePath + ', delete it if the replica is not running')
+		problems.extend(self._dependencyProblems)
+		if not self.connect():
+			problems.append('Could not connect to SQL Server with ' + self._connectionString)
+			return problems
+		try:
+			for dataset in self.datasets:
+				problems.extend(dataset.check())
+		finally:
+			self.closeConnection()
+		return problems
+
+#Types of the sink and sinks options of Replica.
+_SINKS = ['sde', 'sqlite', 'geopackage']
+
+#CDC __$operation codes. Code 3 (update before-image) is not applied.
+_operations = {1:"delete", 2:"insert", 4:"update"}
+
+#Number of CDC records that clearChanges deletes with one statement.
+_CLEAR_CHUNK_SIZE = 1000
+
+#Condition of the CDC records after a ChangeBatch.position, in the order of the CDC query.
+_AFTER_POSITION = '__$start_lsn > ? OR (__$start_lsn = ? AND (__$seqval > ? OR (__$seqval = ? AND __$operation > ?)))'
+
+#Milliseconds a request has to wait for a lock before Replica.isBlocked reports it.
+_BLOCKED_WAIT_MS = 1000
+
+#Seconds for which the result of Replica.isBlocked is kept.
+_BLOCKING_CHECK_SECONDS = 5
+
+########################################################################
+# Returns the net operation of two consecutive operations on the same key.
+# "skip" is a record that was inserted and deleted again, nothing has to be applied for it.
+def _coalesceOperations(previous, current):
+	if current == "delete":
+		if previous == "insert" or previous == "skip":
+			return "skip"
+		return "delete"
+	if previous == "insert" or previous == "skip":
+		return "insert"
+	#The record may not exist in SDE after a delete, updates fall back to an insert.
+	return "update"
+
+########################################################################
+# Returns the name of the table that is tracked by a CDC change table, e.g.
+# Warehouse.cdc.dbo_PLANTS_LOCATION_CT -> Warehouse.dbo.PLANTS_LOCATION
+def _sourceTableName(cdcTable):
+	parts = cdcTable.split('.')
+	name = parts[-1]
+	if name.upper().endswith('_CT'):
+		name = name[:-3]
+	schema = 'dbo'
+	if '_' in name:
+		schema, name = name.split('_', 1)
+	if len(parts) > 2:
+		return parts[0] + '.' + schema + '.' + name
+	return schema + '.' + name
+
+########################################################################
+# Returns the lsn_time_mapping table of the database of a CDC table, e.g. Warehouse.cdc.lsn_time_mapping
+# for Warehouse.cdc.PLANTS_LOCATION_CT.
+def _lsnTimeMappingName(cdcTable):
+	parts = cdcTable.split('.')
+	if len(parts) > 2:
+		return parts[0] + '.cdc.lsn_time_mapping'
+	return 'cdc.lsn_time_mapping'
+
+########################################################################
+# Returns False for the DEFAULT version, e.g. dbo.DEFAULT or sde.DEFAULT, which is edited without
+# an edit_version session.
+def isNamedVersion(version):
+	return version.split('.')[-1].upper() != 'DEFAULT'
+
+###################################################################################################
+###################################################################################################
+#
+# class:	db.Change
+# purpose:	The net change of one primary key in a block of CDC records.
+#			seqvals holds the raw __$seqval of every CDC record that was folded into the change,
+#			so that all of them can be cleared once the change has been applied. error is set
+#			when the change could not be applied.
+#
+# notes:	A backlog can hold millions of changes, so the class has __slots__, row is the
+#			tuple of projected values (without the __$ columns) and the seqvals are kept as
+#			10 byte strings. cdcKeys returns them as the hex strings used by clearChanges and
+#			the quarantine.
+#
+###################################################################################################
+
+class Change(object):
+	__slots__ = ('op', 'key', 'row', 'seqvals', 'error')
+	
+	#seqval: Raw __$seqval of the CDC record, or None for changes that are not read from CDC
+	def __init__(self, op, key, row, seqval):
+		self.op = op
+		self.key = key
+		self.row = row
+		if seqval is None:
+			self.seqvals = ()
+		else:
+			self.seqvals = (seqval,)
+		self.error = None
+		return
+		
+	def addSeqval(self, seqval):
+		self.seqvals = self.seqvals + (seqval,)
+		return
+		
+	def _getCdcKeys(self):
+		return [binascii.hexlify(seqval).upper() for seqval in self.seqvals]
+		
+	def _setCdcKeys(self, cdcKeys):
+		self.seqvals = tuple([binascii.unhexlify(cdcKey) for cdcKey in cdcKeys])
+		return
+		
+	cdcKeys = property(_getCdcKeys, _setCdcKeys)
+	
+	########################################################################
+	# Folds a later change of the same key into this one.
+	def merge(self, later):
+		self.op = _coalesceOperations(self.op, later.op)
+		self.row = later.row
+		self.seqvals = self.seqvals + later.seqvals
+		return
+
+###################################################################################################
+###################################################################################################
+#
+# class:	db.ChangeBatch
+# purpose:	The coalesced changes of one block of CDC records, in the order in which the
+#			keys first appeared in the block. position is the (__$start_lsn, __$seqval,
+#			__$operation) of the last record of the block, the order of the CDC query. lsns
+#			counts the records of the block per __$start_lsn, for lag.LagTracker.
+#
+###################################################################################################
+
+class ChangeBatch(object):
+	__slots__ = ('dataset', 'fields', 'changes', 'numRecords', 'position', 'lsns')
+	
+	def __init__(self, dataset, fields):
+		self.dataset = dataset
+		self.fields = fields
+		self.changes = []
+		self.numRecords = 0
+		self.position = None
+		self.lsns = dict()
+		return
+		
+	def __len__(self):
+		return len(self.changes)
+
+###################################################################################################
+###################################################################################################
+#
+# class:	db.ColumnMap
+# purpose:	The columns of a dataset that are read from SQL Server and how they are written to SDE.
+#			Builds the SELECT list of the CDC query, so that only the mapped columns are transferred,
+#			and the converters that turn the values into the declared types.
+#
+# notes:	Renamed and computed columns are selected with an alias, so the rows that reach the
+#			importer already have the SDE field names. Without a column map every column is
+#			selected, and Decimal values are converted to float.
+#
+###################################################################################################
+
+class ColumnMap(object):
+	#columns: Array of column entries, see the Dataset class, or None to select every column
+	#ignoreColumns: Array of SDE field names that are never written
+	def __init__(self, columns, ignoreColumns):
+		self.columns = []
+		self.ignored = set([name.upper() for name in (ignoreColumns or [])])
+		for column in (columns or []):
+			if 'expression' in column:
+				expression = '(' + column['expression'] + ')'
+				target = column['target']
+			else:
+				expression = '[' + column['source'] + ']'
+				target = column.get('target', column['source'])
+			columnType = column.get('type')
+			if columnType is not None and not columnType in _converters:
+				raise ValueError('Unknown type ' + str(columnType) + ' of column ' + target + ', use one of ' + ', '.join(sorted(_converters)))
+			self.columns.append((target, expression, columnType))
+		return
+		
+	def isMapped(self):
+		return len(self.columns) > 0
+		
+	########################################################################
+	# Returns the SELECT list of the mapped columns.
+	# required: Names of columns that are selected unchanged when they are not mapped, e.g. the key
+	def getSelectList(self, required = []):
+		if not self.isMapped():
+			return '*'
+		targets = set([column[0].upper() for column in self.columns])
+		items = ['[' + name + ']' for name in required if not name.upper() in targets]
+		for target, expression, columnType in self.columns:
+			items.append(expression + ' AS [' + target + ']')
+		return ', '.join(items)
+		
+	########################################################################
+	# Returns the fields of the projected rows of rows with the given fields, which have every
+	# column except the __$ columns of CDC, and the list of (index, converter) tuples that builds
+	# them. Declared types are converted directly, other values only when they are Decimal.
+	def getProjection(self, fields):
+		declared = dict()
+		for target, expression, columnType in self.columns:
+			if columnType is not None:
+				declared[target] = _converters[columnType]
+		names = [name for name in fields if not name.startswith('__$')]
+		names.sort(key = lambda name: fields[name])
+		projected = dict()
+		converters = []
+		for name in names:
+			projected[name] = len(converters)
+			converters.append((fields[name], declared.get(name, _fromDecimal)))
+		return (projected, converters)
+		
+	def isIgnored(self, name):
+		return name.upper() in self.ignored
+
+def _fromDecimal(value):
+	if isinstance(value, Decimal):
+		return float(value)
+	return value
+
+def _toUnicode(value):
+	if isinstance(value, unicode):
+		return value
+	if isinstance(value, str):
+		return value.decode('cp1252', 'replace')
+	return unicode(value)
+
+def _toDate(value):
+	if isinstance(value, datetime):
+		return value
+	if isinstance(value, date):
+		return datetime(value.year, value.month, value.day)
+	return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+#Converters of the types that can be declared in a column map.
+_converters = {
+	'str':_toUnicode,
+	'int':lambda value: int(value),
+	'float':lambda value: float(value),
+	'date':_toDate,
+	'bool':lambda value: bool(value)
+}
+
+#Parameters of _AFTER_POSITION.
+def _getPositionParams(position):
+	return [bytearray(position[0]), bytearray(position[0]), bytearray(position[1]), bytearray(position[1]), position[2]]
 
 ###################################################################################################
 ###################################################################################################
@@ -164,6 +793,7 @@ class Dataset(object):
 	#		"sqlserverDataset":
 	#		{
 	#			"table":"Warehouse.cdc.dbo_PLANTS_LOCATION_CT",
+	#			"sourceTable":"Warehouse.dbo.PLANTS_LOCATION",
 	#			"primaryKey":"rep_id",
 	#			"xField":"X_COORD",
 	#			"yField":"Y_COORD"
@@ -171,10 +801,48 @@ class Dataset(object):
 	#		"sdeDataset":
 	#		{
 	#			"table":"Staging.dbo.PLANTS_LOCATION",
-	#			"primaryKey":"rep_id"
-	#		}
+	#			"primaryKey":"rep_id",
+	#			"versionedView":"Staging.dbo.PLANTS_LOCATION_VW"
+	#		},
+	#		"columns":[
+	#			{"source":"ACC_NUM"},
+	#			{"source":"GRID", "target":"GRID_ID", "type":"str"},
+	#			{"target":"ACC_NUM_AND_QUAL", "expression":"ACC_NUM + ACC_NUM_QUAL", "type":"str"}
+	#		],
+	#		"ignoreColumns":["LEGACY_ID"],
+	#		"priority":1,
+	#		"shards":1,
+	#		"dependsOn":["PLANTS_LOCATION"],
+	#		"changeSource":"rowversion",
+	#		"applyMode":"sql"
 	#	}
 	#
+	#sourceTable (optional): The table that is tracked by CDC. When omitted it is derived from the
+	#	CDC table name, Warehouse.cdc.dbo_PLANTS_LOCATION_CT is the change table of Warehouse.dbo.PLANTS_LOCATION.
+	#columns (optional): The columns that are read from SQL Server. source is the SQL Server column and
+	#	target the SDE field, which defaults to source. A computed column has a SQL expression instead
+	#	of a source. type converts the values to str, int, float, date or bool. Without columns every
+	#	column is read. The primary key, xField and yField are always read.
+	#ignoreColumns (optional): SDE fields that are never written.
+	#priority (optional): Weight of the dataset when the replica's datasets are scheduled, see cycleSeconds.
+	#	Datasets with a higher priority are imported first and get a larger share of every cycle.
+	#shards (optional): Number of edit sessions that write the changes of the dataset at the same time.
+	#	The changes are split by the hash of the primary key, every shard is written in a process of its own.
+	#	The edit batch size of a sharded dataset is not adjusted by adaptiveBatchSize.
+	#dependsOn (optional): Datasets whose rows this dataset references, by sdeTable, cdcTable or source
+	#	table name. The inserts and updates of a dataset are applied after those of the datasets it
+	#	depends on, and its deletes before theirs. Datasets that don't depend on each other are imported
+	#	at the same time, up to maxParallelDatasets of the replica. cycleSeconds is not used then.
+	#changeSource (optional): Imports a table that doesn't have CDC, see TableChangeSource. table is then the
+	#	table itself and cdcFunction can be omitted. "rowversion" finds the changed rows by the rowversion
+	#	column that is set as rowversion in sqlserverDataset, "hash" by a hash of every row.
+	#applyMode (optional): "arcpy" writes the changes with arcpy cursors, one change at a time. "sql" writes
+	#	the changes of a table without xField and yField with a few set-based statements per edit batch
+	#	against its versioned view, see io.SqlEditor. Defaults to "arcpy".
+	#versionedView (optional): The versioned view of the SDE table that applyMode "sql" edits, defaults to
+	#	the table name with _VW appended, the name ArcGIS gives the view when the table is registered
+	#	as versioned.
+	#
 	#replica: The parent Replica object
 	def __init__(self, config, replica):
 		self.replica = replica
@@ -182,8 +850,15 @@ class Dataset(object):
 			self.disabled = config['disabled']
 		else:
 			self.disabled = False
-		self.cdcFunction = config['cdcFunction']
+		self.cdcFunction = config.get('cdcFunction')
 		self.cdcTable = config['sqlserverDataset']['table']
+		if 'sourceTable' in config['sqlserverDataset']:
+			self.sourceTable = config['sqlserverDataset']['sourceTable']
+		elif 'changeSource' in config:
+			self.sourceTable = self.cdcTable
+		else:
+			self.sourceTable = _sourceTableName(self.cdcTable)
+		self.lsnTimeMapping = _lsnTimeMappingName(self.cdcTable)
 		self.cdcPrimaryKey = config['sqlserverDataset']['primaryKey']
 		self.isSpatial = ('xField' in config['sqlserverDataset']) and ('yField' in config['sqlserverDataset'])
 		if self.isSpatial:
@@ -191,7 +866,35 @@ class Dataset(object):
 			self.yField = config['sqlserverDataset']['yField']
 		self.sdeTable = config['sdeDataset']['table']
 		self.sdePrimaryKey = config['sdeDataset']['primaryKey']
+		if 'versionedView' in config['sdeDataset']:
+			self.versionedView = config['sdeDataset']['versionedView']
+		else:
+			self.versionedView = self.sdeTable + '_VW'
+		self.columns = ColumnMap(config.get('columns'), config.get('ignoreColumns'))
+		if 'priority' in config:
+			self.priority = config['priority']
+		else:
+			self.priority = 1
+		if 'shards' in config:
+			self.shards = config['shards']
+		else:
+			self.shards = 1
+		if 'dependsOn' in config:
+			self.dependsOn = config['dependsOn']
+		else:
+			self.dependsOn = []
+		self.parents = []
+		if 'changeSource' in config:
+			self.changeSource = TableChangeSource(self, config['changeSource'], config['sqlserverDataset'].get('rowversion'))
+		else:
+			self.changeSource = None
+		if 'applyMode' in config:
+			self.applyMode = config['applyMode']
+		else:
+			self.applyMode = 'arcpy'
+		self._missingFields = set()
 		
+		self._connection = None
 		self._changeCursor = None
 		self._changeCursorFields = None
 		
@@ -200,22 +903,45 @@ class Dataset(object):
 	def __str__(self):
 		return self.cdcTable + '->' + self.sdeTable;
 		
+	########################################################################
+	# Opens a connection of the dataset's own, which is used instead of the replica's connection
+	# until closeConnection is called. Needed when the CDC records of several datasets are read
+	# at the same time.
+	def openConnection(self):
+		self.closeConnection()
+		self._connection = self.replica.openConnection()
+		return self._connection is not None
+		
+	def closeConnection(self):
+		if self._connection is not None:
+			self.replica.close(self._changeCursor)
+			self._changeCursor = None
+			self.replica.close(self._connection)
+			self._connection = None
+		return
+		
+	def getConnection(self):
+		if self._connection is not None:
+			return self._connection
+		return self.replica.getConnection()
+		
 	########################################################################
 	# Executes the CDC function and returns a cursor of CDC records for the dataset.
-	def getChanges(self):
+	# position: ChangeBatch.position after which the records are read, or None to read all of them
+	def getChanges(self, position = None):
 		func = 'Dataset.getChanges'
 		sql = ''
 		try:
 			self.replica.close(self._changeCursor)
 			self._changeCursorFields = None
 			
-			if not self.replica.isConnected():
+			if self.getConnection() is None:
 				logging.error(func + ': No connection')
 				return None
 		
 			dateUtil = util.DateUtil()
 			now = dateUtil.now()
-			self._changeCursor = self.replica.getConnection().cursor()
+			self._changeCursor = self.getConnection().cursor()
 		
 			#logging.debug('Calling CDC function ' + self.cdcFunction)
 			sql = '''
@@ -228,9 +954,17 @@ SELECT *, CONVERT(VARCHAR(MAX), __$seqval, 2) as __$CDCKEY FROM ''' + self.cdcFu
 '''
 			#selecting from CDC table instead, due to SQL Server CDC bug with multiple tables
 			logging.debug('Selecting CDC data from ' + self.cdcTable)
-			sql = 'SELECT *, CONVERT(VARCHAR(MAX), __$seqval, 2) as __$CDCKEY FROM ' + self.cdcTable
+			columns = '*'
+			if self.columns.isMapped():
+				columns = '__$start_lsn, __$seqval, __$operation, ' + self.getSelectList()
+			where = ''
+			params = []
+			if position is not None:
+				where = ' WHERE ' + _AFTER_POSITION
+				params = _getPositionParams(position)
+			sql = 'SELECT ' + columns + ' FROM ' + self.cdcTable + where + ' ORDER BY __$start_lsn, __$seqval, __$operation'
 			try:
-				self._changeCursor.execute(sql)
+				self._changeCursor.execute(sql, *params)
 			except:
 				logging.warn('Error calling CDC function. Dataset probably has no CDC changes.')
 				return None;
@@ -249,6 +983,251 @@ SELECT *, CONVERT(VARCHAR(MAX), __$seqval, 2) as __$CDCKEY FROM ''' + self.cdcFu
 	def getChangeFields(self):
 		return self._changeCursorFields
 		
+	########################################################################
+	# Returns True if the CDC table has records. If the table can't be read the dataset is
+	# assumed to have changes, so that the import reports the error.
+	def hasChanges(self):
+		if self.changeSource is not None:
+			return self.changeSource.hasChanges()
+		cursor = None
+		try:
+			cursor = self.getConnection().cursor()
+			cursor.execute('SELECT TOP 1 __$seqval FROM ' + self.cdcTable)
+			return cursor.fetchone() is not None
+		except:
+			return True
+		finally:
+			self.replica.close(cursor)
+		
+	def countChanges(self):
+		return self._count(self.cdcTable)
+		
+	########################################################################
+	# Counts the CDC records that are still in the CDC table, e.g. records that were read earlier.
+	# cdcKeys: CDC keys of the records, see Change.cdcKeys
+	def countRecords(self, cdcKeys):
+		cursor = self.getConnection().cursor()
+		try:
+			numRecords = 0
+			for i in xrange(0, len(cdcKeys), _CLEAR_CHUNK_SIZE):
+				ids = ','.join(['0x' + cdcKey for cdcKey in cdcKeys[i:i + _CLEAR_CHUNK_SIZE]])
+				cursor.execute('SELECT COUNT_BIG(*) FROM ' + self.cdcTable + ' where __$seqval in (' + ids + ')')
+				numRecords = numRecords + int(cursor.fetchone()[0])
+			return numRecords
+		finally:
+			self.replica.close(cursor)
+		
+	########################################################################
+	# Counts the CDC records of some keys after a ChangeBatch.position.
+	def countLaterChanges(self, position, keys):
+		params = _getPositionParams(position)
+		cursor = self.getConnection().cursor()
+		try:
+			numRecords = 0
+			for i in xrange(0, len(keys), _CLEAR_CHUNK_SIZE):
+				chunk = keys[i:i + _CLEAR_CHUNK_SIZE]
+				sql = 'SELECT COUNT_BIG(*) FROM ' + self.cdcTable + ' WHERE (' + _AFTER_POSITION + ') AND [' + self.cdcPrimaryKey + '] IN (' + ','.join(['?'] * len(chunk)) + ')'
+				cursor.execute(sql, *(params + chunk))
+				numRecords = numRecords + int(cursor.fetchone()[0])
+			return numRecords
+		finally:
+			self.replica.close(cursor)
+		
+	def countRows(self):
+		return self._count(self.sourceTable)
+		
+	def _count(self, table):
+		cursor = self.getConnection().cursor()
+		try:
+			cursor.execute('SELECT COUNT_BIG(*) FROM ' + table)
+			return int(cursor.fetchone()[0])
+		finally:
+			self.replica.close(cursor)
+		
+	########################################################################
+	# Returns the highest LSN that CDC has captured, as a binary string. Every CDC record of the
+	# dataset up to it is in the CDC table, so a snapshot of the source table that is read after
+	# this call contains all of them.
+	def getMaxLsn(self):
+		cursor = self.getConnection().cursor()
+		try:
+			cursor.execute('SELECT sys.fn_cdc_get_max_lsn()')
+			lsn = cursor.fetchone()[0]
+			if lsn is None:
+				return None
+			return str(lsn)
+		finally:
+			self.replica.close(cursor)
+		
+	########################################################################
+	# Deletes the CDC records up to and including lsn with a single statement.
+	# returns the number of records that were deleted
+	def clearChangesThrough(self, lsn):
+		logging.info('Clearing changes up to LSN 0x' + binascii.hexlify(lsn).upper() + ' from ' + self.cdcTable)
+		cursor = self.getConnection().cursor()
+		try:
+			cursor.execute('DELETE FROM ' + self.cdcTable + ' WHERE __$start_lsn <= ?', bytearray(lsn))
+			numDeleted = cursor.rowcount
+			self.getConnection().commit()
+		finally:
+			self.replica.close(cursor)
+		logging.debug('Deleted ' + str(numDeleted) + ' rows from ' + self.cdcTable)
+		return numDeleted
+		
+	########################################################################
+	# Checks that the CDC table can be read with the dataset's columns.
+	# returns a list of problems
+	def check(self):
+		problems = []
+		cursor = None
+		try:
+			cursor = self.getConnection().cursor()
+			cursor.execute('SELECT TOP 0 ' + self.getSelectList() + ' FROM ' + self.cdcTable)
+			fields = self.replica.dbutil.getColumns(cursor)
+			required = [self.cdcPrimaryKey]
+			if self.isSpatial:
+				required.extend([self.xField, self.yField])
+			if self.changeSource is not None:
+				problems.extend(self.changeSource.check())
+			for name in required:
+				if not name in fields:
+					problems.append(str(self) + ': column ' + name + ' not found')
+			problems.extend(self._checkApplyMode(cursor))
+		except:
+			problems.append(str(self) + ': ' + str(sys.exc_info()[1]))
+		finally:
+			self.replica.close(cursor)
+		return problems
+		
+	def _checkApplyMode(self, cursor):
+		if self.applyMode == 'arcpy':
+			return []
+		if self.applyMode != 'sql':
+			return [str(self) + ': applyMode must be arcpy or sql']
+		if self.isSpatial:
+			return [str(self) + ': applyMode sql can only write tables without xField and yField']
+		problems = []
+		if isNamedVersion(self.replica.sqlEditVersion) and self.replica.stagingRepository is None:
+			problems.append(str(self) + ': applyMode sql needs stagingRepository to edit ' + self.replica.sqlEditVersion)
+		try:
+			cursor.execute('SELECT TOP 0 * FROM ' + self.versionedView)
+			if not self.sdePrimaryKey in self.replica.dbutil.getColumns(cursor):
+				problems.append(str(self) + ': column ' + self.sdePrimaryKey + ' not found in ' + self.versionedView)
+		except:
+			problems.append(str(self) + ': versioned view ' + self.versionedView + ' could not be read: ' + str(sys.exc_info()[1]))
+		return problems
+		
+	########################################################################
+	# Returns the SELECT list of the dataset's columns, see ColumnMap.
+	def getSelectList(self):
+		required = [self.cdcPrimaryKey]
+		if self.isSpatial:
+			required.extend([self.xField, self.yField])
+		return self.columns.getSelectList(required)
+		
+	########################################################################
+	# Returns the SDE fields that are filled from rows with the given fields. Without a column
+	# map, the fields that are not in the rows are logged once per dataset.
+	def getLoadedFields(self, sdeFields, fields):
+		names = []
+		for name in sdeFields:
+			if self.columns.isIgnored(name):
+				continue
+			if fields.has_key(name):
+				names.append(name)
+			elif name != "GlobalID" and not self.columns.isMapped() and not name in self._missingFields:
+				self._missingFields.add(name)
+				logging.warn(name + " not found in Warehouse")
+		return names
+		
+	########################################################################
+	# Generator that executes the CDC query and yields the change records in blocks.
+	# Each block is a tuple of (rows, fields), where fields maps column names to indexes.
+	# sizer: adaptive.BatchSizer that chooses the size of every block instead of blockSize, or None
+	# position: ChangeBatch.position after which the records are read, or None, not used with a changeSource
+	def getChangeBlocks(self, blockSize, sizer = None, position = None):
+		if self.changeSource is not None:
+			for block in self.changeSource.getBlocks(blockSize, sizer):
+				yield block
+			return
+		cursor = self.getChanges(position)
+		if cursor is None:
+			return
+		fields = self.getChangeFields()
+		try:
+			while True:
+				if sizer is not None:
+					blockSize = sizer.size
+				started = time.time()
+				rows = cursor.fetchmany(blockSize)
+				if not rows:
+					break
+				if sizer is not None:
+					sizer.observe(len(rows), time.time() - started)
+				yield (rows, fields)
+		finally:
+			self.replica.close(cursor)
+			self._changeCursor = None
+		
+	########################################################################
+	# Folds the CDC records of a block into one net change per primary key, and converts
+	# the column values to types that arcpy accepts.
+	# rows: CDC records, in CDC order
+	# fields: Dictionary of column name to index for the rows
+	# returns a ChangeBatch
+	def coalesce(self, rows, fields):
+		projected, converters = self.columns.getProjection(fields)
+		batch = ChangeBatch(self, projected)
+		changes = dict()
+		opIndex = fields['__$operation']
+		keyIndex = fields[self.cdcPrimaryKey]
+		seqvalIndex = fields['__$seqval']
+		lsnIndex = fields.get('__$start_lsn')
+		if lsnIndex is not None and len(rows) > 0:
+			last = rows[-1]
+			batch.position = (str(last[lsnIndex]), str(last[seqvalIndex]), last[opIndex])
+		for row in rows:
+			op = _operations.get(row[opIndex])
+			if op is None:
+				#Update before-images share the __$seqval of the after-image and are cleared with it.
+				continue
+			batch.numRecords = batch.numRecords + 1
+			if lsnIndex is not None:
+				lsn = str(row[lsnIndex])
+				batch.lsns[lsn] = batch.lsns.get(lsn, 0) + 1
+			key = row[keyIndex]
+			error = None
+			try:
+				values = self.convertRow(row, converters)
+			except:
+				#The change keeps the values as read and its error, the import quarantines it.
+				values = tuple([row[i] for i, convert in converters])
+				error = 'Could not convert the values of ' + self.cdcPrimaryKey + ' = ' + str(key) + ': ' + str(sys.exc_info()[1])
+				logging.error(error)
+			change = changes.get(key)
+			if change is None:
+				change = Change(op, key, values, str(row[seqvalIndex]))
+				changes[key] = change
+				batch.changes.append(change)
+			else:
+				change.op = _coalesceOperations(change.op, op)
+				change.row = values
+				change.addSeqval(str(row[seqvalIndex]))
+			#Only the values of the last record of a key are written.
+			change.error = error
+		return batch
+		
+	########################################################################
+	# Returns the tuple of projected values of a row, see ColumnMap.getProjection.
+	def convertRow(self, row, converters):
+		values = []
+		for i, convert in converters:
+			value = row[i]
+			if value is not None:
+				value = convert(value)
+			values.append(value)
+		return tuple(values)
+		
 	########################################################################
 	# Determine the database operation type of the row.
 	# returns "insert","update","delete"
@@ -271,22 +1250,24 @@ SELECT *, CONVERT(VARCHAR(MAX), __$seqval, 2) as __$CDCKEY FROM ''' + self.cdcFu
 		return op
 	
 	########################################################################
-	# Deletes records from the CDC table of records that were processed.
-	# processedRecords: An array of CDC IDs
+	# Deletes the CDC records of the given __$seqval hex strings, see Change.cdcKeys.
+	# The records are deleted in chunks by their binary __$seqval, so that the index can be used.
 	def clearChanges(self, processedRecords):
+		if self.changeSource is not None:
+			self.changeSource.clearChanges(processedRecords)
+			return
 		logging.info('Clearing changes from CDC tables for ' + self.cdcTable)
 		func = "Database.clearChanges"
 		try:
-			cursor = self.replica.getConnection().cursor()
-			ids = ""
-			for i in range(0, len(processedRecords)):
-				if i > 0:
-					ids = ids + ","
-				ids = ids + "'" + processedRecords[i] + "'"
-			sql = 'DELETE FROM ' + self.cdcTable + ' where CONVERT(VARCHAR(MAX), __$seqval, 2) in (' + ids + ')'
-			cursor.execute(sql)
-			self.replica.getConnection().commit()
-			logging.debug('Deleted ' + str(cursor.rowcount) + ' rows from ' + self.cdcTable)
+			cursor = self.getConnection().cursor()
+			numDeleted = 0
+			for i in xrange(0, len(processedRecords), _CLEAR_CHUNK_SIZE):
+				ids = ','.join(['0x' + cdcKey for cdcKey in processedRecords[i:i + _CLEAR_CHUNK_SIZE]])
+				sql = 'DELETE FROM ' + self.cdcTable + ' where __$seqval in (' + ids + ')'
+				cursor.execute(sql)
+				numDeleted = numDeleted + cursor.rowcount
+			self.getConnection().commit()
+			logging.debug('Deleted ' + str(numDeleted) + ' rows from ' + self.cdcTable)
 			cursor.close()
 			del cursor
 			cursor = None
@@ -320,12 +1301,14 @@ SELECT *, CONVERT(VARCHAR(MAX), __$seqval, 2) as __$CDCKEY FROM ''' + self.cdcFu
 			arcpy.MakeTableView_management(feature_class, layer_name, where_clause)
 		return layer_name
 		
-	def logBgBaseInfo(self, feature, cdcRow):
+	#fields: Dictionary of column name to index for cdcRow, by default the fields of the CDC query
+	def logBgBaseInfo(self, feature, cdcRow, fields = None):
 		func = 'logBgBaseInfo'
 		logging.debug(' ')
 		logging.debug('Logging BG-BASE info for record:')
 		try:
-			fields = self.getChangeFields()
+			if fields is None:
+				fields = self.getChangeFields()
 			self._logBgBaseInfo('ACC_NUM_AND_QUAL', feature, cdcRow, fields)
 			self._logBgBaseInfo('rep_id', feature, cdcRow, fields)
 			self._logBgBaseInfo('line_seq', feature, cdcRow, fields)
@@ -372,3 +1355,363 @@ SELECT *, CONVERT(VARCHAR(MAX), __$seqval, 2) as __$CDCKEY FROM ''' + self.cdcFu
 				msg = msg + ' CDC: Null'
 		logging.debug('\t' + msg)
 		return
+
+#Kinds of TableChangeSource, see the changeSource option of Dataset.
+_CHANGE_SOURCES = ('rowversion', 'hash')
+
+#Value of an empty column in the snapshot files of a TableChangeSource.
+_NO_VALUE = '-'
+
+###################################################################################################
+###################################################################################################
+#
+# class:	db.TableChangeSource
+# purpose:	Finds the changes of a table that doesn't have CDC, and returns them as the same blocks
+#			of records that Dataset.getChangeBlocks reads from a change table. The source keeps a
+#			snapshot of the table in the replica's tempPath, a line with a hash for every primary
+#			key, in key order. A read merges the keys of the table, selected in the same order, with
+#			the snapshot: new keys are inserts, keys whose hash changed are updates and keys that
+#			are no longer in the table are deletes.
+#
+# notes:	With a rowversion column the hash is the rowversion, the merge only reads the keys and
+#			rowversions and the rows of the changed keys are read with a second query. Without one
+#			the hash is the MD5 of the values of the row, and every row is read.
+#
+#			Every change gets a made up __$seqval. A read writes the hashes it found to a pending
+#			file, and clearChanges moves the hashes of the cleared seqvals to the snapshot. So a
+#			change that was not saved is found again by the next read, like a CDC record that was
+#			not cleared. Positions are not kept, a stopped import reads the table again.
+#
+#			Keys are ordered by their binary value in SQL Server, so that the order of string keys
+#			doesn't depend on the collation, see _orderKey.
+#
+###################################################################################################
+
+class TableChangeSource(object):
+	#dataset:		The db.Dataset of the table
+	#kind:			"rowversion" or "hash"
+	#rowversion:	The rowversion column of the table, used by "rowversion"
+	def __init__(self, dataset, kind, rowversion = None):
+		self.dataset = dataset
+		self.kind = kind
+		self.rowversion = rowversion
+		name = ''.join([c if c.isalnum() else '_' for c in dataset.sourceTable])
+		self.path = os.path.join(dataset.replica.tempPath, 'changes_' + name + '.snapshot')
+		self.numReads = 0
+		self._pendingPath = self.path + '.pending'
+		self._committed = set()
+		self._stats = None
+		return
+		
+	def __str__(self):
+		return self.kind + ' changes of ' + self.dataset.sourceTable
+		
+	########################################################################
+	# Generator that compares the table with the snapshot and yields the changes in blocks of
+	# (rows, fields), the rows have the __$start_lsn, __$seqval and __$operation columns of CDC.
+	# sizer: adaptive.BatchSizer that chooses the size of every block instead of blockSize, or None
+	def getBlocks(self, blockSize, sizer = None):
+		if not self.kind in _CHANGE_SOURCES:
+			raise ValueError(str(self.dataset) + ': unknown changeSource ' + str(self.kind))
+		self.numReads = self.numReads + 1
+		self._committed = set()
+		pending = open(self._pendingPath, 'w')
+		cursors = []
+		try:
+			if self.kind == 'rowversion':
+				fields, records = self._readRowversions(pending, cursors)
+			else:
+				fields, records = self._readHashes(pending, cursors)
+			rows = []
+			started = time.time()
+			for record in records:
+				rows.append(record)
+				if sizer is not None:
+					blockSize = sizer.size
+				if len(rows) >= blockSize:
+					if sizer is not None:
+						sizer.observe(len(rows), time.time() - started)
+					#The pending hashes of the changes must be on disk before they can be cleared.
+					pending.flush()
+					yield (rows, fields)
+					rows = []
+					started = time.time()
+			pending.flush()
+			if len(rows) > 0:
+				yield (rows, fields)
+		finally:
+			for cursor in cursors:
+				self.dataset.replica.close(cursor)
+			pending.close()
+		
+	########################################################################
+	# Returns True if the table has changes that are not in the snapshot. Without a rowversion
+	# the table is assumed to have changes until it was read once by this process.
+	def hasChanges(self):
+		if self.kind != 'rowversion':
+			return self.numReads == 0
+		cursor = None
+		try:
+			cursor = self.dataset.getConnection().cursor()
+			cursor.execute('SELECT COUNT_BIG(*), MAX([' + self.rowversion + ']) FROM ' + self.dataset.sourceTable)
+			row = cursor.fetchone()
+			version = None
+			if row[1] is not None:
+				version = binascii.hexlify(row[1]).upper()
+			return (int(row[0]), version) != self._getStats()
+		except:
+			return True
+		finally:
+			self.dataset.replica.close(cursor)
+		
+	########################################################################
+	# Moves the hashes of the changes with the given seqvals to the snapshot.
+	# processedRecords: __$seqval hex strings, see Change.cdcKeys
+	def clearChanges(self, processedRecords):
+		func = 'TableChangeSource.clearChanges'
+		try:
+			self._committed.update(processedRecords)
+			self._save()
+			logging.debug('Saved ' + str(len(self._committed)) + ' changes to the snapshot ' + self.path)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+		
+	########################################################################
+	# returns a list of problems
+	def check(self):
+		if not self.kind in _CHANGE_SOURCES:
+			return [str(self.dataset) + ': changeSource must be one of ' + ', '.join(_CHANGE_SOURCES)]
+		if self.kind == 'rowversion' and not self.rowversion:
+			return [str(self.dataset) + ': the rowversion column is not set in sqlserverDataset']
+		return []
+		
+	def _readHashes(self, pending, cursors):
+		cursor = self.dataset.getConnection().cursor()
+		cursors.append(cursor)
+		cursor.execute('SELECT ' + self.dataset.getSelectList() + ' FROM ' + self.dataset.sourceTable + ' ORDER BY ' + self._orderBy())
+		fields = self.dataset.replica.dbutil.getColumns(cursor)
+		keyIndex = fields[self.dataset.cdcPrimaryKey]
+		current = ((row[keyIndex], _hashRow(row), row) for row in cursor)
+		return (_changeFields(fields), self._changes(current, pending, len(fields), keyIndex))
+		
+	def _changes(self, current, pending, numColumns, keyIndex):
+		for op, key, seqval, row in self._merge(current, pending):
+			if op == 'delete':
+				row = [None] * numColumns
+				row[keyIndex] = key
+			yield [seqval, seqval, _codes[op]] + list(row)
+		
+	########################################################################
+	# Merges the keys and rowversions of the table with the snapshot, then reads the rows of
+	# the changed keys. The rows that were changed again after the merge are read with the
+	# keys they had, and found again by the next read.
+	def _readRowversions(self, pending, cursors):
+		version = '[' + self.rowversion + ']'
+		cursor = self.dataset.getConnection().cursor()
+		cursors.append(cursor)
+		cursor.execute('SELECT [' + self.dataset.cdcPrimaryKey + '], ' + version + ' FROM ' + self.dataset.sourceTable + ' ORDER BY ' + self._orderBy())
+		changed = dict()
+		deleted = []
+		lowest = None
+		for op, key, seqval, row in self._merge(((row[0], binascii.hexlify(row[1]).upper(), None) for row in cursor), pending):
+			if op == 'delete':
+				deleted.append((key, seqval))
+			else:
+				changed[key] = (op, seqval)
+				if lowest is None or row < lowest:
+					lowest = row
+		self.dataset.replica.close(cursor)
+		cursor = self.dataset.getConnection().cursor()
+		cursors.append(cursor)
+		if lowest is None:
+			cursor.execute('SELECT TOP 0 ' + self.dataset.getSelectList() + ' FROM ' + self.dataset.sourceTable)
+		else:
+			cursor.execute('SELECT ' + self.dataset.getSelectList() + ' FROM ' + self.dataset.sourceTable + ' WHERE ' + version + ' >= ?', bytearray(binascii.unhexlify(lowest)))
+		fields = self.dataset.replica.dbutil.getColumns(cursor)
+		return (_changeFields(fields), self._changedRows(cursor, fields, changed, deleted))
+		
+	def _changedRows(self, cursor, fields, changed, deleted):
+		keyIndex = fields[self.dataset.cdcPrimaryKey]
+		for row in cursor:
+			change = changed.pop(row[keyIndex], None)
+			if change is not None:
+				yield [change[1], change[1], _codes[change[0]]] + list(row)
+		for key, seqval in deleted:
+			row = [None] * len(fields)
+			row[keyIndex] = key
+			yield [seqval, seqval, _codes['delete']] + row
+		
+	########################################################################
+	# Generator that merges (key, hash, row) tuples of the table in key order with the snapshot,
+	# writes the pending hashes and yields (op, key, seqval, row) for every change. The row of
+	# a rowversion change is its hash.
+	def _merge(self, current, pending):
+		previous = _readSnapshot(self.path)
+		old = next(previous, None)
+		last = None
+		numChanges = 0
+		for key, value, row in current:
+			order = _orderKey(key)
+			if last is not None and order <= last:
+				raise ValueError(str(self.dataset) + ': the key ' + repr(key) + ' is not unique or the table is not in key order')
+			last = order
+			while old is not None and _orderKey(old[0]) < order:
+				numChanges = numChanges + 1
+				seqval = _makeSeqval(numChanges)
+				_writePending(pending, old[1], seqval, None, old[2])
+				yield ('delete', old[0], seqval, None)
+				old = next(previous, None)
+			oldValue = None
+			if old is not None and _orderKey(old[0]) == order:
+				oldValue = old[2]
+				old = next(previous, None)
+			if oldValue == value:
+				_writePending(pending, _encodeKey(key), None, value, value)
+				continue
+			numChanges = numChanges + 1
+			seqval = _makeSeqval(numChanges)
+			_writePending(pending, _encodeKey(key), seqval, value, oldValue)
+			if self.kind == 'rowversion':
+				row = value
+			if oldValue is None:
+				yield ('insert', key, seqval, row)
+			else:
+				yield ('update', key, seqval, row)
+		while old is not None:
+			numChanges = numChanges + 1
+			seqval = _makeSeqval(numChanges)
+			_writePending(pending, old[1], seqval, None, old[2])
+			yield ('delete', old[0], seqval, None)
+			old = next(previous, None)
+		
+	########################################################################
+	# Writes the snapshot with the hashes of the pending file whose changes were cleared, and
+	# the old hashes of the others. Keys that the last read didn't reach keep their line.
+	def _save(self):
+		if not os.path.exists(self._pendingPath):
+			return
+		temp = self.path + '.tmp'
+		with open(temp, 'w') as f:
+			previous = _readSnapshot(self.path)
+			old = next(previous, None)
+			for key, encoded, seqval, value, oldValue in _readPending(self._pendingPath):
+				order = _orderKey(key)
+				while old is not None and _orderKey(old[0]) < order:
+					f.write(old[2] + '\t' + old[1] + '\n')
+					old = next(previous, None)
+				if old is not None and _orderKey(old[0]) == order:
+					old = next(previous, None)
+				if seqval is not None and not seqval in self._committed:
+					value = oldValue
+				if value is not None:
+					f.write(value + '\t' + encoded + '\n')
+			while old is not None:
+				f.write(old[2] + '\t' + old[1] + '\n')
+				old = next(previous, None)
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		os.rename(temp, self.path)
+		self._stats = None
+		return
+		
+	########################################################################
+	# returns the number of keys in the snapshot and the highest hash, the rowversion
+	def _getStats(self):
+		if self._stats is None:
+			count = 0
+			highest = None
+			for key, encoded, value in _readSnapshot(self.path):
+				count = count + 1
+				if highest is None or value > highest:
+					highest = value
+			self._stats = (count, highest)
+		return self._stats
+		
+	def _orderBy(self):
+		key = '[' + self.dataset.cdcPrimaryKey + ']'
+		cursor = self.dataset.getConnection().cursor()
+		try:
+			cursor.execute('SELECT TOP 1 ' + key + ' FROM ' + self.dataset.sourceTable)
+			row = cursor.fetchone()
+		finally:
+			self.dataset.replica.close(cursor)
+		if row is not None and isinstance(row[0], basestring):
+			return 'CAST(' + key + ' AS VARBINARY(900))'
+		return key
+
+#__$operation codes of the changes of a TableChangeSource.
+_codes = {'delete':1, 'insert':2, 'update':4}
+
+def _changeFields(fields):
+	changeFields = {'__$start_lsn':0, '__$seqval':1, '__$operation':2}
+	for name in fields:
+		changeFields[name] = fields[name] + 3
+	return changeFields
+
+def _makeSeqval(n):
+	return binascii.unhexlify('%020X' % n)
+
+def _hashRow(row):
+	return hashlib.md5(repr(tuple(row))).hexdigest()[:16].upper()
+
+########################################################################
+# Returns the value by which keys are ordered, the bytes of VARBINARY(900) for strings.
+def _orderKey(key):
+	if isinstance(key, unicode):
+		return key.encode('utf-16-le')
+	return key
+
+def _encodeKey(key):
+	if isinstance(key, unicode):
+		return 'u' + binascii.hexlify(key.encode('utf-8'))
+	if isinstance(key, str):
+		return 's' + binascii.hexlify(key)
+	if isinstance(key, Decimal):
+		return 'd' + str(key)
+	if isinstance(key, float):
+		return 'f' + repr(key)
+	return 'i' + str(key)
+
+def _decodeKey(encoded):
+	kind = encoded[0]
+	value = encoded[1:]
+	if kind == 'u':
+		return binascii.unhexlify(value).decode('utf-8')
+	if kind == 's':
+		return binascii.unhexlify(value)
+	if kind == 'd':
+		return Decimal(value)
+	if kind == 'f':
+		return float(value)
+	return int(value)
+
+########################################################################
+# Generator of the (key, encoded key, hash) of the lines of a snapshot file.
+def _readSnapshot(path):
+	if not os.path.exists(path):
+		return
+	with open(path, 'r') as f:
+		for line in f:
+			value, encoded = line.rstrip('\n').split('\t')
+			yield (_decodeKey(encoded), encoded, value)
+
+########################################################################
+# Generator of the (key, encoded key, seqval, hash, old hash) of the lines of a pending file.
+def _readPending(path):
+	with open(path, 'r') as f:
+		for line in f:
+			parts = [None if part == _NO_VALUE else part for part in line.rstrip('\n').split('\t')]
+			if len(parts) < 4:
+				#The last line of a read that was stopped.
+				break
+			yield (_decodeKey(parts[3]), parts[3], parts[0], parts[1], parts[2])
+
+def _writePending(f, encoded, seqval, value, oldValue):
+	if seqval is not None:
+		seqval = binascii.hexlify(seqval).upper()
+	f.write('\t'.join([seqval or _NO_VALUE, value or _NO_VALUE, oldValue or _NO_VALUE, encoded]) + '\n')
+	return
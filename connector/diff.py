@@ -0,0 +1,492 @@
+import os, sys, traceback, logging
+import json
+import hashlib, struct
+from datetime import datetime
+import db
+import util
+arcpy = util.LazyModule('arcpy')
+
+#Relative tolerance when comparing floating point values and coordinates.
+_TOLERANCE = 1e-9
+
+#Number of sub-ranges a key range whose checksums differ is split into.
+_FANOUT = 10
+
+#SDE field types that are part of the range checksums. Other types are only compared row by row.
+_NUMERIC_TYPES = ('Integer', 'SmallInteger', 'Double', 'Single')
+_CHECKSUM_TYPES = _NUMERIC_TYPES + ('String', 'Date')
+
+#Seconds per change assumed by the plan when no import has been timed yet.
+_DEFAULT_RATES = {'insert':0.3, 'update':0.3, 'delete':0.2, 'commit':1.0}
+
+###################################################################################################
+###################################################################################################
+#
+# class:	diff.ChangeDiff
+# purpose:	Compares coalesced CDC changes with the rows that are currently in SDE. The SDE rows
+#			of a whole batch are read with a single arcpy.da.SearchCursor, and every change is
+#			classified as one of:
+#				insert, insert-existing (the record is already in SDE),
+#				update, noop (an update that doesn't change any value), update-missing (becomes an insert),
+#				delete, delete-missing, skip (inserted and deleted in the same batch)
+#
+###################################################################################################
+
+class ChangeDiff(object):
+	#dataset: The db.Dataset whose changes are compared
+	def __init__(self, dataset):
+		self.dataset = dataset
+		self._fieldNames = None
+		self._xyTolerance = None
+		return
+
+	########################################################################
+	# Returns the SDE fields that are compared, the fields that exist in both SDE and CDC.
+	def getFieldNames(self, fields):
+		if self._fieldNames is None:
+			names = []
+			for field in arcpy.ListFields(self.dataset.getSdeTablePath()):
+				if field.type in ('OID', 'Geometry', 'GlobalID') or field.name == 'GlobalID':
+					continue
+				if self.dataset.columns.isIgnored(field.name):
+					continue
+				if field.name in fields and field.name != self.dataset.sdePrimaryKey:
+					names.append(field.name)
+			self._fieldNames = names
+		return self._fieldNames
+
+	########################################################################
+	# Reads the SDE rows of the keys in the batch.
+	# returns a dictionary of key to a dictionary of field name to value
+	def readSdeRows(self, batch):
+		rows = dict()
+		keys = [change.key for change in batch.changes if change.key is not None]
+		if len(keys) == 0:
+			return rows
+		where = self.dataset.sdePrimaryKey + ' IN (' + ','.join([_quote(key) for key in keys]) + ')'
+		return self.readRows(batch.fields, where)
+		
+	########################################################################
+	# Reads the SDE rows that match a where clause.
+	# returns a dictionary of key to a dictionary of field name to value
+	def readRows(self, fields, where):
+		rows = dict()
+		names = self.getFieldNames(fields)
+		cursorFields = [self.dataset.sdePrimaryKey] + names
+		if self.dataset.isSpatial:
+			cursorFields.append('SHAPE@XY')
+		cursor = arcpy.da.SearchCursor(self.dataset.getSdeTablePath(), cursorFields, where)
+		try:
+			for row in cursor:
+				values = dict()
+				for i in range(1, len(cursorFields)):
+					values[cursorFields[i]] = row[i]
+				rows[_normalizeKey(row[0])] = values
+		finally:
+			del cursor
+		return rows
+
+	########################################################################
+	# Returns the names of the fields whose CDC value differs from the SDE value.
+	# exact: Compare the values as they would be written, for deciding that a write can be
+	#	skipped. Otherwise trailing spaces, microseconds and float rounding are ignored, like
+	#	the checksums of TableReconciler do.
+	def compare(self, change, fields, sdeValues, exact = True):
+		changed = []
+		for name in self.getFieldNames(fields):
+			if not _equal(change.row[fields[name]], sdeValues.get(name), exact):
+				changed.append(name)
+		if self.dataset.isSpatial and self.dataset.xField in fields and self.dataset.yField in fields:
+			x = change.row[fields[self.dataset.xField]]
+			y = change.row[fields[self.dataset.yField]]
+			xy = sdeValues.get('SHAPE@XY')
+			if x is not None and y is not None:
+				if xy is None or xy[0] is None or not self._sameCoordinate(float(x), xy[0], exact) or not self._sameCoordinate(float(y), xy[1], exact):
+					changed.append('SHAPE')
+		return changed
+
+	########################################################################
+	# A written coordinate is snapped to the XY resolution of the feature class, so a difference
+	# below half of it doesn't change the stored shape.
+	def _sameCoordinate(self, a, b, exact):
+		if not exact:
+			return _equal(a, b)
+		if self._xyTolerance is None:
+			self._xyTolerance = 0.0
+			try:
+				self._xyTolerance = arcpy.Describe(self.dataset.getSdeTablePath()).spatialReference.XYResolution / 2.0
+			except:
+				logging.debug('Could not read the XY resolution of ' + self.dataset.sdeTable + ', coordinates are compared exactly')
+		return abs(a - b) <= self._xyTolerance
+
+	########################################################################
+	# Classifies the changes of a batch against SDE.
+	# returns a list of (change, kind, changedFields) tuples
+	def classify(self, batch):
+		sdeRows = self.readSdeRows(batch)
+		result = []
+		for change in batch.changes:
+			sdeValues = sdeRows.get(_normalizeKey(change.key))
+			changed = []
+			if change.op == 'skip':
+				kind = 'skip'
+			elif change.op == 'insert':
+				if sdeValues is None:
+					kind = 'insert'
+				else:
+					kind = 'insert-existing'
+			elif change.op == 'update':
+				if sdeValues is None:
+					kind = 'update-missing'
+				else:
+					changed = self.compare(change, batch.fields, sdeValues)
+					if len(changed) == 0:
+						kind = 'noop'
+					else:
+						kind = 'update'
+			else:
+				if sdeValues is None:
+					kind = 'delete-missing'
+				else:
+					kind = 'delete'
+			result.append((change, kind, changed))
+		return result
+
+###################################################################################################
+###################################################################################################
+#
+# class:	diff.TableReconciler
+# purpose:	Finds the rows in which a Warehouse table and its SDE dataset differ without reading
+#			both tables row by row. The tables are split into key ranges, and a checksum of each
+#			range is computed on both sides, with HASHBYTES in SQL Server and from a streamed
+#			arcpy.da.SearchCursor for SDE. Ranges whose checksums differ are split again, and
+#			ranges of at most reconcileLeafSize rows are compared row by row with ChangeDiff.
+#			The result is a db.ChangeBatch of repairs: inserts of the rows that are missing in SDE,
+#			updates of the rows that differ and deletes of the rows that are no longer in Warehouse.
+#
+# notes:	The checksum of a row is the MD5 of its values, formatted the same way on both sides:
+#			strings without trailing spaces, numbers with 6 decimals and dates to the second.
+#			A range checksum is the row count and the sums of the first two 32 bit words of the
+#			row hashes, so it doesn't depend on the order in which the rows are read. A value
+#			that SQL Server formats differently only makes its range be compared row by row.
+#			Key ranges are always selected with a where clause, so that both sides order keys
+#			with the collation of SQL Server. The dataset or its replica must be connected.
+#
+###################################################################################################
+
+class TableReconciler(object):
+	#dataset: The db.Dataset whose Warehouse table is compared with its SDE dataset
+	def __init__(self, dataset):
+		self.dataset = dataset
+		self.replica = dataset.replica
+		self.numRanges = 0
+		self.numDifferentRanges = 0
+		self.numRowsCompared = 0
+		#Names of the fields that differ, for each key that is updated by the repairs
+		self.changedFields = dict()
+		self._comparer = ChangeDiff(dataset)
+		self._fields = None
+		self._sqlNames = None
+		self._sdeNames = None
+		self._types = None
+		return
+		
+	########################################################################
+	# Compares the tables and returns a db.ChangeBatch of the changes that make SDE equal to
+	# Warehouse. The rows of the changes have the columns of the Warehouse table.
+	def run(self):
+		self._fields = self._getSourceFields()
+		self._getColumns()
+		batch = db.ChangeBatch(self.dataset, self._fields)
+		bounds = self._getBoundaries(None, None, self.replica.reconcileRangeSize)
+		logging.debug('Comparing ' + str(max(1, len(bounds))) + ' key ranges of ' + str(self.dataset))
+		for lo, hi in _ranges(None, None, bounds):
+			self._reconcileRange(lo, hi, batch)
+		batch.numRecords = len(batch.changes)
+		return batch
+		
+	def _reconcileRange(self, lo, hi, batch):
+		sqlDigest = self._getSqlDigest(lo, hi)
+		sdeDigest = self._getSdeDigest(lo, hi)
+		self.numRanges = self.numRanges + 1
+		if sqlDigest == sdeDigest:
+			return
+		self.numDifferentRanges = self.numDifferentRanges + 1
+		leafSize = max(1, self.replica.reconcileLeafSize)
+		if max(sqlDigest[0], sdeDigest[0]) > leafSize and sqlDigest[0] > 1:
+			bounds = self._getBoundaries(lo, hi, max(leafSize, -(-sqlDigest[0] // _FANOUT)))
+			if len(bounds) > 1:
+				for subLo, subHi in _ranges(lo, hi, bounds):
+					self._reconcileRange(subLo, subHi, batch)
+				return
+		self._compareRows(lo, hi, batch)
+		return
+		
+	########################################################################
+	# Compares the rows of a key range one by one and adds the repairs to the batch.
+	def _compareRows(self, lo, hi, batch):
+		keyIndex = self._fields[self.dataset.cdcPrimaryKey]
+		keys = []
+		sqlRows = dict()
+		cursor = self.dataset.getConnection().cursor()
+		try:
+			cursor.execute('SELECT * FROM ' + self._select(lo, hi))
+			converters = self.dataset.columns.getProjection(self._fields)[1]
+			for row in cursor.fetchall():
+				key = _normalizeKey(row[keyIndex])
+				keys.append(key)
+				sqlRows[key] = self.dataset.convertRow(row, converters)
+		finally:
+			self.replica.close(cursor)
+		sdeRows = self._comparer.readRows(self._fields, self._sdeWhere(lo, hi) or None)
+		self.numRowsCompared = self.numRowsCompared + len(keys)
+		
+		for key in keys:
+			row = sqlRows[key]
+			sdeValues = sdeRows.get(key)
+			if sdeValues is None:
+				self._addRepair(batch, 'insert', key, row)
+				continue
+			changed = self._comparer.compare(db.Change('update', key, row, None), self._fields, sdeValues, False)
+			if len(changed) > 0:
+				self._addRepair(batch, 'update', key, row)
+				self.changedFields[key] = changed
+		for key in sdeRows:
+			if not key in sqlRows:
+				row = [None] * len(self._fields)
+				row[keyIndex] = key
+				self._addRepair(batch, 'delete', key, row)
+		return
+		
+	def _addRepair(self, batch, op, key, row):
+		change = db.Change(op, key, row, None)
+		batch.changes.append(change)
+		return
+		
+	########################################################################
+	# Returns the first key of every block of size rows in a key range, in key order.
+	def _getBoundaries(self, lo, hi, size):
+		key = '[' + self.dataset.cdcPrimaryKey + ']'
+		sql = 'SELECT k FROM (SELECT ' + key + ' AS k, ROW_NUMBER() OVER (ORDER BY ' + key + ') AS n FROM ' + self._select(lo, hi) + ') t WHERE (n - 1) % ' + str(max(1, int(size))) + ' = 0 ORDER BY k'
+		cursor = self.dataset.getConnection().cursor()
+		try:
+			cursor.execute(sql)
+			return [row[0] for row in cursor.fetchall()]
+		finally:
+			self.replica.close(cursor)
+		
+	########################################################################
+	# returns a tuple of (row count, sum of first hash words, sum of second hash words)
+	def _getSqlDigest(self, lo, hi):
+		values = [_sqlValue(self._sqlNames[i], self._types[i]) for i in range(0, len(self._sqlNames))]
+		rowHash = "HASHBYTES('MD5', " + " + N'|' + ".join(values) + ")"
+		sql = 'SELECT COUNT(*), SUM(CAST(CAST(SUBSTRING(h, 1, 4) AS INT) AS BIGINT)), SUM(CAST(CAST(SUBSTRING(h, 5, 4) AS INT) AS BIGINT)) FROM (SELECT ' + rowHash + ' AS h FROM ' + self._select(lo, hi) + ') t'
+		cursor = self.dataset.getConnection().cursor()
+		try:
+			cursor.execute(sql)
+			row = cursor.fetchone()
+			return (int(row[0]), int(row[1] or 0), int(row[2] or 0))
+		finally:
+			self.replica.close(cursor)
+		
+	def _getSdeDigest(self, lo, hi):
+		count = 0
+		first = 0
+		second = 0
+		cursor = arcpy.da.SearchCursor(self.dataset.getSdeTablePath(), self._sdeNames, self._sdeWhere(lo, hi) or None)
+		try:
+			for row in cursor:
+				text = u'|'.join([_formatValue(row[i], self._types[i]) for i in range(0, len(self._types))])
+				words = struct.unpack('>ii', hashlib.md5(text.encode('utf-16-le')).digest()[:8])
+				count = count + 1
+				first = first + words[0]
+				second = second + words[1]
+		finally:
+			del cursor
+		return (count, first, second)
+		
+	def _getSourceFields(self):
+		cursor = self.dataset.getConnection().cursor()
+		try:
+			cursor.execute('SELECT TOP 0 * FROM ' + self._select(None, None))
+			return self.replica.dbutil.getColumns(cursor)
+		finally:
+			self.replica.close(cursor)
+		
+	########################################################################
+	# Sets the columns that are part of the checksums, the key first. Warehouse and SDE
+	# columns are paired by name, except for the key.
+	def _getColumns(self):
+		types = dict()
+		for field in arcpy.ListFields(self.dataset.getSdeTablePath()):
+			types[field.name] = field.type
+		self._sqlNames = [self.dataset.cdcPrimaryKey]
+		self._sdeNames = [self.dataset.sdePrimaryKey]
+		self._types = [types.get(self.dataset.sdePrimaryKey)]
+		for name in self._comparer.getFieldNames(self._fields):
+			if types.get(name) in _CHECKSUM_TYPES:
+				self._sqlNames.append(name)
+				self._sdeNames.append(name)
+				self._types.append(types[name])
+		return
+		
+	########################################################################
+	# Returns the FROM clause of the Warehouse rows in a key range. With a column map the rows
+	# are selected in a derived table, so that their columns have the SDE names.
+	def _select(self, lo, hi):
+		if self.dataset.columns.isMapped():
+			return '(SELECT ' + self.dataset.getSelectList() + ' FROM ' + self.dataset.sourceTable + self._sqlWhere(lo, hi) + ') s'
+		return self.dataset.sourceTable + self._sqlWhere(lo, hi)
+		
+	def _sqlWhere(self, lo, hi):
+		where = _rangeWhere('[' + self.dataset.cdcPrimaryKey + ']', lo, hi)
+		if where:
+			return ' WHERE ' + where
+		return ''
+		
+	def _sdeWhere(self, lo, hi):
+		return _rangeWhere(self.dataset.sdePrimaryKey, lo, hi)
+
+###################################################################################################
+###################################################################################################
+#
+# class:	diff.ApplyRates
+# purpose:	Average number of seconds an import took per insert, update and delete, and per
+#			edit session commit, for each dataset of a replica. The rates are measured by
+#			SqlServerImporter and used to estimate how long a planned import will take.
+#
+###################################################################################################
+
+class ApplyRates(object):
+	#replica: The db.Replica, the rates are kept in a JSON file in its tempPath
+	def __init__(self, replica):
+		name = ''.join([c if c.isalnum() else '_' for c in replica.name])
+		self.path = os.path.join(replica.tempPath, 'rates_' + name + '.json')
+		self._rates = dict()
+		if os.path.exists(self.path):
+			try:
+				with open(self.path, 'r') as f:
+					self._rates = json.load(f)
+			except:
+				logging.warn('Could not read ' + self.path)
+		return
+
+	def get(self, dataset, op):
+		rates = self._rates.get(str(dataset), dict())
+		if op in rates:
+			return rates[op]
+		return _DEFAULT_RATES[op]
+
+	########################################################################
+	# Adds a measurement, averaged with the previous rate so that one unusual run doesn't
+	# replace the history.
+	def update(self, dataset, op, count, seconds):
+		if count < 1:
+			return
+		rates = self._rates.setdefault(str(dataset), dict())
+		rate = seconds / count
+		if op in rates:
+			rate = (rates[op] + rate) / 2.0
+		rates[op] = rate
+		return
+
+	def estimate(self, dataset, counts, editBatchSize):
+		seconds = 0.0
+		num_changes = 0
+		for op in ('insert', 'update', 'delete'):
+			seconds = seconds + counts.get(op, 0) * self.get(dataset, op)
+			num_changes = num_changes + counts.get(op, 0)
+		if num_changes > 0:
+			seconds = seconds + (num_changes // max(1, editBatchSize) + 1) * self.get(dataset, 'commit')
+		return seconds
+
+	def save(self):
+		func = 'ApplyRates.save'
+		try:
+			with open(self.path, 'w') as f:
+				json.dump(self._rates, f, indent = 1)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+
+########################################################################
+# Splits the key range [lo, hi) at the boundaries returned by TableReconciler._getBoundaries.
+def _ranges(lo, hi, bounds):
+	return zip([lo] + bounds[1:], bounds[1:] + [hi])
+
+def _rangeWhere(key, lo, hi):
+	clauses = []
+	if lo is not None:
+		clauses.append(key + ' >= ' + _literal(lo))
+	if hi is not None:
+		clauses.append(key + ' < ' + _literal(hi))
+	return ' AND '.join(clauses)
+
+def _literal(value):
+	if isinstance(value, float):
+		return repr(value)
+	if isinstance(value, (int, long)):
+		#repr() of a long ends with L.
+		return str(value)
+	return _quote(value)
+
+########################################################################
+# SQL Server expression that formats a column for the row checksum, see _formatValue.
+def _sqlValue(name, fieldType):
+	column = '[' + name + ']'
+	if fieldType in _NUMERIC_TYPES:
+		value = 'CONVERT(NVARCHAR(50), CAST(' + column + ' AS DECIMAL(38, 6)))'
+	elif fieldType == 'Date':
+		value = 'CONVERT(NVARCHAR(19), ' + column + ', 120)'
+	else:
+		value = 'RTRIM(CONVERT(NVARCHAR(4000), ' + column + '))'
+	return "ISNULL(N'=' + " + value + ", N'~')"
+
+def _formatValue(value, fieldType):
+	if value is None:
+		return u'~'
+	if fieldType in _NUMERIC_TYPES:
+		#Adding 0.0 turns -0.0 into 0.0, SQL Server has no negative zero.
+		return u'=' + (u'%.6f' % (float(value) + 0.0))
+	if fieldType == 'Date':
+		return u'=' + (u'%04d-%02d-%02d %02d:%02d:%02d' % (value.year, value.month, value.day, value.hour, value.minute, value.second))
+	if isinstance(value, str):
+		value = value.decode('cp1252', 'replace')
+	return u'=' + unicode(value).rstrip(u' ')
+
+def _quote(key):
+	return "'" + unicode(key).replace("'", "''") + "'"
+
+def _normalizeKey(key):
+	if isinstance(key, float) and key == int(key):
+		return int(key)
+	if isinstance(key, (int, long)):
+		return int(key)
+	if isinstance(key, str):
+		return key.decode('cp1252', 'replace')
+	return key
+
+########################################################################
+# Compares a CDC value with an SDE value.
+# exact: Only ignore the encoding of strings, see ChangeDiff.compare
+def _equal(a, b, exact = False):
+	if a is None or b is None:
+		return a is None and b is None
+	if isinstance(a, (int, long, float)) and isinstance(b, (int, long, float)):
+		if a == b or exact:
+			return a == b
+		return abs(a - b) <= _TOLERANCE * max(abs(a), abs(b))
+	if isinstance(a, basestring) and isinstance(b, basestring):
+		if isinstance(a, str):
+			a = a.decode('cp1252', 'replace')
+		if isinstance(b, str):
+			b = b.decode('cp1252', 'replace')
+		if exact:
+			return a == b
+		return a.rstrip() == b.rstrip()
+	if isinstance(a, datetime) and isinstance(b, datetime) and not exact:
+		return a.replace(microsecond = 0) == b.replace(microsecond = 0)
+	return a == b
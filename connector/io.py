@@ -1,8 +1,32 @@
-import os, sys, arcpy
+import os, sys, binascii
 import traceback, logging, uuid
-import arcpy
+import threading, Queue
 import util
+import adaptive
+import db
+import diff
+import lag
+import pipeline
+import processes
+import profiling
+import quarantine
+import report
+import checkpoint
+import schedule
+import sink
+import spill
+import versions
+import time
 from time import strftime
+from collections import OrderedDict
+arcpy = util.LazyModule('arcpy')
+
+#Operation codes of the changes in the temp table of SqlEditor, the CDC __$operation codes.
+_SQL_OPERATIONS = {"delete":1, "insert":2, "update":4}
+
+#SQL Server accepts 1000 rows per VALUES list and 2100 parameters per statement.
+_MAX_INSERT_ROWS = 1000
+_MAX_PARAMETERS = 2000
 
 ###################################################################################################
 ###################################################################################################
@@ -21,12 +45,40 @@ from time import strftime
 
 class SqlServerImporter(object):
 
-	#replicas:	A db.Replicas object.
-	def __init__(self, replicas, clearCdc):
+	#replicas:		A db.Replicas object.
+	#clearCdc:		Delete the CDC records of the changes that were imported.
+	#maxParallel:	Maximum number of replicas that are imported at the same time.
+	#reportPath:	Optional folder to which a JSON run report is written.
+	#fromSpill:		Read the CDC records from the last spill of each dataset instead of SQL Server.
+	#maxRuntime:	Seconds after which the run stops importing, see the maxRuntime of the replicas.
+	def __init__(self, replicas, clearCdc, maxParallel = 1, reportPath = None, fromSpill = False, maxRuntime = None):
 		self._replicas = replicas
 		self._clearCdc = clearCdc
+		self._maxParallel = maxParallel
+		self._reportPath = reportPath
+		self._fromSpill = fromSpill
+		self._maxRuntime = maxRuntime
+		self._deadline = None
 		self._dbutil = util.DBUtil()
+		self._local = threading.local()
+		self._lastError = None
+		self.report = report.RunReport('import')
+		
+	#The error of the last change that could not be written. Every thread has its own, the
+	#outlets of a FanOutEditor write on threads of their own.
+	def _getLastError(self):
+		return getattr(self._local, 'lastError', None)
+		
+	def _setLastError(self, error):
+		self._local.lastError = error
 		
+	_lastError = property(_getLastError, _setLastError)
+		
+	########################################################################
+	# Imports all replicas. Replicas that don't share a production workspace or lock file
+	# are imported at the same time, up to maxParallel, each group in a worker process because
+	# arcpy can't edit and synchronize on several threads of one process. Returns the
+	# report.RunReport of the run.
 	def run(self):
 		func = 'SqlServerImporter.run'
 		logging.info(" ")
@@ -34,41 +86,145 @@ class SqlServerImporter(object):
 		logging.info("******************************************************************************")
 		logging.info("Begin " + func)
 		
-		for replica in self._replicas.replicas:
-			self.processReplica(replica)
+		self.report = report.RunReport('import')
+		if self._maxRuntime is not None:
+			self._deadline = time.time() + self._maxRuntime
+		groups = self._replicas.getGroups()
+		tasks = []
+		for group in groups:
+			name = ', '.join([r.name for r in group])
+			if self._maxParallel > 1 and len(groups) > 1:
+				args = ([r.config for r in group], self._clearCdc, self._fromSpill, self._deadline)
+				tasks.append((name, lambda name = name, args = args: self._loadReports(processes.run('import ' + name, _importGroup, args))))
+			else:
+				tasks.append((name, lambda group = group: self._processGroup(group)))
+		pipeline.TaskPool('replicas', self._maxParallel).run(tasks)
+		self.report.finish()
+		self.report.log()
+		if self._reportPath is not None:
+			self.report.write(self._reportPath)
 			
 		logging.info("End " + func)
 		logging.info("******************************************************************************")
+		return self.report
+		
+	def _processGroup(self, replicas):
+		for replica in replicas:
+			self.processReplica(replica)
+		return
+		
+	#values: List of ReplicaReport.toDict() of the replicas that a worker processed
+	def _loadReports(self, values):
+		for replicaValues in values:
+			self.report.replica(replicaValues['name']).load(replicaValues)
 		return
 			
 	def processReplica(self, replica):
 		func = 'SqlServerImporter.processReplica'
 		logging.info("Begin " + func)
 		logging.info("Processing replica " + replica.name)
+		replicaReport = self.report.replica(replica.name)
+		replicaReport.start()
+		replica.queryStats.reset()
+		replicaReport.queries = replica.queryStats
 			
 		lockfile = util.LockFile(replica.lockFilePath)
-		if lockfile.locked():
+		if not lockfile.lock():
 			logging.error(replica.name + " is already running")
 			logging.info('If %s is not running, then delete the file %s', replica.name, replica.lockFilePath)
 			logging.info("End " + func)
+			replicaReport.finish('locked')
+			return
+		
+		deadline = self._deadline
+		if replica.maxRuntime is not None:
+			deadline = min(deadline or sys.maxint, time.time() + replica.maxRuntime)
+		if deadline is not None and time.time() >= deadline:
+			lockfile.unlock()
+			logging.warn('The run is out of time, ' + replica.name + ' will be imported in the next run')
+			replicaReport.finish('out of time')
+			logging.info("End " + func)
 			return
-		lockfile.lock()
 		
 		num_changes = 0
+		started = time.time()
 		replica.connect()
-		for dataset in replica.datasets:
-			logging.debug('Processing dataset in ' + dataset.sdeTable)
-			changes = self._importChanges(dataset)
-			if changes > 0:
-				num_changes = num_changes + changes
+		if replica.isConnected() and not self._fromSpill and not True in [dataset.hasChanges() for dataset in replica.datasets]:
+			#Nothing to import, return before anything needs arcpy.
+			replica.closeConnection()
+			lockfile.unlock()
+			logging.info('There are no changes from SQL Server. SDE sync will not run')
+			replicaReport.finish('no changes')
+			logging.info("End " + func)
+			return
+		stopped = checkpoint.Checkpoint(replica)
+		sinks = openSinks(self, replica)
+		watermarks = None
+		if len(sinks) > 1:
+			watermarks = checkpoint.Watermarks(replica)
+		tracker = lag.LagTracker(replica)
+		if replica.hasDependencies():
+			#Parents are inserted before their children and deleted after them.
+			scheduler = schedule.DependencyScheduler(replica.name, replica.maxParallelDatasets, deadline)
+			interleaved = replica.maxParallelDatasets > 1 and len(replica.datasets) > 1
+			#With a cycle there is no order, the scheduler skips the datasets of the cycle.
+			datasets = replica.getDependencyOrder() or replica.datasets
+			if interleaved:
+				#arcpy can't edit on several threads of one process, every dataset is imported in a worker.
+				jobs = dict([(dataset, DatasetWorker(self, dataset, stopped, watermarks, tracker)) for dataset in datasets])
+			else:
+				jobs = dict([(dataset, DatasetImport(self, dataset, interleaved, stopped, True, sinks, watermarks, tracker)) for dataset in datasets])
+			for dataset in datasets:
+				scheduler.add(jobs[dataset], [jobs[parent] for parent in dataset.parents])
+		else:
+			scheduler = schedule.DatasetScheduler(replica.name, replica.cycleSeconds, deadline)
+			#Interleaved datasets read their CDC records at the same time, each needs its own connection.
+			interleaved = replica.cycleSeconds is not None and len(replica.datasets) > 1
+			for dataset in replica.datasets:
+				scheduler.add(DatasetImport(self, dataset, interleaved, stopped, sinks = sinks, watermarks = watermarks, tracker = tracker))
+		with profiling.stage('import'):
+			scheduler.run()
+			for job in scheduler.jobs:
+				changes = job.close()
+				if changes > 0:
+					num_changes = num_changes + changes
+		for target in sinks:
+			target.close()
+		stopped.save()
+		if watermarks is not None:
+			watermarks.save()
+		if isinstance(scheduler, schedule.DependencyScheduler):
+			if len(scheduler.skipped) > 0:
+				replicaReport.add('skipped', len(scheduler.skipped))
+		elif interleaved:
+			replicaReport.add('cycles', scheduler.numCycles)
+		if len(scheduler.interrupted) > 0:
+			replicaReport.add('stopped', len(scheduler.interrupted))
 		replica.closeConnection()
+		replicaReport.addTime('import', time.time() - started)
 			
 		if num_changes < 1:
 			lockfile.unlock()
-			if num_changes == 0:
+			if len(scheduler.interrupted) > 0:
+				logging.info('No changes were imported before the replica ran out of time. SDE sync will not run')
+				replicaReport.finish('out of time')
+			elif num_changes == 0:
 				logging.info('There are no changes from SQL Server. SDE sync will not run')
+				replicaReport.finish('no changes')
 			else:
 				logging.info('Failed to refresh staging from SQL Server, SDE sync will not run')
+				replicaReport.finish('failed')
+			logging.info("End " + func)
+			return
+		
+		if not True in [isinstance(target, SdeSink) for target in sinks]:
+			tracker.finish(replicaReport)
+			lockfile.unlock()
+			logging.info('The changes were written to ' + ', '.join([str(target) for target in sinks]) + '. SDE sync will not run')
+			if len(scheduler.interrupted) > 0:
+				replicaReport.finish('partial')
+			else:
+				replicaReport.finish('imported')
 			logging.info("End " + func)
 			return
 		
@@ -80,25 +236,256 @@ class SqlServerImporter(object):
 			logging.info("******************************************************************************")
 			return"""
 			
+		started = time.time()
 		if self._syncWithProd(replica) == False:
+			tracker.finish(replicaReport)
 			lockfile.unlock()
 			logging.info('Failed to sync data between staging to production. SDE sync will not run')
 			logging.info("End " + func)
 			logging.info("******************************************************************************")
+			replicaReport.finish('failed')
 			return
 			
 		logging.debug('Performing second flush...');
 		if self._syncWithProd(replica) == False:
+			tracker.finish(replicaReport)
 			lockfile.unlock()
 			logging.info('Failed to sync data between staging to production. SDE sync will not run')
 			logging.info("End " + func)
 			logging.info("******************************************************************************")
+			replicaReport.finish('failed')
 			return
+		replicaReport.addTime('sync', time.time() - started)
+		tracker.synced()
+		tracker.finish(replicaReport)
 			
 		lockfile.unlock()
+		if len(scheduler.interrupted) > 0:
+			replicaReport.finish('partial')
+		else:
+			replicaReport.finish('synced')
+		logging.info("End " + func)
+		return
+		
+	########################################################################
+	# Dry run: reads the CDC changes and compares them with SDE without writing anything or
+	# clearing CDC. Reports the inserts, updates, updates that change nothing and deletes per
+	# dataset, with the estimated time to apply them. Returns the report.RunReport of the plan.
+	def plan(self):
+		func = 'SqlServerImporter.plan'
+		logging.info(" ")
+		logging.info(" ")
+		logging.info("******************************************************************************")
+		logging.info("Begin " + func)
+		
+		self.report = report.RunReport('plan')
+		for replica in self._replicas.replicas:
+			self.planReplica(replica)
+		self.report.finish()
+		self.report.log()
+		if self._reportPath is not None:
+			self.report.write(self._reportPath)
+			
+		logging.info("End " + func)
+		logging.info("******************************************************************************")
+		return self.report
+		
+	def planReplica(self, replica):
+		func = 'SqlServerImporter.planReplica'
+		logging.info("Begin " + func)
+		logging.info("Planning replica " + replica.name)
+		replicaReport = self.report.replica(replica.name)
+		replicaReport.start()
+		replica.queryStats.reset()
+		replicaReport.queries = replica.queryStats
+		
+		rates = diff.ApplyRates(replica)
+		seconds = 0.0
+		replica.connect()
+		for dataset in replica.datasets:
+			seconds = seconds + self._planChanges(dataset, rates)
+		replica.closeConnection()
+		
+		logging.info('Estimated import time for ' + replica.name + ': ' + ('%.0f' % seconds) + 's')
+		replicaReport.counters['estimatedSeconds'] = round(seconds, 1)
+		replicaReport.finish('planned')
 		logging.info("End " + func)
 		return
 		
+	def _planChanges(self, dataset, rates):
+		func = 'SqlServerImporter._planChanges'
+		logging.info('Begin ' + func)
+		replica = dataset.replica
+		changes = None
+		seconds = 0.0
+		try:
+			counts = dict()
+			fieldCounts = dict()
+			num_records = 0
+			comparer = diff.ChangeDiff(dataset)
+			changes = self._openChanges(dataset)
+			for batch in changes:
+				num_records = num_records + batch.numRecords
+				for change, kind, changed in comparer.classify(batch):
+					counts[kind] = counts.get(kind, 0) + 1
+					for name in changed:
+						fieldCounts[name] = fieldCounts.get(name, 0) + 1
+			
+			ops = dict()
+			ops['insert'] = counts.get('insert', 0) + counts.get('insert-existing', 0) + counts.get('update-missing', 0)
+			ops['update'] = counts.get('update', 0)
+			if not replica.skipNoopUpdates:
+				ops['update'] = ops['update'] + counts.get('noop', 0)
+			ops['delete'] = counts.get('delete', 0) + counts.get('delete-missing', 0)
+			seconds = rates.estimate(dataset, ops, replica.editBatchSize)
+			
+			values = self.report.replica(replica.name).dataset(str(dataset))
+			values['records'] = num_records
+			for kind in ['insert', 'insert-existing', 'update', 'noop', 'update-missing', 'delete', 'delete-missing', 'skip']:
+				values[kind] = counts.get(kind, 0)
+			values['changedFields'] = fieldCounts
+			values['estimatedSeconds'] = round(seconds, 1)
+			
+			logging.info(str(dataset) + ': ' + str(num_records) + ' CDC records, ' + ', '.join([kind + ' ' + str(counts[kind]) for kind in sorted(counts)]))
+			logging.info(str(dataset) + ': estimated ' + ('%.0f' % seconds) + 's to apply')
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		finally:
+			if changes is not None:
+				changes.close()
+		logging.info('End ' + func)
+		return seconds
+
+	########################################################################
+	# Compares every Warehouse table with its SDE dataset using key range checksums and reports
+	# the rows that differ. With repair the differences are written to SDE and production is
+	# synchronized. Returns the report.RunReport of the reconciliation.
+	def reconcile(self, repair = False):
+		func = 'SqlServerImporter.reconcile'
+		logging.info(" ")
+		logging.info(" ")
+		logging.info("******************************************************************************")
+		logging.info("Begin " + func)
+		
+		self.report = report.RunReport('reconcile')
+		for replica in self._replicas.replicas:
+			self.reconcileReplica(replica, repair)
+		self.report.finish()
+		self.report.log()
+		if self._reportPath is not None:
+			self.report.write(self._reportPath)
+		
+		logging.info("End " + func)
+		logging.info("******************************************************************************")
+		return self.report
+	
+	def reconcileReplica(self, replica, repair):
+		func = 'SqlServerImporter.reconcileReplica'
+		logging.info("Begin " + func)
+		logging.info("Reconciling replica " + replica.name)
+		replicaReport = self.report.replica(replica.name)
+		replicaReport.start()
+		replica.queryStats.reset()
+		replicaReport.queries = replica.queryStats
+		
+		lockfile = None
+		if repair:
+			lockfile = util.LockFile(replica.lockFilePath)
+			if not lockfile.lock():
+				logging.error(replica.name + " is already running")
+				replicaReport.finish('locked')
+				logging.info("End " + func)
+				return
+		
+		status = 'failed'
+		try:
+			if replica.connect():
+				num_repaired = 0
+				num_failed = 0
+				for dataset in replica.datasets:
+					repaired = self._reconcileDataset(dataset, replicaReport, repair)
+					if repaired < 0:
+						num_failed = num_failed + 1
+					else:
+						num_repaired = num_repaired + repaired
+				replica.closeConnection()
+				if num_repaired > 0:
+					started = time.time()
+					self._syncWithProd(replica)
+					replicaReport.addTime('sync', time.time() - started)
+				if num_failed > 0:
+					status = 'failed'
+				elif repair:
+					status = 'repaired'
+				else:
+					status = 'reconciled'
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		finally:
+			replica.closeConnection()
+			if lockfile is not None:
+				lockfile.unlock()
+		replicaReport.finish(status)
+		logging.info("End " + func)
+		return
+	
+	########################################################################
+	# returns the number of repairs that were saved to SDE, or -1 if the dataset could not be compared
+	def _reconcileDataset(self, dataset, replicaReport, repair):
+		func = 'SqlServerImporter._reconcileDataset'
+		logging.info('Begin ' + func)
+		num_repaired = 0
+		try:
+			started = time.time()
+			reconciler = diff.TableReconciler(dataset)
+			repairs = reconciler.run()
+			replicaReport.addTime('reconcile', time.time() - started)
+			
+			counts = dict()
+			section = replicaReport.section('repairs')
+			for change in repairs.changes:
+				counts[change.op] = counts.get(change.op, 0) + 1
+				entry = {'dataset':str(dataset), 'op':change.op, 'key':change.key}
+				if change.key in reconciler.changedFields:
+					entry['fields'] = reconciler.changedFields[change.key]
+				section.append(entry)
+			
+			values = replicaReport.dataset(str(dataset))
+			values['ranges'] = reconciler.numRanges
+			values['differentRanges'] = reconciler.numDifferentRanges
+			values['rowsCompared'] = reconciler.numRowsCompared
+			values['missing'] = counts.get('insert', 0)
+			values['different'] = counts.get('update', 0)
+			values['extra'] = counts.get('delete', 0)
+			logging.info(str(dataset) + ': ' + str(reconciler.numDifferentRanges) + ' of ' + str(reconciler.numRanges) + ' key ranges differ, ' + str(values['missing']) + ' rows missing in SDE, ' + str(values['different']) + ' different, ' + str(values['extra']) + ' not in Warehouse')
+			
+			if repair and len(repairs) > 0:
+				started = time.time()
+				editor = SdeEditor(dataset.replica.stagingWorkspace, lambda change, fields: self._applyChange(dataset, change, fields), dataset.replica.editBatchSize, dataset.replica.editBatchSeconds)
+				for change in repairs.changes:
+					editor.add(change, repairs.fields)
+				editor.close()
+				num_repaired = len(editor.committed)
+				values['repaired'] = num_repaired
+				values['failed'] = len(editor.failed)
+				replicaReport.add('repairs', num_repaired)
+				replicaReport.addTime('repair', time.time() - started)
+				logging.info('Repaired ' + str(num_repaired) + ' out of ' + str(len(repairs)) + ' rows')
+		except:
+			num_repaired = -1
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		logging.info('End ' + func)
+		return num_repaired
+	
 	def test(self):
 		func = 'SqlServerImporter.test'
 		logging.info(" ")
@@ -136,75 +523,182 @@ class SqlServerImporter(object):
 		logging.info("End " + func)
 		return
 		
-	def _importChanges(self, dataset):
-		func = 'SqlServerImporter._importChanges'
+	########################################################################
+	# Starts reading the CDC records of a dataset. The next block is read from SQL Server and
+	# coalesced on worker threads while the current one is written to SDE. With fromSpill the
+	# blocks are read from the last spill of the dataset instead of SQL Server, if it is still
+	# up to date, see _checkSpill.
+	# sizer: adaptive.BatchSizer that chooses the number of CDC records fetched per block, or None
+	# position: ChangeBatch.position after which the CDC records are read, or None
+	# returns a started pipeline.Pipeline of db.ChangeBatch objects
+	def _openChanges(self, dataset, sizer = None, position = None):
+		replica = dataset.replica
+		changes = pipeline.Pipeline(str(dataset), replica.pipelineDepth)
+		if self._fromSpill:
+			path = spill.getLatestSpill(dataset)
+			if path is None:
+				logging.warn('There is no complete spill of ' + str(dataset) + ' in ' + replica.spillPath)
+				changes.addSource('read', lambda: [])
+			else:
+				reason = self._checkSpill(dataset, path)
+				if reason is not None:
+					raise IOError('The spill ' + path + ' of ' + str(dataset) + ' is out of date, ' + reason)
+				logging.info('Reading CDC records of ' + str(dataset) + ' from ' + path)
+				changes.addSource('read', spill.SpillReader(path).getBlocks)
+		elif replica.spillChanges:
+			writer = spill.SpillWriter(dataset)
+			changes.addSource('fetch', lambda: writer.spill(dataset.getChangeBlocks(replica.fetchBlockSize, sizer, position)))
+		else:
+			changes.addSource('fetch', lambda: dataset.getChangeBlocks(replica.fetchBlockSize, sizer, position))
+		changes.addStage('transform', lambda block: dataset.coalesce(block[0], block[1]))
+		changes.start()
+		return changes
+		
+	########################################################################
+	# Checks that a spill can still be replayed: all of its records are still in CDC, so they
+	# were not imported since, and no key of it has a later record in CDC, whose change the
+	# replay would undo.
+	# returns the reason why the spill can't be replayed, or None
+	def _checkSpill(self, dataset, path):
+		if dataset.changeSource is not None:
+			return 'the changes of the dataset are not read from CDC'
+		cdcKeys = []
+		keys = set()
+		position = None
+		for rows, fields in spill.SpillReader(path).getBlocks():
+			if len(rows) == 0:
+				continue
+			seqvalIndex = fields['__$seqval']
+			keyIndex = fields[dataset.cdcPrimaryKey]
+			for row in rows:
+				cdcKeys.append(binascii.hexlify(row[seqvalIndex]).upper())
+				keys.add(row[keyIndex])
+			last = rows[-1]
+			position = (str(last[fields['__$start_lsn']]), str(last[seqvalIndex]), last[fields['__$operation']])
+		if position is None:
+			return None
+		numRecords = dataset.countRecords(cdcKeys)
+		if numRecords < len(cdcKeys):
+			return str(len(cdcKeys) - numRecords) + ' of its ' + str(len(cdcKeys)) + ' records are no longer in CDC'
+		numLater = dataset.countLaterChanges(position, list(keys))
+		if numLater > 0:
+			return 'CDC has ' + str(numLater) + ' later records of its keys'
+		return None
+		
+	########################################################################
+	# Records the changes that failed in the quarantine store, and quarantines the ones
+	# that failed in replica.quarantineAttempts runs.
+	# returns the CDC keys of the quarantined changes, which can be cleared from the CDC table
+	def _quarantineFailures(self, dataset, committed, failed):
+		func = 'SqlServerImporter._quarantineFailures'
+		replica = dataset.replica
+		cleared = []
+		store = None
+		try:
+			store = quarantine.QuarantineStore(replica.quarantinePath)
+			store.resolve(dataset.cdcTable, committed)
+			for change, fields in failed:
+				try:
+					attempts = store.recordFailure(dataset.cdcTable, change, fields)
+					if attempts >= replica.quarantineAttempts:
+						logging.warn('Quarantining ' + change.op + ' of ' + dataset.sdePrimaryKey + ' = ' + str(change.key) + ' after ' + str(attempts) + ' failed runs')
+						store.quarantine(dataset.cdcTable, change)
+						cleared.extend(change.cdcKeys)
+				except:
+					#The change stays in CDC and is retried, the other failures are still recorded.
+					tb = sys.exc_info()[2]
+					tbinfo = traceback.format_tb(tb)[0]
+					msg = "Error in " + func + " for key " + str(change.key) + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+					logging.error(msg)
+			if len(failed) > 0:
+				logging.info(str(len(failed)) + ' failed changes recorded in ' + replica.quarantinePath)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		finally:
+			if store is not None:
+				store.close()
+		return cleared
+		
+	########################################################################
+	# Writes quarantined changes to the sinks of the replica again, usually after they were fixed
+	# with quarantine.py, and synchronizes production if any of them were saved in SDE. The
+	# changes are written with the editors of a DatasetImport, a FanOutEditor when there are
+	# several sinks. Their CDC records were cleared for every sink when they were quarantined,
+	# so the watermarks of the sinks are not changed.
+	# ids: Optional list of quarantine entry ids. All quarantined changes are replayed if None.
+	# returns the number of changes that were saved, or -1 if the replica is locked
+	def replayQuarantine(self, replica, ids = None):
+		func = 'SqlServerImporter.replayQuarantine'
 		logging.info('Begin ' + func)
-		bImport = False
-		processedRecords = []
-		num_total = 0
+		lockfile = util.LockFile(replica.lockFilePath)
+		if not lockfile.lock():
+			logging.error(replica.name + " is already running")
+			logging.info("End " + func)
+			return -1
+		
+		num_replayed = 0
+		store = None
+		sinks = []
 		try:
-			num_updates = 0
-			num_updates_total = 0
-			num_inserts = 0
-			num_inserts_total = 0
-			num_deletes = 0
-			num_deletes_total = 0
-			num_records = 0
-			
-			cursor = dataset.getChanges()
-			fields = dataset.getChangeFields()
-			if cursor is not None:
-				logging.info("Begin iterating through change records")
-				for row in cursor:
-					operation = dataset.getOperationType(row)
-					bProcessed = False
-					if operation == "insert":
-						num_inserts_total = num_inserts_total + 1
-						if self._processInserts(dataset, row, fields) == True:
-							num_inserts = num_inserts + 1
-							bProcessed = True
-					elif operation == "update":
-						num_updates_total = num_updates_total + 1
-						if self._processUpdates(dataset, row, fields) == True:
-							num_updates = num_updates + 1
-							bProcessed = True
-					elif operation == "delete":
-						num_deletes_total = num_deletes_total + 1
-						if self._processDeletes(dataset, row, fields) == True:
-							num_deletes = num_deletes + 1
-							bProcessed = True
-					else:
-						continue
-						
-					if bProcessed:
-						processedRecords.append(row[fields['__$CDCKEY']])
-					
-					num_records = num_records + 1
-				cursor.close()
-				del cursor
-				cursor = None
-				
-				num_total = num_inserts + num_updates + num_deletes
-				logging.info("Processed " + str(num_total) + " out of " + str(num_records) + " database operations")
-				logging.debug('Number of inserts: ' + str(num_inserts) + ' out of ' + str(num_inserts_total))
-				logging.debug('Number of updates: ' + str(num_updates) + ' out of ' + str(num_updates_total))
-				logging.debug('Number of deletes: ' + str(num_deletes) + ' out of ' + str(num_deletes_total))
+			store = quarantine.QuarantineStore(replica.quarantinePath)
+			sinks = openSinks(self, replica)
+			watermarks = None
+			if len(sinks) > 1:
+				watermarks = checkpoint.Watermarks(replica)
+			for dataset in replica.datasets:
+				entries = store.getEntries(dataset.cdcTable, 'quarantined', ids)
+				if len(entries) == 0:
+					continue
+				logging.info('Replaying ' + str(len(entries)) + ' quarantined changes for ' + str(dataset))
+				editor = DatasetImport(self, dataset, sinks = sinks, watermarks = watermarks).openEditor()
+				entryIds = dict()
+				for entry in entries:
+					change = db.Change(entry.op, entry.key, tuple(entry.row), None)
+					change.cdcKeys = entry.cdcKeys
+					entryIds[id(change)] = entry.id
+					editor.add(change, entry.fields)
+				editor.close()
+				for change in editor.committed:
+					store.setStatus(entryIds[id(change)], 'replayed')
+				for change, fields in editor.failed:
+					store.setStatus(entryIds[id(change)], 'quarantined', change.error)
+				logging.info('Replayed ' + str(len(editor.committed)) + ' out of ' + str(len(entries)) + ' changes')
+				num_replayed = num_replayed + len(editor.committed)
 				
-				logging.info("End iterating through change records")
+			if num_replayed > 0 and True in [isinstance(target, SdeSink) for target in sinks]:
+				self._syncWithProd(replica)
 		except:
-			num_total = -1
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
 			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 			logging.error(msg)
 		finally:
-			if num_total > 0:
-				if self._clearCdc == True:
-					dataset.clearChanges(processedRecords)
-				else:
-					logging.info('clearCdc is set to False in config file. CDC still contains change records')
-			logging.info('End ' + func)
-		return num_total
+			for target in sinks:
+				target.close()
+			if store is not None:
+				store.close()
+			lockfile.unlock()
+		logging.info('End ' + func)
+		return num_replayed
+		
+	def _applyChange(self, dataset, change, fields):
+		self._lastError = None
+		bApplied = True
+		if change.op == "insert":
+			bApplied = self._processInserts(dataset, change.row, fields)
+		elif change.op == "update":
+			bApplied = self._processUpdates(dataset, change.row, fields)
+		elif change.op == "delete":
+			bApplied = self._processDeletes(dataset, change.row, fields)
+		if not bApplied:
+			if self._lastError is not None:
+				change.error = self._lastError
+			else:
+				change.error = 'Could not ' + change.op + ' record ' + str(change.key)
+		return bApplied
 			
 	def _processInserts(self, dataset, row, fields):
 		func = 'SqlServerImporter._processInserts'
@@ -222,7 +716,7 @@ class SqlServerImporter(object):
 			else:
 				features = arcpy.InsertCursor(layer)
 				field_names = self._getFieldNames(layer)
-				dataset.logBgBaseInfo(None, row)
+				dataset.logBgBaseInfo(None, row, fields)
 				
 				feature = features.newRow()
 				if self._loadFeature(feature, row, dataset, field_names, fields) == True:
@@ -235,12 +729,14 @@ class SqlServerImporter(object):
 			msgs = arcpy.GetMessages(0)
 			arcpy.AddError(msgs)
 			logging.error("ArcGIS error: %s", msgs)
+			self._lastError = msgs
 		except:
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
 			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 			arcpy.AddError(msg)
 			logging.error(msg)
+			self._lastError = str(sys.exc_info()[1])
 		finally:
 			if feature:
 				del feature
@@ -275,14 +771,14 @@ class SqlServerImporter(object):
 				if bWasFirst == True:
 					logging.debug('--------------- Begin updating record where line_seq = 1 ---------------')
 				
-				dataset.logBgBaseInfo(feature, row)
+				dataset.logBgBaseInfo(feature, row, fields)
 				
 				if self._loadFeature(feature, row, dataset, field_names, fields) == True:
 					features.updateRow(feature)
 					
 					if bWasFirst == True:
 						logging.debug('Line seq for SDE should now be 2:')
-						dataset.logBgBaseInfo(feature, row)
+						dataset.logBgBaseInfo(feature, row, fields)
 						logging.debug('---------------   End updating record where line_seq = 1 ---------------')
 					logging.debug('Successfully updated record ' + str(key))
 					bUpdate = True
@@ -303,12 +799,14 @@ class SqlServerImporter(object):
 			msgs = arcpy.GetMessages(0)
 			arcpy.AddError(msgs)
 			logging.error("ArcGIS error: %s", msgs)
+			self._lastError = msgs
 		except:
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
 			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 			arcpy.AddError(msg)
 			logging.error(msg)
+			self._lastError = str(sys.exc_info()[1])
 		finally:
 			if feature:
 				del feature
@@ -339,12 +837,14 @@ class SqlServerImporter(object):
 			msgs = arcpy.GetMessages(0)
 			arcpy.AddError(msgs)
 			logging.error("ArcGIS error: %s", msgs)
+			self._lastError = msgs
 		except:
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
 			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 			arcpy.AddError(msg)
 			logging.error(msg)
+			self._lastError = str(sys.exc_info()[1])
 		finally:
 			if feature:
 				del feature
@@ -366,35 +866,37 @@ class SqlServerImporter(object):
 		func = 'SqlServerImporter._loadFeature'
 		last_field = ''
 		last_value = ''
+		bLoaded = True
 		try:
-			for field_name in feature_fields:
-				if row_fields.has_key(field_name):
-					new_value = row[row_fields[field_name]]
-					last_field = field_name
-					if new_value is not None:
-						last_value = new_value
-					else:
-						last_value = 'None'
-					try:
-						if str(type(new_value)) == "<class 'decimal.Decimal'>":
-							new_value = float(new_value)
-						feature.setValue(field_name, new_value)
-					except arcpy.ExecuteError:
-						msgs = arcpy.GetMessages(0)
-						arcpy.AddError(msgs)
-						logging.error("ArcGIS error: %s", msgs)
-						logging.error('Field/Value: %s, %s', last_field, last_value)
-						logging.error(type(last_value))
-					except:
-						tb = sys.exc_info()[2]
-						tbinfo = traceback.format_tb(tb)[0]
-						msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
-						arcpy.AddError(msg)
-						logging.error(msg)
-						logging.error('Field/Value: %s, %s', last_field, last_value)
-						logging.error(type(last_value))
-				elif field_name != "GlobalID":
-					logging.warn(field_name + " not found in Warehouse")
+			for field_name in dataset.getLoadedFields(feature_fields, row_fields):
+				new_value = row[row_fields[field_name]]
+				last_field = field_name
+				if new_value is not None:
+					last_value = new_value
+				else:
+					last_value = 'None'
+				try:
+					if str(type(new_value)) == "<class 'decimal.Decimal'>":
+						new_value = float(new_value)
+					feature.setValue(field_name, new_value)
+				except arcpy.ExecuteError:
+					msgs = arcpy.GetMessages(0)
+					arcpy.AddError(msgs)
+					logging.error("ArcGIS error: %s", msgs)
+					logging.error('Field/Value: %s, %s', last_field, last_value)
+					logging.error(type(last_value))
+					self._lastError = 'Field ' + last_field + ': ' + msgs
+					bLoaded = False
+				except:
+					tb = sys.exc_info()[2]
+					tbinfo = traceback.format_tb(tb)[0]
+					msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+					arcpy.AddError(msg)
+					logging.error(msg)
+					logging.error('Field/Value: %s, %s', last_field, last_value)
+					logging.error(type(last_value))
+					self._lastError = 'Field ' + last_field + ': ' + str(sys.exc_info()[1])
+					bLoaded = False
 
 			if dataset.isSpatial == True and row_fields.has_key(dataset.xField) and row_fields.has_key(dataset.yField):
 				x = row[row_fields[dataset.xField]]
@@ -405,12 +907,13 @@ class SqlServerImporter(object):
 					if str(type(y)) == "<class 'decimal.Decimal'>":
 						y = float(y)
 					feature.shape = arcpy.PointGeometry(arcpy.Point(x, y))
-			return True
+			return bLoaded
 		except arcpy.ExecuteError:
 			msgs = arcpy.GetMessages(0)
 			arcpy.AddError(msgs)
 			logging.error("ArcGIS error: %s", msgs)
 			logging.error('Field/Value: %s, %s', last_field, last_value)
+			self._lastError = 'Field ' + last_field + ': ' + msgs
 		except:
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
@@ -418,6 +921,7 @@ class SqlServerImporter(object):
 			arcpy.AddError(msg)
 			logging.error(msg)
 			logging.error('Field/Value: %s, %s', last_field, last_value)
+			self._lastError = 'Field ' + last_field + ': ' + str(sys.exc_info()[1])
 		return False
 		
 	def _reconcileStaging(self, replica):
@@ -449,13 +953,14 @@ class SqlServerImporter(object):
 		func = 'SqlServerImporter._syncWithProd'
 		logging.info("Begin " + func)
 		try:
-			logging.debug("Synchronizing data from staging to production")
-			arcpy.SynchronizeChanges_management(replica.stagingWorkspace, replica.name, replica.productionWorkspace, "FROM_GEODATABASE1_TO_2", "IN_FAVOR_OF_GDB1", "BY_OBJECT", "DO_NOT_RECONCILE")
-			logging.debug("Finished synchronizing data from production to staging")
-			
-			logging.debug("Compressing data in Production SDE")
-			arcpy.Compress_management(replica.productionWorkspace)
-			logging.debug("Finished compressing data in Production SDE")
+			with profiling.stage('sync'):
+				logging.debug("Synchronizing data from staging to production")
+				arcpy.SynchronizeChanges_management(replica.stagingWorkspace, replica.name, replica.productionWorkspace, "FROM_GEODATABASE1_TO_2", "IN_FAVOR_OF_GDB1", "BY_OBJECT", "DO_NOT_RECONCILE")
+				logging.debug("Finished synchronizing data from production to staging")
+				
+				logging.debug("Compressing data in Production SDE")
+				arcpy.Compress_management(replica.productionWorkspace)
+				logging.debug("Finished compressing data in Production SDE")
 			return True
 		except arcpy.ExecuteError:
 			msgs = arcpy.GetMessages(2)
@@ -470,6 +975,1669 @@ class SqlServerImporter(object):
 		logging.info("End " + func)
 		return False
 		
+########################################################################
+# Imports a group of replicas in a worker process, see SqlServerImporter.run.
+# configs: The configs of the replicas
+# returns the ReplicaReport.toDict() of the replicas
+def _importGroup(configs, clearCdc, fromSpill, deadline):
+	importer = SqlServerImporter(db.Replicas(configs), clearCdc, fromSpill = fromSpill)
+	importer._deadline = deadline
+	importer._processGroup(importer._replicas.replicas)
+	return [values.toDict() for values in importer.report.replicas.values()]
+	
+###################################################################################################
+###################################################################################################
+#
+# class:	io.DatasetImport
+# purpose:	Imports the CDC changes of one dataset a batch at a time, as a job of the
+#			schedule.DatasetScheduler. A pass reads the CDC records that are in the change table
+#			when it starts. When a pass is drained, the records of the applied changes are cleared
+#			from CDC, and poll starts another pass if new records arrived in the meantime.
+#
+# notes:	With deferDeletes the deletes are held back until applyDeletes is called, so that
+#			schedule.DependencyScheduler can delete the rows of the child datasets first. A later
+#			change of a held back key is merged into its delete.
+#
+#			With the snapshotRatio of the replica, the first pass may reload staging from the
+#			source table before it imports the CDC records after the snapshot, see _snapshot.
+#
+#			Once a change of a key failed, the later changes of the key are held back for the
+#			rest of the run and stay in CDC with it, see _holdBack.
+#
+###################################################################################################
+
+class DatasetImport(object):
+	#importer:	The SqlServerImporter
+	#dataset:	The db.Dataset whose changes are imported
+	#connect:	Read CDC on a connection of the dataset's own, needed when datasets are interleaved
+	#stopped:	checkpoint.Checkpoint of the replica, or None
+	#deferDeletes:	Hold back the deletes until applyDeletes is called
+	#sinks:		The sink.Sink objects to which the changes are written, None for the geodatabase
+	#watermarks:	checkpoint.Watermarks of the sinks, needed with more than one sink
+	#tracker:		lag.LagTracker that measures the lag of the changes, or None
+	def __init__(self, importer, dataset, connect = False, stopped = None, deferDeletes = False, sinks = None, watermarks = None, tracker = None):
+		self.importer = importer
+		self.dataset = dataset
+		self.sinks = sinks or []
+		self.watermarks = watermarks
+		self.tracker = tracker
+		self.priority = dataset.priority
+		self.resumed = stopped is not None and stopped.has(dataset)
+		self.interrupted = False
+		self.position = None
+		self.numPasses = 0
+		self.numRecords = 0
+		self.numNoops = 0
+		self.numFailed = 0
+		self.numCommits = 0
+		self.numRollbacks = 0
+		self.commitSeconds = 0.0
+		self.drainedSeconds = None
+		self.snapshot = None
+		self.failed = False
+		self._connect = connect
+		self._checkpoint = stopped
+		self._started = time.time()
+		self._changes = None
+		self._batches = None
+		self._editor = None
+		self._numAdded = 0
+		self._comparer = None
+		self._passFailed = False
+		self._timings = dict()
+		self._timingsLock = threading.Lock()
+		self._shards = []
+		self._outlets = OrderedDict()
+		self._unsaved = dict()
+		self._totals = {'insert':0, 'update':0, 'delete':0}
+		self._applied = {'insert':0, 'update':0, 'delete':0}
+		self._fetchSizer = None
+		self._applySizer = None
+		self._snapshotLsn = None
+		self._fieldNames = None
+		self._deferred = None
+		self._rejected = []
+		self._held = []
+		self._heldKeys = set()
+		self._order = dict()
+		if deferDeletes:
+			self._deferred = OrderedDict()
+		replica = dataset.replica
+		if replica.adaptiveBatchSize:
+			self._fetchSizer = adaptive.BatchSizer('fetch', replica.fetchBlockSize, replica.minBatchSize, replica.maxBatchSize, replica.isBlocked)
+			if dataset.shards <= 1:
+				self._applySizer = adaptive.BatchSizer('apply', replica.editBatchSize, replica.minBatchSize, replica.maxBatchSize, replica.isBlocked)
+		return
+		
+	def __str__(self):
+		return str(self.dataset)
+		
+	########################################################################
+	# Imports the next batch of changes, the first call starts the first pass.
+	# returns False when the pass is drained or failed
+	def step(self):
+		func = 'DatasetImport.step'
+		try:
+			if self._batches is None:
+				if self.numPasses > 0:
+					return False
+				self._start()
+			batch = next(self._batches, None)
+			if batch is None:
+				self._editor.flush()
+				self._finishPass()
+				return False
+			self._apply(batch)
+			self._trackApplied()
+			return True
+		except:
+			self.failed = True
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+			self._finishPass()
+		return False
+		
+	########################################################################
+	# Saves the open edit session, so that another dataset can be edited.
+	def pause(self):
+		if self._editor is not None:
+			self._editor.flush()
+			self._trackApplied()
+		return
+		
+	########################################################################
+	# Stops the import after the current batch, called when the run is out of time.
+	def interrupt(self):
+		self.interrupted = True
+		self._finishPass()
+		return
+		
+	########################################################################
+	# Applies the deletes that were held back, in an edit session of their own.
+	def applyDeletes(self):
+		func = 'DatasetImport.applyDeletes'
+		if self.failed:
+			return
+		if self._deferred:
+			try:
+				with profiling.stage('apply'):
+					self._openEditor()
+					for change, fields in self._deferred.values():
+						self._order[id(change)] = len(self._order)
+						if change.key in self._heldKeys:
+							self._held.append((change, fields))
+							continue
+						self._totals['delete'] = self._totals['delete'] + 1
+						self._editor.add(change, fields)
+					self._editor.flush()
+			except:
+				self.failed = True
+				tb = sys.exc_info()[2]
+				tbinfo = traceback.format_tb(tb)[0]
+				msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+				logging.error(msg)
+			self._deferred.clear()
+			self._finishPass()
+		if not self.failed:
+			self._clearSnapshot()
+		return
+		
+	########################################################################
+	# Starts a new pass if the last one cleared all of its changes and CDC has new records.
+	# returns True if a pass was started
+	def poll(self):
+		if self.failed or self._passFailed or self._batches is not None or self.importer._clearCdc != True:
+			return False
+		if not self.dataset.hasChanges():
+			return False
+		self._start()
+		return True
+		
+	########################################################################
+	# Ends the import, writes the counts to the run report and the apply rates.
+	# returns the number of changes applied, or -1 if the import failed
+	def close(self):
+		func = 'DatasetImport.close'
+		self._finishPass()
+		if self._connect:
+			self.dataset.closeConnection()
+		if self._checkpoint is not None and not self.failed:
+			if self.interrupted:
+				self._checkpoint.set(self.dataset, self.position, self.numRecords)
+			else:
+				self._checkpoint.clear(self.dataset)
+		if self.failed:
+			return -1
+		num_total = -1
+		try:
+			num_inserts = self._applied['insert']
+			num_updates = self._applied['update']
+			num_deletes = self._applied['delete']
+			num_total = num_inserts + num_updates + num_deletes
+			logging.info("Processed " + str(num_total) + " changes from " + str(self.numRecords) + " database operations")
+			logging.debug('Number of inserts: ' + str(num_inserts) + ' out of ' + str(self._totals['insert']))
+			logging.debug('Number of updates: ' + str(num_updates) + ' out of ' + str(self._totals['update']))
+			logging.debug('Number of deletes: ' + str(num_deletes) + ' out of ' + str(self._totals['delete']))
+			if self._comparer is not None:
+				logging.debug('Number of updates skipped because nothing changed: ' + str(self.numNoops))
+			logging.debug('Saved ' + str(self.numCommits) + ' edit batches, rolled back ' + str(self.numRollbacks))
+			
+			replica = self.dataset.replica
+			values = self.importer.report.replica(replica.name).dataset(str(self.dataset))
+			values['records'] = self.numRecords
+			values['inserts'] = num_inserts
+			values['updates'] = num_updates
+			values['deletes'] = num_deletes
+			values['noops'] = self.numNoops
+			values['failed'] = self.numFailed
+			values['commits'] = self.numCommits
+			values['rollbacks'] = self.numRollbacks
+			if self._connect:
+				values['priority'] = self.priority
+				values['passes'] = self.numPasses
+				values['drainedSeconds'] = self.drainedSeconds
+			if replica.adaptiveBatchSize:
+				values['batchSizes'] = {'fetch':self._fetchSizer.toDict()}
+				if self._applySizer is not None:
+					values['batchSizes']['apply'] = self._applySizer.toDict()
+			if len(self._shards) > 0:
+				values['shards'] = self._shards
+			if len(self._outlets) > 0:
+				values['sinks'] = self._outlets.values()
+			if self.dataset.applyMode != 'arcpy':
+				values['applyMode'] = self.dataset.applyMode
+			if self.resumed:
+				values['resumed'] = True
+			if self.interrupted:
+				values['stopped'] = True
+			if self.snapshot is not None:
+				values['snapshot'] = self.snapshot
+				self.importer.report.replica(replica.name).add('snapshots', 1)
+			self.importer.report.replica(replica.name).add('changes', num_total)
+			
+			rates = diff.ApplyRates(replica)
+			for op in self._timings:
+				if op != "skip":
+					rates.update(self.dataset, op, self._timings[op][0], self._timings[op][1])
+			rates.update(self.dataset, 'commit', self.numCommits, self.commitSeconds)
+			rates.save()
+		except:
+			num_total = -1
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return num_total
+		
+	def _start(self):
+		replica = self.dataset.replica
+		logging.debug('Processing dataset in ' + self.dataset.sdeTable)
+		self.numPasses = self.numPasses + 1
+		if self._connect and self.numPasses == 1 and not self.dataset.openConnection():
+			raise IOError('Could not open a connection for ' + str(self.dataset))
+		position = None
+		if self.numPasses == 1 and self.resumed and self.importer._clearCdc != True:
+			#The saved records are still in CDC, continue after the last one.
+			position = self._checkpoint.getPosition(self.dataset)
+		self._openEditor()
+		self._passFailed = False
+		#The snapshot and the comparison with the rows need the geodatabase.
+		writesSde = len(self.sinks) == 0 or (len(self.sinks) == 1 and isinstance(self.sinks[0], SdeSink))
+		if self.numPasses == 1 and not self.resumed and replica.snapshotRatio is not None and not self.importer._fromSpill and self.dataset.changeSource is None and writesSde:
+			position = self._snapshot()
+		self._changes = self.importer._openChanges(self.dataset, self._fetchSizer, position)
+		self._batches = iter(self._changes)
+		if (replica.skipNoopUpdates or self.snapshot is not None) and self._comparer is None and writesSde:
+			self._comparer = diff.ChangeDiff(self.dataset)
+		logging.info("Begin iterating through change records")
+		return
+		
+	########################################################################
+	# Reloads staging from the source table when the CDC table has more records than snapshotRatio
+	# of its rows. The rows in which staging differs from the table are found with
+	# diff.TableReconciler and written in the edit session of the pass. The LSN up to which CDC
+	# has captured the changes is read before the table, and the CDC records up to it are cleared
+	# once the snapshot is saved. The records after it are imported as usual, see _apply for the
+	# ones that the snapshot already contains.
+	# returns the position after which the CDC records are read, or None without a snapshot
+	def _snapshot(self):
+		dataset = self.dataset
+		replica = dataset.replica
+		numRecords = dataset.countChanges()
+		if numRecords == 0:
+			return None
+		numRows = dataset.countRows()
+		if numRecords <= replica.snapshotRatio * numRows:
+			return None
+		lsn = dataset.getMaxLsn()
+		if lsn is None:
+			return None
+		logging.info(str(dataset) + ' has ' + str(numRecords) + ' CDC records for ' + str(numRows) + ' rows, reloading staging from ' + dataset.sourceTable)
+		started = time.time()
+		with profiling.stage('snapshot'):
+			reconciler = diff.TableReconciler(dataset)
+			repairs = reconciler.run()
+		with profiling.stage('apply'):
+			for change in repairs.changes:
+				self._add(change, repairs.fields)
+			self._editor.flush()
+		self.snapshot = OrderedDict()
+		self.snapshot['lsn'] = '0x' + binascii.hexlify(lsn).upper()
+		self.snapshot['records'] = numRecords
+		self.snapshot['rows'] = numRows
+		self.snapshot['repairs'] = len(repairs.changes)
+		self.snapshot['cleared'] = 0
+		self.snapshot['seconds'] = round(time.time() - started, 3)
+		if len(self._editor.failed) == 0:
+			self._snapshotLsn = lsn
+		if not self._deferred:
+			self._clearSnapshot()
+		#After the last record that can have the LSN.
+		self.position = (lsn, '\xff' * 10, 5)
+		return self.position
+		
+	########################################################################
+	# Clears the CDC records that the saved snapshot replaced. Deletes that are held back are
+	# saved first.
+	def _clearSnapshot(self):
+		if self._snapshotLsn is None or self._passFailed:
+			return
+		if self.importer._clearCdc == True:
+			with profiling.stage('clearCdc'):
+				self.snapshot['cleared'] = self.dataset.clearChangesThrough(self._snapshotLsn)
+		self._snapshotLsn = None
+		return
+		
+	########################################################################
+	# Opens the editor of a pass. With more than one sink the changes are fanned out to an
+	# editor per sink, whose batch sizes are not adapted.
+	def _openEditor(self):
+		replica = self.dataset.replica
+		maxRows = replica.editBatchSize
+		if self._applySizer is not None:
+			maxRows = self._applySizer.size
+		self._numAdded = 0
+		if len(self.sinks) > 1:
+			editors = [(target, self._openSinkEditor(target, replica.editBatchSize, None)) for target in self.sinks]
+			self._editor = FanOutEditor(str(self.dataset), self.dataset, editors, self.watermarks, replica.editBatchSize, self._unsaved)
+		elif len(self.sinks) == 1:
+			self._editor = self._openSinkEditor(self.sinks[0], maxRows, self._applySizer)
+		else:
+			self._editor = self._openSinkEditor(None, maxRows, self._applySizer)
+		return
+		
+	########################################################################
+	# Returns a new editor for the sinks of the import, like the editor of a pass, e.g. to replay
+	# quarantined changes.
+	def openEditor(self):
+		self._openEditor()
+		return self._editor
+		
+	########################################################################
+	# Returns the editor that writes the changes of the dataset to a sink.
+	# target: The sink.Sink, None or an SdeSink for the geodatabase
+	def _openSinkEditor(self, target, maxRows, sizer):
+		replica = self.dataset.replica
+		if target is not None and not isinstance(target, SdeSink):
+			return SinkEditor(target, self.dataset, maxRows, replica.editBatchSeconds, sizer)
+		elif self.dataset.applyMode == 'sql' and not self.dataset.isSpatial:
+			if self._fieldNames is None:
+				self._fieldNames = self.importer._getFieldNames(self.dataset.getSdeTablePath())
+			return SqlEditor(self.dataset, self._fieldNames, self._applyChange, maxRows, replica.editBatchSeconds, sizer)
+		elif self.dataset.shards > 1:
+			return ShardedEditor(str(self.dataset), self.dataset, self.dataset.shards, maxRows, replica.editBatchSeconds)
+		return SdeEditor(replica.stagingWorkspace, self._applyChange, maxRows, replica.editBatchSeconds, sizer)
+		
+	def _apply(self, batch):
+		started = time.time()
+		self.numRecords = self.numRecords + batch.numRecords
+		for change, fields in self._editor.failed:
+			self._heldKeys.add(change.key)
+		if batch.position is not None:
+			self.position = batch.position
+		with profiling.stage('apply'):
+			if self._comparer is not None:
+				for change, kind, changed in self._comparer.classify(batch):
+					if kind == 'noop' and self.dataset.replica.skipNoopUpdates:
+						#Rewriting identical values would only add versioned delta rows.
+						change.op = "skip"
+						self.numNoops = self.numNoops + 1
+					elif kind == 'delete-missing' and self.snapshot is not None:
+						#The row was already deleted when the snapshot was read.
+						change.op = "skip"
+					elif kind == 'insert-existing' and self.snapshot is not None:
+						#The snapshot has the row, with values that are at least as recent.
+						change.op = "update"
+			if isinstance(self._editor, FanOutEditor):
+				self._editor.position = batch.position
+			for change in batch.changes:
+				self._add(change, batch.fields)
+			if isinstance(self._editor, FanOutEditor):
+				self._editor.mark(batch.position)
+				self._editor.position = None
+		if self.tracker is not None:
+			self.tracker.read(self.dataset, batch, self._numAdded, started)
+		return
+		
+	def _add(self, change, fields):
+		self._order[id(change)] = len(self._order)
+		if change.key in self._heldKeys:
+			#An earlier change of the key failed, writing this one would be undone by its retry.
+			self._held.append((change, fields))
+			return
+		if change.error is not None and change.op != 'delete':
+			#The values could not be converted, the change goes to the quarantine unwritten.
+			self._heldKeys.add(change.key)
+			self._rejected.append((change, fields))
+			return
+		if self._deferred is not None:
+			change = self._defer(change, fields)
+			if change is None:
+				return
+		if change.op in self._totals:
+			self._totals[change.op] = self._totals[change.op] + 1
+		self._editor.add(change, fields)
+		self._numAdded = self._numAdded + 1
+		return
+		
+	########################################################################
+	# Measures the apply lag of the batches whose changes the editor saved.
+	def _trackApplied(self):
+		if self.tracker is not None and self._editor is not None:
+			self.tracker.applied(self.dataset, len(self._editor.committed) + len(self._editor.failed))
+		return
+		
+	########################################################################
+	# Holds back a delete, or merges a change into the delete of its key that was held back.
+	# returns the change to apply now, or None
+	def _defer(self, change, fields):
+		deleted = self._deferred.pop(change.key, None)
+		if deleted is not None:
+			deleted[0].merge(change)
+			change = deleted[0]
+		if change.op == 'delete':
+			self._deferred[change.key] = (change, fields)
+			return None
+		return change
+		
+	def _applyChange(self, change, fields):
+		started = time.time()
+		bApplied = self.importer._applyChange(self.dataset, change, fields)
+		with self._timingsLock:
+			timing = self._timings.setdefault(change.op, [0, 0.0])
+			timing[0] = timing[0] + 1
+			timing[1] = timing[1] + time.time() - started
+		return bApplied
+		
+	########################################################################
+	# Closes the CDC pipeline and the edit session of the pass and clears the CDC records of
+	# the changes that were saved. Edits that were applied before a failure are still saved,
+	# so that their CDC records can be cleared.
+	def _finishPass(self):
+		processedRecords = []
+		if self._changes is not None:
+			self._changes.close()
+			self._changes = None
+			self._batches = None
+		if self._editor is not None:
+			editor = self._editor
+			self._editor = None
+			editor.close()
+			if self.tracker is not None:
+				self.tracker.applied(self.dataset)
+			rejected = self._rejected
+			self._rejected = []
+			failed = editor.failed + rejected
+			committed, held = self._holdBack(editor.committed, failed)
+			for change in committed:
+				if change.op in self._applied:
+					self._applied[change.op] = self._applied[change.op] + 1
+				processedRecords.extend(change.cdcKeys)
+			self.numFailed = self.numFailed + len(failed) + len(held)
+			self.numCommits = self.numCommits + editor.numCommits
+			self.numRollbacks = self.numRollbacks + editor.numRollbacks
+			self.commitSeconds = self.commitSeconds + editor.commitSeconds
+			self._passFailed = len(failed) + len(held) > 0
+			if isinstance(editor, ShardedEditor):
+				self._addShards(editor)
+				with self._timingsLock:
+					for op, timing in editor.timings.items():
+						total = self._timings.setdefault(op, [0, 0.0])
+						total[0] = total[0] + timing[0]
+						total[1] = total[1] + timing[1]
+			quarantined = self.importer._quarantineFailures(self.dataset, committed, failed)
+			if isinstance(editor, FanOutEditor):
+				self._addOutlets(editor)
+				if len(rejected) + len(held) > 0 and self.dataset.changeSource is None:
+					#The watermarks moved past the changes that were not written, the sinks retry them.
+					cdcKeys = [cdcKey for change, fields in rejected + held for cdcKey in change.cdcKeys]
+					for target in self.sinks:
+						self.watermarks.update(target.name, self.dataset, None, [], cdcKeys)
+				self.watermarks.discard(self.dataset, quarantined)
+			processedRecords.extend(quarantined)
+			logging.info("End iterating through change records")
+		if len(processedRecords) > 0:
+			if self.importer._clearCdc == True:
+				with profiling.stage('clearCdc'):
+					self.dataset.clearChanges(processedRecords)
+			else:
+				logging.info('clearCdc is set to False in config file. CDC still contains change records')
+		if self._deferred and self.watermarks is not None and self.dataset.changeSource is None:
+			#The watermarks moved past the deletes that are held back, the sinks retry them.
+			cdcKeys = [cdcKey for change, fields in self._deferred.values() for cdcKey in change.cdcKeys]
+			for target in self.sinks:
+				self.watermarks.update(target.name, self.dataset, None, [], cdcKeys)
+		if self.drainedSeconds is None and self.numPasses > 0 and not self.failed and not self.interrupted:
+			self.drainedSeconds = round(time.time() - self._started, 3)
+		return
+		
+	########################################################################
+	# Holds back the changes of the keys of which an earlier change failed in this run. Their
+	# CDC records are not cleared, so the next run retries them after the failed change, which
+	# would otherwise undo them. They are not quarantined, the failed change is.
+	# committed: The changes that the editor of the pass saved
+	# failed: (change, fields) of the changes that failed in the pass
+	# returns the committed changes that are not held back, and the held back (change, fields)
+	def _holdBack(self, committed, failed):
+		held = self._held
+		self._held = []
+		first = dict()
+		for change, fields in failed:
+			index = self._order.get(id(change), -1)
+			first[change.key] = min(first.get(change.key, index), index)
+			self._heldKeys.add(change.key)
+		kept = []
+		for change in committed:
+			if change.key in first and self._order.get(id(change), -1) > first[change.key]:
+				change.error = 'An earlier change of the key was not saved'
+				held.append((change, None))
+			else:
+				kept.append(change)
+		for change, fields in held:
+			if change.error is None:
+				change.error = 'An earlier change of the key was not saved'
+		self._order = dict()
+		return (kept, held)
+		
+	########################################################################
+	# Adds the throughput of the shards of a pass to the per-shard values of the report.
+	def _addShards(self, editor):
+		for shard in editor.shards:
+			if shard.index >= len(self._shards):
+				self._shards.append(OrderedDict([('shard', shard.index), ('changes', 0), ('commits', 0), ('seconds', 0.0), ('changesPerSecond', 0.0)]))
+			values = self._shards[shard.index]
+			values['changes'] = values['changes'] + shard.numChanges
+			values['commits'] = values['commits'] + shard.numCommits
+			values['seconds'] = round(values['seconds'] + shard.seconds, 3)
+			values['changesPerSecond'] = round(values['changes'] / max(values['seconds'], 0.001), 1)
+		return
+		
+	########################################################################
+	# Adds the throughput of the sinks of a pass to the per-sink values of the report.
+	def _addOutlets(self, editor):
+		for outlet in editor.outlets:
+			values = self._outlets.get(outlet.sink.name)
+			if values is None:
+				values = OrderedDict([('sink', outlet.sink.name), ('changes', 0), ('commits', 0), ('failed', 0), ('seconds', 0.0), ('changesPerSecond', 0.0)])
+				self._outlets[outlet.sink.name] = values
+			values['changes'] = values['changes'] + outlet.numChanges
+			values['commits'] = values['commits'] + outlet.editor.numCommits
+			values['failed'] = values['failed'] + len(outlet.editor.failed)
+			values['seconds'] = round(values['seconds'] + outlet.seconds, 3)
+			values['changesPerSecond'] = round(values['changes'] / max(values['seconds'], 0.001), 1)
+		return
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	io.DatasetWorker
+# purpose:	A job of the schedule.DependencyScheduler that imports a dataset with a DatasetImport
+#			in a worker process, so that the datasets that the scheduler runs at the same time
+#			edit the geodatabase in processes of their own. arcpy can't run several edit sessions
+#			on threads of one process.
+#
+# notes:	Has the step, interrupt, applyDeletes and close of DatasetImport, with deferDeletes.
+#			The worker is started by the first call and stopped by close, which takes over the
+#			values of the dataset for the run report, the checkpoint of the dataset, its lag and
+#			its sink watermarks. The worker opens the sinks of the replica itself. The SQL Server
+#			statements of the worker are not in the query statistics of the report.
+#
+###################################################################################################
+
+class DatasetWorker(object):
+	#importer:	The SqlServerImporter
+	#dataset:	The db.Dataset whose changes are imported
+	#stopped:	checkpoint.Checkpoint of the replica
+	#watermarks:	checkpoint.Watermarks of the sinks, or None
+	#tracker:		lag.LagTracker that measures the lag of the changes
+	def __init__(self, importer, dataset, stopped, watermarks = None, tracker = None):
+		self.importer = importer
+		self.dataset = dataset
+		self.watermarks = watermarks
+		self.tracker = tracker
+		self.priority = dataset.priority
+		self.resumed = stopped.has(dataset)
+		self.interrupted = False
+		self.failed = False
+		self.position = None
+		self.numRecords = 0
+		self._checkpoint = stopped
+		self._worker = None
+		return
+		
+	def __str__(self):
+		return str(self.dataset)
+		
+	def step(self):
+		return self._call('step') == True
+		
+	def interrupt(self):
+		self._call('interrupt')
+		return
+		
+	def applyDeletes(self):
+		self._call('applyDeletes')
+		return
+		
+	########################################################################
+	# Ends the import in the worker and takes over its results, see DatasetImport.close.
+	# returns the number of changes applied, or -1 if the import failed
+	def close(self):
+		result = self._call('close')
+		if self._worker is not None:
+			self._worker.stop()
+			self._worker = None
+		if result is None:
+			return -1
+		numChanges, values, counters, lagValues, marks = result
+		if not self.failed:
+			if self.interrupted:
+				self._checkpoint.set(self.dataset, self.position, self.numRecords)
+			else:
+				self._checkpoint.clear(self.dataset)
+		replicaReport = self.importer.report.replica(self.dataset.replica.name)
+		replicaReport.dataset(str(self.dataset)).update(values)
+		for name in counters:
+			replicaReport.add(name, counters[name])
+		if self.tracker is not None and lagValues is not None:
+			self.tracker.addSamples(self.dataset, lagValues)
+		if self.watermarks is not None:
+			self.watermarks.setDataset(self.dataset, marks)
+		return numChanges
+		
+	########################################################################
+	# Calls a method of the _RemoteImport in the worker, starts the worker on the first call.
+	# returns the result of the method, or None if the worker failed
+	def _call(self, method):
+		func = 'DatasetWorker._call'
+		try:
+			if self._worker is None:
+				if self.failed:
+					return None
+				replica = self.dataset.replica
+				self._worker = processes.Worker(replica.name + ':' + str(self.dataset), _RemoteImport, (replica.config, str(self.dataset), self.importer._clearCdc, self.importer._fromSpill))
+			result, state = self._worker.call(method)
+			self.failed, self.interrupted, self.position, self.numRecords = state
+			return result
+		except:
+			self.failed = True
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return None
+		
+########################################################################
+# The DatasetImport of a DatasetWorker, in the worker process. It has an importer, the sinks,
+# the checkpoint, the watermarks and the lag tracker of its own. The methods return their result
+# and the state of the import, that the DatasetWorker takes over.
+class _RemoteImport(object):
+	#config:		The config of the replica
+	#datasetName:	str() of the db.Dataset
+	def __init__(self, config, datasetName, clearCdc, fromSpill):
+		replica = db.Replica(config)
+		self.dataset = [dataset for dataset in replica.datasets if str(dataset) == datasetName][0]
+		self.importer = SqlServerImporter(db.Replicas([]), clearCdc, fromSpill = fromSpill)
+		self.sinks = openSinks(self.importer, replica)
+		self.watermarks = None
+		if len(self.sinks) > 1:
+			self.watermarks = checkpoint.Watermarks(replica)
+		self.tracker = lag.LagTracker(replica)
+		self.job = DatasetImport(self.importer, self.dataset, True, checkpoint.Checkpoint(replica), True, self.sinks, self.watermarks, self.tracker)
+		return
+		
+	def step(self):
+		return (self.job.step(), self._getState())
+		
+	def interrupt(self):
+		return (self.job.interrupt(), self._getState())
+		
+	def applyDeletes(self):
+		return (self.job.applyDeletes(), self._getState())
+		
+	def close(self):
+		numChanges = self.job.close()
+		for target in self.sinks:
+			target.close()
+		self.dataset.replica.closeConnection()
+		replicaReport = self.importer.report.replica(self.dataset.replica.name)
+		marks = dict()
+		if self.watermarks is not None:
+			marks = self.watermarks.getDataset(self.dataset)
+		result = (numChanges, replicaReport.dataset(str(self.dataset)), replicaReport.counters, self.tracker.getSamples(self.dataset), marks)
+		return (result, self._getState())
+		
+	def _getState(self):
+		return (self.job.failed, self.job.interrupted, self.job.position, self.job.numRecords)
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	SdeEditor
+# purpose:	Writes changes to an SDE workspace inside arcpy.da.Editor edit sessions.
+#			The edits are saved every maxRows changes or maxSeconds seconds. When a batch
+#			fails, it is rolled back and split in half until the changes that cannot be saved
+#			are isolated, so one bad record doesn't hold back the rest of the batch.
+#
+# notes:	Only the changes in committed have been saved to the geodatabase. failed holds
+#			(change, fields) tuples of the changes that could not be written, their CDC records
+#			must stay in the change table.
+#
+#			With a sizer, maxRows is only the size of the first edit session, the sizer chooses
+#			the size of the next session from the time the saved ones took.
+#
+###################################################################################################
+
+class SdeEditor(object):
+
+	#workspace:		The SDE workspace that is edited.
+	#applyChange:	Function(change, fields) that writes a db.Change and returns True if it was written.
+	#maxRows:		Number of changes after which the edits are saved.
+	#maxSeconds:	Number of seconds after which the edits are saved.
+	#sizer:			adaptive.BatchSizer that adjusts maxRows, or None.
+	def __init__(self, workspace, applyChange, maxRows, maxSeconds, sizer = None):
+		self.workspace = workspace
+		self.committed = []
+		self.failed = []
+		self.numCommits = 0
+		self.numRollbacks = 0
+		self.commitSeconds = 0.0
+		self._applyChange = applyChange
+		self._maxRows = max(1, maxRows)
+		self._maxSeconds = maxSeconds
+		self._sizer = sizer
+		self._editor = None
+		self._pending = []
+		self._results = []
+		self._started = None
+		self._lastCommitSeconds = 0.0
+		self._lastError = None
+		return
+		
+	########################################################################
+	# Writes a change in the current edit session, and saves the session when it is full.
+	def add(self, change, fields):
+		if change.op == "skip":
+			self.committed.append(change)
+			return
+		if self._editor is None:
+			self._begin()
+		self._pending.append((change, fields))
+		try:
+			self._results.append(self._applyChange(change, fields))
+		except:
+			self._logError('SdeEditor.add')
+			self._failBatch()
+			return
+		if len(self._pending) >= self._maxRows or time.time() - self._started >= self._maxSeconds:
+			self.flush()
+		return
+		
+	########################################################################
+	# Saves the changes of the current edit session.
+	def flush(self):
+		if self._editor is None:
+			return
+		try:
+			self._commit()
+		except:
+			self._logError('SdeEditor.flush')
+			self._failBatch()
+			return
+		self._accept(self._pending, self._results)
+		if self._sizer is not None:
+			self._maxRows = self._sizer.observe(len(self._pending), time.time() - self._started, self._lastCommitSeconds)
+		self._pending = []
+		self._results = []
+		return
+		
+	def close(self):
+		self.flush()
+		if self._editor is not None:
+			self._rollback()
+		return
+		
+	def _begin(self):
+		self._editor = arcpy.da.Editor(self.workspace)
+		self._editor.startEditing(False, True)
+		self._editor.startOperation()
+		self._started = time.time()
+		return
+		
+	def _commit(self):
+		started = time.time()
+		with profiling.stage('commit'):
+			self._editor.stopOperation()
+			self._editor.stopEditing(True)
+		self._editor = None
+		self.numCommits = self.numCommits + 1
+		self._lastCommitSeconds = time.time() - started
+		self.commitSeconds = self.commitSeconds + self._lastCommitSeconds
+		return
+		
+	def _rollback(self):
+		try:
+			self._editor.abortOperation()
+		except:
+			None
+		try:
+			self._editor.stopEditing(False)
+		except:
+			self._logError('SdeEditor._rollback')
+		self._editor = None
+		self.numRollbacks = self.numRollbacks + 1
+		return
+		
+	def _accept(self, pending, results):
+		for i in range(0, len(pending)):
+			if results[i] == True:
+				self.committed.append(pending[i][0])
+			else:
+				self.failed.append(pending[i])
+		return
+		
+	def _failBatch(self):
+		pending = self._pending
+		self._pending = []
+		self._results = []
+		self._rollback()
+		self._bisect(pending)
+		return
+		
+	def _bisect(self, pending):
+		if len(pending) == 1:
+			change = pending[0][0]
+			logging.error('Could not save ' + change.op + ' for key ' + str(change.key) + '. The change was rolled back')
+			if change.error is None:
+				change.error = self._lastError
+			self.failed.append(pending[0])
+			return
+		logging.warn('Retrying ' + str(len(pending)) + ' changes in two smaller edit batches')
+		middle = len(pending) // 2
+		for part in [pending[:middle], pending[middle:]]:
+			self._applyBatch(part)
+		return
+		
+	def _applyBatch(self, pending):
+		results = []
+		try:
+			self._begin()
+			for change, fields in pending:
+				results.append(self._applyChange(change, fields))
+			self._commit()
+		except:
+			self._logError('SdeEditor._applyBatch')
+			self._rollback()
+			self._bisect(pending)
+			return
+		self._accept(pending, results)
+		return
+		
+	def _logError(self, func):
+		tb = sys.exc_info()[2]
+		tbinfo = traceback.format_tb(tb)[0]
+		msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+		logging.error(msg)
+		self._lastError = str(sys.exc_info()[1])
+		return
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	SqlEditor
+# purpose:	Writes the changes of a non-spatial dataset with set-based statements against the
+#			versioned view of its SDE table instead of arcpy cursors. The changes of an edit
+#			batch are inserted into a temp table, then applied with one DELETE, one UPDATE and
+#			one INSERT that read the temp table, in one transaction. The UPDATE has no FROM
+#			clause, SQL Server doesn't allow a join in an UPDATE of a view with INSTEAD OF
+#			triggers, like the versioned view. A named sqlEditVersion is edited inside an
+#			edit_version session, which is closed after the transaction was committed, the
+#			DEFAULT version directly.
+#
+# notes:	Has the interface of SdeEditor. The changes are held until the batch is saved, a
+#			change whose key is already in the batch saves the batch first, so the changes of a
+#			key are still written in CDC order. An update of a missing row is inserted and an
+#			insert of an existing row is skipped, like the arcpy path does it. A delete of a
+#			missing row fails.
+#
+#			When the statements of a batch fail, the batch is rolled back and written again with
+#			an SdeEditor, which isolates the changes that cannot be saved.
+#
+###################################################################################################
+
+class SqlEditor(object):
+	#dataset:		The db.Dataset whose changes are written, without xField and yField
+	#fieldNames:	Fields of the SDE table, see SqlServerImporter._getFieldNames
+	#applyChange:	Function(change, fields) of the SdeEditor that writes the batches that fail
+	#maxRows, maxSeconds, sizer: see SdeEditor
+	def __init__(self, dataset, fieldNames, applyChange, maxRows, maxSeconds, sizer = None):
+		self.dataset = dataset
+		self.committed = []
+		self.failed = []
+		self.numCommits = 0
+		self.numRollbacks = 0
+		self.commitSeconds = 0.0
+		self._fieldNames = fieldNames
+		self._applyChange = applyChange
+		self._maxRows = max(1, maxRows)
+		self._maxSeconds = maxSeconds
+		self._sizer = sizer
+		self._connection = None
+		self._pending = []
+		self._keys = set()
+		self._started = None
+		self._lastError = None
+		return
+		
+	########################################################################
+	# Adds a change to the current edit batch, and saves the batch when it is full.
+	def add(self, change, fields):
+		if change.op == "skip":
+			self.committed.append(change)
+			return
+		if change.key in self._keys:
+			self.flush()
+		if len(self._pending) == 0:
+			self._started = time.time()
+		self._pending.append((change, fields))
+		self._keys.add(change.key)
+		if len(self._pending) >= self._maxRows or time.time() - self._started >= self._maxSeconds:
+			self.flush()
+		return
+		
+	########################################################################
+	# Saves the changes of the current edit batch.
+	def flush(self):
+		if len(self._pending) == 0:
+			return
+		pending = self._pending
+		self._pending = []
+		self._keys = set()
+		started = time.time()
+		try:
+			with profiling.stage('commit'):
+				missing = self._write(pending)
+		except:
+			self._logError('SqlEditor.flush')
+			self._rollback()
+			logging.warn('Writing ' + str(len(pending)) + ' changes of ' + str(self.dataset) + ' with arcpy instead')
+			self._fallBack(pending)
+			return
+		seconds = time.time() - started
+		self.numCommits = self.numCommits + 1
+		self.commitSeconds = self.commitSeconds + seconds
+		for change, fields in pending:
+			if change.key in missing:
+				logging.error('Could not delete record ' + str(change.key) + ', it does not exist in ' + self.dataset.versionedView)
+				change.error = 'Could not delete record ' + str(change.key)
+				self.failed.append((change, fields))
+			else:
+				self.committed.append(change)
+		if self._sizer is not None:
+			self._maxRows = self._sizer.observe(len(pending), time.time() - self._started, seconds)
+		return
+		
+	def close(self):
+		self.flush()
+		if self._connection is not None:
+			self.dataset.replica.close(self._connection)
+			self._connection = None
+		return
+		
+	########################################################################
+	# Applies a batch in one transaction.
+	# returns the keys of the deletes whose rows did not exist
+	def _write(self, pending):
+		replica = self.dataset.replica
+		if self._connection is None:
+			self._connection = replica.openConnection()
+			if self._connection is None:
+				raise RuntimeError('Could not connect to SQL Server')
+		cursor = self._connection.cursor()
+		try:
+			version = replica.sqlEditVersion
+			if db.isNamedVersion(version):
+				cursor.execute('EXEC ' + replica.stagingRepository + '.set_current_version ?', version)
+				cursor.execute('EXEC ' + replica.stagingRepository + '.edit_version ?, 1', version)
+			#The changes of a pass can come from rows with different fields, e.g. the repairs of a snapshot.
+			groups = OrderedDict()
+			for change, fields in pending:
+				groups.setdefault(id(fields), (fields, []))[1].append(change)
+			missing = set()
+			for fields, changes in groups.values():
+				missing.update(self._writeGroup(cursor, fields, changes))
+			self._connection.commit()
+			if db.isNamedVersion(version):
+				cursor.execute('EXEC ' + replica.stagingRepository + '.edit_version ?, 2', version)
+				self._connection.commit()
+		finally:
+			replica.close(cursor)
+		return missing
+		
+	def _writeGroup(self, cursor, fields, changes):
+		dataset = self.dataset
+		view = dataset.versionedView
+		key = '[' + dataset.sdePrimaryKey + ']'
+		names = [name for name in dataset.getLoadedFields(self._fieldNames, fields) if name != dataset.sdePrimaryKey and name != 'GlobalID']
+		columns = [key] + ['[' + name + ']' for name in names]
+		
+		cursor.execute("IF OBJECT_ID('tempdb..#changes') IS NOT NULL DROP TABLE #changes")
+		cursor.execute('SELECT TOP 0 CAST(0 AS TINYINT) AS [__op], ' + ', '.join(columns) + ' INTO #changes FROM ' + view)
+		rows = []
+		for change in changes:
+			row = change.row
+			values = [_SQL_OPERATIONS[change.op], row[fields[dataset.cdcPrimaryKey]]]
+			values.extend([row[fields[name]] for name in names])
+			rows.append(values)
+		numRows = max(1, min(_MAX_INSERT_ROWS, _MAX_PARAMETERS // (len(columns) + 1)))
+		for i in range(0, len(rows), numRows):
+			block = rows[i:i + numRows]
+			values = '(' + ', '.join(['?'] * (len(columns) + 1)) + ')'
+			cursor.execute('INSERT INTO #changes VALUES ' + ', '.join([values] * len(block)), *[value for row in block for value in row])
+		
+		exists = 'EXISTS (SELECT 1 FROM ' + view + ' v WHERE v.' + key + ' = c.' + key + ')'
+		cursor.execute('SELECT c.' + key + ' FROM #changes c WHERE c.[__op] = 1 AND NOT ' + exists)
+		missing = [row[0] for row in cursor.fetchall()]
+		cursor.execute('DELETE FROM ' + view + ' WHERE ' + key + ' IN (SELECT ' + key + ' FROM #changes WHERE [__op] = 1)')
+		if len(names) > 0:
+			#The keys of a batch are unique, every subquery returns one row.
+			assignments = ', '.join([column + ' = (SELECT c.' + column + ' FROM #changes c WHERE c.' + key + ' = ' + view + '.' + key + ')' for column in columns[1:]])
+			cursor.execute('UPDATE ' + view + ' SET ' + assignments + ' WHERE ' + key + ' IN (SELECT ' + key + ' FROM #changes WHERE [__op] = 4)')
+		targets = list(columns)
+		sources = ['c.' + column for column in columns]
+		if 'GlobalID' in self._fieldNames:
+			targets.append('[GlobalID]')
+			sources.append('NEWID()')
+		cursor.execute('INSERT INTO ' + view + ' (' + ', '.join(targets) + ') SELECT ' + ', '.join(sources) + ' FROM #changes c WHERE c.[__op] IN (2, 4) AND NOT ' + exists)
+		cursor.execute('DROP TABLE #changes')
+		return missing
+		
+	def _rollback(self):
+		if self._connection is None:
+			return
+		try:
+			self._connection.rollback()
+		except:
+			self._logError('SqlEditor._rollback')
+		self.numRollbacks = self.numRollbacks + 1
+		replica = self.dataset.replica
+		if db.isNamedVersion(replica.sqlEditVersion):
+			cursor = None
+			try:
+				cursor = self._connection.cursor()
+				cursor.execute('EXEC ' + replica.stagingRepository + '.edit_version ?, 2', replica.sqlEditVersion)
+				self._connection.commit()
+			except:
+				None
+			finally:
+				replica.close(cursor)
+		return
+		
+	def _fallBack(self, pending):
+		editor = SdeEditor(self.dataset.replica.stagingWorkspace, self._applyChange, self._maxRows, self._maxSeconds)
+		for change, fields in pending:
+			editor.add(change, fields)
+		editor.close()
+		self.committed.extend(editor.committed)
+		self.failed.extend(editor.failed)
+		self.numCommits = self.numCommits + editor.numCommits
+		self.numRollbacks = self.numRollbacks + editor.numRollbacks
+		self.commitSeconds = self.commitSeconds + editor.commitSeconds
+		return
+		
+	def _logError(self, func):
+		tb = sys.exc_info()[2]
+		tbinfo = traceback.format_tb(tb)[0]
+		msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+		logging.error(msg)
+		self._lastError = str(sys.exc_info()[1])
+		return
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	ShardedEditor
+# purpose:	Splits the changes of a dataset into shards by the hash of their primary key and
+#			writes every shard with an SdeEditor of its own, in its own edit session and in its
+#			own worker process, because arcpy can't run several edit sessions on threads of one
+#			process. All the changes of a key go to the same shard in the order in which they
+#			were added, so the changes of a key are still written in CDC order.
+#
+# notes:	Has the interface of SdeEditor. committed, failed and the counts are complete after
+#			flush or close. A change is only in committed after the edit session of its shard
+#			was saved, so its CDC records are not cleared before.
+#
+#			A thread per shard passes the changes to its worker, see _ShardWriter, and maps the
+#			saved and failed changes the worker returns back to the db.Change objects. The
+#			workers are started for every pass, from the worker of a DatasetWorker as well when
+#			the dataset is imported in one.
+#
+###################################################################################################
+
+class ShardedEditor(object):
+	#name:			Name of the threads and worker processes
+	#dataset:		The db.Dataset whose changes are written
+	#numShards:		Number of shards.
+	#maxRows:		Number of changes of a shard after which its edits are saved.
+	#maxSeconds:	Number of seconds after which the edits of a shard are saved.
+	def __init__(self, name, dataset, numShards, maxRows, maxSeconds):
+		self.workspace = dataset.replica.stagingWorkspace
+		self.shards = []
+		self.timings = dict()
+		self._closed = False
+		self._lock = threading.Lock()
+		try:
+			for i in range(0, max(1, numShards)):
+				worker = processes.Worker(name + ':shard' + str(i), _ShardWriter, (dataset.replica.config, str(dataset), maxRows, maxSeconds))
+				shard = _Shard(i, worker, max(1, maxRows))
+				self.shards.append(shard)
+		except:
+			for shard in self.shards:
+				shard.worker.stop()
+			raise
+		for shard in self.shards:
+			thread = threading.Thread(target = self._run, args = (shard,), name = str(shard.worker))
+			thread.daemon = True
+			shard.thread = thread
+			thread.start()
+		return
+		
+	def _getCommitted(self):
+		return [change for shard in self.shards for change in shard.committed]
+		
+	def _getFailed(self):
+		return [item for shard in self.shards for item in shard.failed]
+		
+	def _sum(self, name):
+		return sum([getattr(shard, name) for shard in self.shards])
+		
+	committed = property(_getCommitted)
+	failed = property(_getFailed)
+	numCommits = property(lambda self: self._sum('numCommits'))
+	numRollbacks = property(lambda self: self._sum('numRollbacks'))
+	commitSeconds = property(lambda self: self._sum('commitSeconds'))
+		
+	########################################################################
+	# Passes a change to the shard of its key, waits while the queue of the shard is full.
+	def add(self, change, fields):
+		shard = self.shards[hash(change.key) % len(self.shards)]
+		shard.queue.put((change, fields))
+		return
+		
+	########################################################################
+	# Saves the edit sessions of all shards and waits until they are saved.
+	def flush(self):
+		if self._closed:
+			return
+		for shard in self.shards:
+			shard.queue.put(_FLUSH)
+		for shard in self.shards:
+			shard.queue.join()
+		return
+		
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		for shard in self.shards:
+			shard.queue.put(_CLOSE)
+		for shard in self.shards:
+			shard.thread.join()
+		return
+		
+	########################################################################
+	# Passes the changes that are queued for a shard to its worker, as many at a time as are
+	# waiting, up to the size of the queue.
+	def _run(self, shard):
+		with profiling.stage('apply'):
+			while True:
+				items = [shard.queue.get()]
+				while items[-1] is not _CLOSE and items[-1] is not _FLUSH and len(items) < shard.queue.maxsize:
+					try:
+						items.append(shard.queue.get_nowait())
+					except Queue.Empty:
+						break
+				started = time.time()
+				try:
+					changes = [item for item in items if item is not _CLOSE and item is not _FLUSH]
+					if len(changes) > 0:
+						self._send(shard, 'add', changes)
+					if items[-1] is _CLOSE:
+						self._send(shard, 'close', [])
+						return
+					elif items[-1] is _FLUSH:
+						self._send(shard, 'flush', [])
+				except:
+					tb = sys.exc_info()[2]
+					tbinfo = traceback.format_tb(tb)[0]
+					msg = "Error in ShardedEditor._run:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+					logging.error(msg)
+					self._fail(shard, str(sys.exc_info()[1]))
+					if items[-1] is _CLOSE:
+						return
+				finally:
+					shard.seconds = shard.seconds + time.time() - started
+					for item in items:
+						shard.queue.task_done()
+					if items[-1] is _CLOSE:
+						shard.worker.stop()
+		
+	########################################################################
+	# Calls a method of the _ShardWriter of a shard and takes over the changes it saved or
+	# could not write.
+	# changes: (change, fields) tuples that are passed to the method
+	def _send(self, shard, method, changes):
+		items = []
+		for change, fields in changes:
+			shard.numSent = shard.numSent + 1
+			shard.pending[shard.numSent] = (change, fields)
+			items.append((shard.numSent, change.op, change.key, tuple(change.row), fields))
+			shard.numChanges = shard.numChanges + 1
+		if method == 'add':
+			result = shard.worker.call(method, items)
+		else:
+			result = shard.worker.call(method)
+		for seq in result['committed']:
+			shard.committed.append(shard.pending.pop(seq)[0])
+		for seq, error in result['failed']:
+			item = shard.pending.pop(seq)
+			if item[0].error is None:
+				item[0].error = error
+			shard.failed.append(item)
+		shard.numCommits = result['numCommits']
+		shard.numRollbacks = result['numRollbacks']
+		shard.commitSeconds = result['commitSeconds']
+		with self._lock:
+			for op, timing in result['timings'].items():
+				total = self.timings.setdefault(op, [0, 0.0])
+				total[0] = total[0] + timing[0]
+				total[1] = total[1] + timing[1]
+		return
+		
+	########################################################################
+	# Fails the changes of a shard whose worker didn't return them, e.g. because it stopped.
+	def _fail(self, shard, error):
+		for seq in sorted(shard.pending.keys()):
+			change, fields = shard.pending.pop(seq)
+			if change.error is None:
+				change.error = error
+			shard.failed.append((change, fields))
+		return
+		
+#Queue items that make a shard save its edits or close its editor.
+_FLUSH = object()
+_CLOSE = object()
+
+class _Shard(object):
+	def __init__(self, index, worker, size):
+		self.index = index
+		self.worker = worker
+		self.queue = Queue.Queue(size)
+		self.thread = None
+		self.pending = dict()
+		self.committed = []
+		self.failed = []
+		self.numSent = 0
+		self.numChanges = 0
+		self.numCommits = 0
+		self.numRollbacks = 0
+		self.commitSeconds = 0.0
+		self.seconds = 0.0
+		return
+		
+########################################################################
+# Writes the changes of a shard of a ShardedEditor with an SdeEditor, in a worker process.
+# The changes are numbered by the ShardedEditor, the methods return the numbers of the changes
+# that were saved and that failed since the last call.
+class _ShardWriter(object):
+	#config:		The config of the replica
+	#datasetName:	str() of the db.Dataset
+	#maxRows, maxSeconds: see SdeEditor
+	def __init__(self, config, datasetName, maxRows, maxSeconds):
+		replica = db.Replica(config)
+		self.dataset = [dataset for dataset in replica.datasets if str(dataset) == datasetName][0]
+		self.importer = SqlServerImporter(db.Replicas([]), False)
+		self.editor = SdeEditor(replica.stagingWorkspace, self._applyChange, maxRows, maxSeconds)
+		self._seqs = dict()
+		self._timings = dict()
+		return
+		
+	#items: (seq, op, key, row, fields) tuples
+	def add(self, items):
+		for seq, op, key, row, fields in items:
+			change = db.Change(op, key, row, None)
+			self._seqs[id(change)] = (seq, change)
+			self.editor.add(change, fields)
+		return self._result()
+		
+	def flush(self):
+		self.editor.flush()
+		return self._result()
+		
+	def close(self):
+		self.editor.close()
+		return self._result()
+		
+	def _applyChange(self, change, fields):
+		started = time.time()
+		bApplied = self.importer._applyChange(self.dataset, change, fields)
+		timing = self._timings.setdefault(change.op, [0, 0.0])
+		timing[0] = timing[0] + 1
+		timing[1] = timing[1] + time.time() - started
+		return bApplied
+		
+	def _result(self):
+		committed = [self._seqs.pop(id(change))[0] for change in self.editor.committed]
+		failed = [(self._seqs.pop(id(change))[0], change.error) for change, fields in self.editor.failed]
+		self.editor.committed = []
+		self.editor.failed = []
+		result = {'committed':committed, 'failed':failed, 'numCommits':self.editor.numCommits, 'numRollbacks':self.editor.numRollbacks, 'commitSeconds':self.editor.commitSeconds, 'timings':self._timings}
+		self._timings = dict()
+		return result
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	SdeSink
+# purpose:	The geodatabase as a sink.Sink: writes a batch of changes with arcpy cursors in
+#			SdeEditor edit sessions of editBatchSize changes.
+#
+# notes:	DatasetImport writes to this sink with its own editors, which stream the changes,
+#			shard them and write them with set-based SQL, see _openEditor. apply() is for the
+#			callers that have a batch.
+#
+###################################################################################################
+
+class SdeSink(sink.Sink):
+	#importer: The SqlServerImporter whose _applyChange writes a change
+	def __init__(self, importer, name = 'sde'):
+		sink.Sink.__init__(self, name)
+		self.importer = importer
+		return
+		
+	def apply(self, dataset, inserts, updates, deletes):
+		replica = dataset.replica
+		editor = SdeEditor(replica.stagingWorkspace, lambda change, fields: self.importer._applyChange(dataset, change, fields), replica.editBatchSize, replica.editBatchSeconds)
+		for change, fields in deletes + updates + inserts:
+			editor.add(change, fields)
+		editor.close()
+		return editor.failed
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	SinkEditor
+# purpose:	Writes the changes of a dataset to a sink.Sink in batches of maxRows changes or
+#			maxSeconds seconds, split into inserts, updates and deletes.
+#
+# notes:	Has the interface of SdeEditor. A change whose key is already in the batch writes the
+#			batch first, so the changes of a key are still written in CDC order.
+#
+###################################################################################################
+
+class SinkEditor(object):
+	#sink:		The sink.Sink
+	#dataset:	The db.Dataset whose changes are written
+	#maxRows, maxSeconds, sizer: see SdeEditor
+	def __init__(self, sink, dataset, maxRows, maxSeconds, sizer = None):
+		self.sink = sink
+		self.dataset = dataset
+		self.committed = []
+		self.failed = []
+		self.numCommits = 0
+		self.numRollbacks = 0
+		self.commitSeconds = 0.0
+		self._maxRows = max(1, maxRows)
+		self._maxSeconds = maxSeconds
+		self._sizer = sizer
+		self._pending = []
+		self._keys = set()
+		self._started = None
+		return
+		
+	def add(self, change, fields):
+		if change.op == "skip":
+			self.committed.append(change)
+			return
+		if change.key in self._keys:
+			self.flush()
+		if len(self._pending) == 0:
+			self._started = time.time()
+		self._pending.append((change, fields))
+		self._keys.add(change.key)
+		if len(self._pending) >= self._maxRows or time.time() - self._started >= self._maxSeconds:
+			self.flush()
+		return
+		
+	def flush(self):
+		if len(self._pending) == 0:
+			return
+		pending = self._pending
+		self._pending = []
+		self._keys = set()
+		batch = {'insert':[], 'update':[], 'delete':[]}
+		for change, fields in pending:
+			batch[change.op].append((change, fields))
+		started = time.time()
+		with profiling.stage('commit'):
+			failed = self.sink.apply(self.dataset, batch['insert'], batch['update'], batch['delete'])
+		seconds = time.time() - started
+		if len(failed) < len(pending):
+			self.numCommits = self.numCommits + 1
+		if len(failed) > 0:
+			self.numRollbacks = self.numRollbacks + 1
+		self.commitSeconds = self.commitSeconds + seconds
+		failedChanges = set([id(change) for change, fields in failed])
+		for change, fields in pending:
+			if id(change) in failedChanges:
+				self.failed.append((change, fields))
+			else:
+				self.committed.append(change)
+		if self._sizer is not None:
+			self._maxRows = self._sizer.observe(len(pending), time.time() - self._started, seconds)
+		return
+		
+	def close(self):
+		self.flush()
+		return
+		
+###################################################################################################
+###################################################################################################
+#
+# class:	FanOutEditor
+# purpose:	Writes the changes that were read once from CDC to several sinks at the same time.
+#			Every sink has an editor of its own on a thread of its own, see _Outlet, and keeps
+#			a watermark in a checkpoint.Watermarks: the position of the last CDC block whose
+#			changes it saved, and the CDC keys of the changes it could not save.
+#
+# notes:	Has the interface of SdeEditor, with position, the ChangeBatch.position of the block
+#			whose changes are added, and mark(position), which is called after the changes of a
+#			block were added and saves them in every sink. A sink is only given the blocks that
+#			end after its watermark of the previous run and the changes it has to retry, the
+#			others it already saved. A block that starts before the watermark is given whole, its
+#			changes are written again in CDC order. Positions are compared in the order of the
+#			CDC query, __$start_lsn first, because __$seqval doesn't grow across transactions
+#			that commit in another order.
+#
+#			The changes of a db.TableChangeSource have made up positions that start again on
+#			every read, so they are given to every sink and have no watermarks. Its changes are
+#			found again on the next run until every sink saved them.
+#
+#			A change is in committed when every sink has it, so its CDC
+#			records are only cleared below the watermarks of all sinks, and in failed when a sink
+#			could not save it or an earlier change of its key. committed, failed and the counts
+#			are complete after close.
+#
+###################################################################################################
+
+class FanOutEditor(object):
+	#name:			Name of the threads
+	#dataset:		The db.Dataset whose changes are written
+	#editors:		List of (sink, editor) of the sinks and the editors that write to them
+	#watermarks:	checkpoint.Watermarks of the sinks
+	#size:			Number of changes that may wait for the editor of a sink
+	#unsaved:		Dictionary of sink name to the keys of which a sink could not save a change in
+	#				the earlier passes, updated on close
+	def __init__(self, name, dataset, editors, watermarks, size, unsaved = None):
+		self.dataset = dataset
+		self.watermarks = watermarks
+		self.unsaved = unsaved
+		if self.unsaved is None:
+			self.unsaved = dict()
+		self.outlets = []
+		self.committed = []
+		self.failed = []
+		self.position = None
+		self._changes = []
+		self._closed = False
+		#Without CDC there are no positions that last from one run to the next.
+		self._tracked = dataset.changeSource is None
+		for target, editor in editors:
+			if self._tracked:
+				outlet = _Outlet(target, editor, watermarks.getPosition(target.name, dataset), watermarks.getRetries(target.name, dataset), max(1, size))
+			else:
+				outlet = _Outlet(target, editor, None, set(), max(1, size))
+			thread = threading.Thread(target = self._run, args = (outlet,), name = name + ':' + target.name)
+			thread.daemon = True
+			outlet.thread = thread
+			self.outlets.append(outlet)
+			thread.start()
+		return
+		
+	def _sum(self, name):
+		return sum([getattr(outlet.editor, name) for outlet in self.outlets])
+		
+	numCommits = property(lambda self: self._sum('numCommits'))
+	numRollbacks = property(lambda self: self._sum('numRollbacks'))
+	commitSeconds = property(lambda self: self._sum('commitSeconds'))
+		
+	########################################################################
+	# Passes a change to the sinks that don't have the block of position yet, waits while their
+	# queues are full.
+	def add(self, change, fields):
+		outlets = [outlet for outlet in self.outlets if outlet.needs(change, self.position)]
+		self._changes.append((change, fields, outlets))
+		for outlet in outlets:
+			outlet.queue.put((change, fields))
+		return
+		
+	########################################################################
+	# Saves the changes that were added in every sink, and moves the watermark of a sink to
+	# position once they are saved.
+	def mark(self, position):
+		if not self._tracked:
+			position = None
+		for outlet in self.outlets:
+			outlet.queue.put((_MARK, position))
+		return
+		
+	def flush(self):
+		if self._closed:
+			return
+		for outlet in self.outlets:
+			outlet.queue.put(_FLUSH)
+		for outlet in self.outlets:
+			outlet.queue.join()
+		return
+		
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		for outlet in self.outlets:
+			outlet.queue.put(_CLOSE)
+		for outlet in self.outlets:
+			outlet.thread.join()
+		results = []
+		for outlet in self.outlets:
+			committed = set([id(change) for change in outlet.editor.committed])
+			failed = dict([(id(change), change.error) for change, fields in outlet.editor.failed])
+			results.append((outlet, committed, failed, self.unsaved.setdefault(outlet.sink.name, set()), [], []))
+		for change, fields, outlets in self._changes:
+			errors = []
+			for outlet, committed, failed, keys, saved, retries in results:
+				if not outlet in outlets:
+					continue
+				if id(change) in committed and not change.key in keys:
+					saved.extend(change.cdcKeys)
+					continue
+				#The later changes of a key are retried with the one that was not saved, so the
+				#retry doesn't undo them. A change that the editor lost to an error is not in failed.
+				keys.add(change.key)
+				retries.extend(change.cdcKeys)
+				if id(change) in committed:
+					errors.append(outlet.sink.name + ': an earlier change of the key was not saved')
+				else:
+					errors.append(outlet.sink.name + ': ' + str(failed.get(id(change)) or 'not saved'))
+			if len(errors) > 0:
+				change.error = '; '.join(errors)
+				self.failed.append((change, fields))
+			else:
+				self.committed.append(change)
+		for outlet, committed, failed, keys, saved, retries in results:
+			if self._tracked:
+				self.watermarks.update(outlet.sink.name, self.dataset, outlet.position, saved, retries)
+		self._changes = []
+		return
+		
+	def _run(self, outlet):
+		with profiling.stage('apply'):
+			while True:
+				item = outlet.queue.get()
+				started = time.time()
+				try:
+					if item is _CLOSE:
+						outlet.editor.close()
+						return
+					elif item is _FLUSH:
+						outlet.editor.flush()
+					elif item[0] is _MARK:
+						outlet.editor.flush()
+						if item[1] is not None:
+							outlet.position = item[1]
+					else:
+						outlet.editor.add(item[0], item[1])
+						outlet.numChanges = outlet.numChanges + 1
+				except:
+					tb = sys.exc_info()[2]
+					tbinfo = traceback.format_tb(tb)[0]
+					msg = "Error in FanOutEditor._run:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+					logging.error(msg)
+				finally:
+					outlet.seconds = outlet.seconds + time.time() - started
+					outlet.queue.task_done()
+		
+#Queue item that makes an outlet save its edits and move its watermark.
+_MARK = object()
+
+class _Outlet(object):
+	#sink:		The sink.Sink
+	#editor:	The editor that writes to the sink
+	#position:	Watermark of the sink after the previous run, or None
+	#retries:	CDC keys of the changes that the sink could not save in the previous runs
+	def __init__(self, sink, editor, position, retries, size):
+		self.sink = sink
+		self.editor = editor
+		self.position = position
+		self.retries = retries
+		self.queue = Queue.Queue(size)
+		self.thread = None
+		self.numChanges = 0
+		self.seconds = 0.0
+		self._watermark = position
+		return
+		
+	########################################################################
+	# Returns True if the sink doesn't have the change yet.
+	# position: ChangeBatch.position of the block of the change, None when it isn't read from CDC
+	def needs(self, change, position):
+		if self._watermark is None or position is None or position > self._watermark:
+			return True
+		for cdcKey in change.cdcKeys:
+			if cdcKey in self.retries:
+				return True
+		return False
+		
+########################################################################
+# Returns the sink.Sink objects of a replica, see the sink and sinks options of db.Replica.
+def openSinks(importer, replica):
+	sinks = []
+	for config in replica.sinks:
+		name = config.get('name', config['type'])
+		if config['type'] == 'sde':
+			sinks.append(SdeSink(importer, name))
+		elif config['type'] in ['sqlite', 'geopackage']:
+			target = sink.SqliteSink(config['path'], config['type'] == 'geopackage', config.get('srid', 0))
+			target.name = name
+			sinks.append(target)
+		else:
+			raise ValueError(replica.name + ': unknown sink ' + str(config['type']))
+	if len(sinks) == 0:
+		sinks.append(SdeSink(importer))
+	return sinks
+	
 ###################################################################################################
 ###################################################################################################
 #
@@ -485,11 +2653,20 @@ class SqlServerImporter(object):
 
 class GeodatabaseExporter(object):
 
-	#replicas:	A db.Replicas object.
-	def __init__(self, replicas):
+	#replicas:		A db.Replicas object.
+	#maxParallel:	Maximum number of replicas that are exported at the same time.
+	#reportPath:	Optional folder to which a JSON run report is written.
+	def __init__(self, replicas, maxParallel = 1, reportPath = None):
 		self._replicas = replicas
+		self._maxParallel = maxParallel
+		self._reportPath = reportPath
 		self._dbutil = util.DBUtil()
+		self.report = report.RunReport('export')
 		
+	########################################################################
+	# Exports all replicas. Replicas that don't share a production workspace or lock file
+	# are exported at the same time, up to maxParallel, each group in a worker process like
+	# SqlServerImporter.run. Returns the report.RunReport of the run.
 	def run(self):
 		func = 'GeodatabaseExporter.run'
 		logging.info(" ")
@@ -497,66 +2674,143 @@ class GeodatabaseExporter(object):
 		logging.info("******************************************************************************")
 		logging.info("Begin " + func)
 		
-		for replica in self._replicas.replicas:
-			self.processReplica(replica)
+		self.report = report.RunReport('export')
+		groups = self._replicas.getGroups()
+		tasks = []
+		for group in groups:
+			name = ', '.join([r.name for r in group])
+			if self._maxParallel > 1 and len(groups) > 1:
+				args = ([r.config for r in group],)
+				tasks.append((name, lambda name = name, args = args: self._loadReports(processes.run('export ' + name, _exportGroup, args))))
+			else:
+				tasks.append((name, lambda group = group: self._processGroup(group)))
+		pipeline.TaskPool('replicas', self._maxParallel).run(tasks)
+		self.report.finish()
+		self.report.log()
+		if self._reportPath is not None:
+			self.report.write(self._reportPath)
 			
 		logging.info("End " + func)
 		logging.info("******************************************************************************")
+		return self.report
+		
+	def _processGroup(self, replicas):
+		for replica in replicas:
+			self.processReplica(replica)
+		return
+		
+	#values: List of ReplicaReport.toDict() of the replicas that a worker processed
+	def _loadReports(self, values):
+		for replicaValues in values:
+			self.report.replica(replicaValues['name']).load(replicaValues)
 		return
 		
 	def processReplica(self, replica):
 		func = 'GeodatabaseExporter.processReplica'
 		logging.info("Begin " + func)
 		logging.info("Processing " + replica.name)
+		replicaReport = self.report.replica(replica.name)
+		replicaReport.start()
+		replica.queryStats.reset()
+		replicaReport.queries = replica.queryStats
+		
+		lockfile = util.LockFile(replica.lockFilePath)
+		if not lockfile.lock():
+			logging.error(replica.name + " is already running")
+			logging.info('If %s is not running, then delete the file %s', replica.name, replica.lockFilePath)
+			logging.info("End " + func)
+			replicaReport.finish('locked')
+			return
+		try:
+			replicaReport.finish(self._exportReplica(replica, replicaReport))
+		finally:
+			lockfile.unlock()
+		logging.info("End " + func)
+		return
 		
+	def _exportReplica(self, replica, replicaReport):
 		ts = strftime("%m%d%Y_%H%M%S")
 		tempFile = replica.tempPath + '\\temp_' + ts + '.xml'
 		exportFile = replica.exportPath + '\\changes_' + ts + '.xml'
 		
 		if replica.autoReconcile == True:
 			logging.info('Reconciling edits from edit versions to default in staging')
-			self._reconcileStaging(replica)
+			started = time.time()
+			with profiling.stage('reconcile'):
+				self._reconcileStaging(replica)
+			replicaReport.addTime('reconcile', time.time() - started)
 			
 		logging.info("Exporting XML change file for " + replica.name)
-		if self._exportChangeFile(replica, tempFile) == False:
+		started = time.time()
+		with profiling.stage('export'):
+			exported = self._exportChangeFile(replica, tempFile)
+		if exported == False:
 			msg = 'Failed to create XML change file. Make sure that you have sufficient permissions in ' + replica.tempPath
 			arcpy.AddError(msg)
 			logging.error(msg)
 			logging.error("Export change file failed. Sync will not run.")
 			logging.info("******************************************************************************")
-			return
+			return 'failed'
+		replicaReport.addTime('export', time.time() - started)
 			
 		logging.info("Synchronizing changes in Staging Default SDE with Production SDE")
+		started = time.time()
 		if self._syncWithProd(replica) == False:
 			logging.error("Failed to sync with prod. Sync will not run.")
 			logging.info("******************************************************************************")
-			return False
+			return 'failed'
+		replicaReport.addTime('sync', time.time() - started)
 			
 		arcpy.AddMessage("Sending XML change file to BG-BASE folder queue")
 		if self._sendChangeFile(replica, tempFile, exportFile) == False:
 			msg = 'Failed to copy XML change file to folder queue. Make sure that you have sufficient permissions in ' + replica.exportPath
 			logging.error(msg)
 			arcpy.AddError(msg)
-			
-		logging.info("End " + func)
-		return
+			return 'not sent'
+		return 'exported'
 		
 	def _reconcileStaging(self, replica):
 		func = 'GeodatabaseExporter._reconcileStaging'
 		logging.info("Begin " + func)
+		timings = self.report.replica(replica.name).section('reconcile')
 		
 		try:
-			logging.debug('Getting edits versions')
-			versions = replica.stagingEditVersions
-			if len(versions) > 0:
-				logging.debug('Found ' + str(len(versions)) + ' edit versions to reconcile.')
-				logging.debug("Reconciling data with Staging DEFAULT")
-				arcpy.ReconcileVersions_management(replica.stagingWorkspace, "ALL_VERSIONS", replica.stagingDefaultVersion, ";".join(versions), "NO_LOCK_ACQUIRED", "NO_ABORT", "BY_OBJECT", "FAVOR_TARGET_VERSION", "POST", "KEEP_VERSION")
-				logging.debug("Finished reconciling data with Staging DEFAULT")
+			if replica.stagingRepository is not None:
+				replica.connect()
+			planner = versions.ReconcilePlanner(replica)
+			changed, idle = planner.plan()
+			for state in idle:
+				logging.debug(state.name + ' has not changed since it was last reconciled')
+				timings.append({'version':state.name, 'stateId':state.stateId, 'modified':state.modified, 'status':'idle', 'seconds':0.0})
 			
-			logging.debug("Compressing data in Staging SDE")
-			arcpy.Compress_management(replica.stagingWorkspace)
-			logging.debug("Finished compressing data in Staging SDE")
+			reconciled = []
+			if len(changed) > 0:
+				logging.debug('Found ' + str(len(changed)) + ' edit versions to reconcile.')
+			for state in changed:
+				started = time.time()
+				status = 'reconciled'
+				try:
+					logging.debug("Reconciling " + state.name + " with Staging DEFAULT")
+					arcpy.ReconcileVersions_management(replica.stagingWorkspace, "ALL_VERSIONS", replica.stagingDefaultVersion, state.name, "NO_LOCK_ACQUIRED", "NO_ABORT", "BY_OBJECT", "FAVOR_TARGET_VERSION", "POST", "KEEP_VERSION")
+					reconciled.append(state.name)
+				except arcpy.ExecuteError:
+					status = 'failed'
+					msgs = arcpy.GetMessages(2)
+					arcpy.AddError(msgs)
+					logging.error("ArcGIS error reconciling %s: %s", state.name, msgs)
+				seconds = time.time() - started
+				logging.debug("Finished reconciling " + state.name + " in " + ('%.1f' % seconds) + "s")
+				timings.append({'version':state.name, 'stateId':state.stateId, 'modified':state.modified, 'status':status, 'seconds':round(seconds, 3)})
+			
+			if len(reconciled) > 0:
+				logging.debug("Compressing data in Staging SDE")
+				started = time.time()
+				arcpy.Compress_management(replica.stagingWorkspace)
+				timings.append({'version':'compress', 'status':'compressed', 'seconds':round(time.time() - started, 3)})
+				logging.debug("Finished compressing data in Staging SDE")
+				planner.save(reconciled)
+			else:
+				logging.info("No edit versions changed since the last run. Staging will not be reconciled or compressed")
 		except arcpy.ExecuteError:
 			msgs = arcpy.GetMessages(2)
 			arcpy.AddError(msgs)
@@ -567,6 +2821,8 @@ class GeodatabaseExporter(object):
 			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 			arcpy.AddError(msg)
 			logging.error(msg)
+		finally:
+			replica.closeConnection()
 		logging.info("End " + func)
 		return
 		
@@ -596,13 +2852,14 @@ class GeodatabaseExporter(object):
 		func = 'GeodatabaseExporter._syncWithProd'
 		logging.info("Begin " + func)
 		try:
-			logging.debug("Synchronizing data from staging to production")
-			arcpy.SynchronizeChanges_management(replica.stagingWorkspace, replica.name, replica.productionWorkspace, "FROM_GEODATABASE1_TO_2", "IN_FAVOR_OF_GDB1", "BY_OBJECT", "DO_NOT_RECONCILE")
-			logging.debug("Finished synchronizing data from production to staging")
-			
-			logging.debug("Compressing data in Production SDE")
-			arcpy.Compress_management(replica.productionWorkspace)
-			logging.debug("Finished compressing data in Production SDE")
+			with profiling.stage('sync'):
+				logging.debug("Synchronizing data from staging to production")
+				arcpy.SynchronizeChanges_management(replica.stagingWorkspace, replica.name, replica.productionWorkspace, "FROM_GEODATABASE1_TO_2", "IN_FAVOR_OF_GDB1", "BY_OBJECT", "DO_NOT_RECONCILE")
+				logging.debug("Finished synchronizing data from production to staging")
+				
+				logging.debug("Compressing data in Production SDE")
+				arcpy.Compress_management(replica.productionWorkspace)
+				logging.debug("Finished compressing data in Production SDE")
 			return True
 		except arcpy.ExecuteError:
 			msgs = arcpy.GetMessages(2)
@@ -665,6 +2922,14 @@ class GeodatabaseExporter(object):
 		logging.info("End " + func)
 		return result
 
+########################################################################
+# Exports a group of replicas in a worker process, see GeodatabaseExporter.run.
+# returns the ReplicaReport.toDict() of the replicas
+def _exportGroup(configs):
+	exporter = GeodatabaseExporter(db.Replicas(configs))
+	exporter._processGroup(exporter._replicas.replicas)
+	return [values.toDict() for values in exporter.report.replicas.values()]
+	
 """
 DECLARE @begin_time datetime, @end_time datetime, @begin_lsn binary(10), @end_lsn binary(10);
 SET @begin_time = '2000-01-01 00:00:00'
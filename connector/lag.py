@@ -0,0 +1,216 @@
+import os, sys, traceback, logging
+import json, time, threading
+from collections import OrderedDict
+from time import strftime
+
+#Stages after which the lag of the CDC records is measured.
+_STAGES = ['read', 'apply', 'sync']
+
+#Percentiles of the lag that are reported.
+_PERCENTILES = [('p50', 0.5), ('p95', 0.95)]
+
+###################################################################################################
+###################################################################################################
+#
+# class:	lag.LagTracker
+# purpose:	Measures the replication lag of a replica, the seconds from the commit of a change
+#			in Warehouse until the import read it, saved it in staging and synchronized it to
+#			production. The commit times of the __$start_lsn of a batch are read with one query,
+#			see db.Replica.getCommitAges, and every LSN is weighted by its number of CDC records.
+#			finish adds the p50, p95 and max per dataset and stage to the run report and appends
+#			them to lag_<replica>.jsonl in the tempPath, one JSON object per line, from which the
+#			freshness can be charted over the runs.
+#
+# notes:	A batch is saved once the editor has saved or failed the changes that were added up
+#			to the batch. ShardedEditor and FanOutEditor only report their changes when they are
+#			closed, so their apply lag includes the wait until the end of the pass. Changes that
+#			are not read from CDC, e.g. of datasets with a changeSource, whose LSNs are made up,
+#			and the deletes that are held back for the DependencyScheduler are not measured.
+#
+#			When the lsn_time_mapping of a dataset can't be read, the lag of the dataset isn't
+#			measured for the rest of the run.
+#
+###################################################################################################
+
+class LagTracker(object):
+	#replica: The db.Replica whose lag is measured
+	def __init__(self, replica):
+		self.replica = replica
+		name = ''.join([c if c.isalnum() else '_' for c in replica.name])
+		self.path = os.path.join(replica.tempPath, 'lag_' + name + '.jsonl')
+		self._disabled = set()
+		self._datasets = OrderedDict()
+		self._lock = threading.Lock()
+		return
+
+	def __str__(self):
+		return self.path
+
+	########################################################################
+	# Reads the commit times of the records of a batch and measures their read lag.
+	#numAdded:	Number of changes added to the editor of the pass after the batch
+	#started:	time.time() at which the import got the batch
+	def read(self, dataset, batch, numAdded, started):
+		if dataset.changeSource is not None or dataset in self._disabled or len(batch.lsns) == 0:
+			return
+		lsns = sorted(batch.lsns)
+		ages = self.replica.getCommitAges(dataset.lsnTimeMapping, lsns[0], lsns[-1])
+		now = time.time()
+		if ages is None:
+			logging.warn(self.replica.name + ': could not read the commit times of the CDC records of ' + str(dataset) + ', its lag is not measured')
+			self._disabled.add(dataset)
+			return
+		commits = [(now - ages[lsn], numRecords) for lsn, numRecords in batch.lsns.items() if lsn in ages]
+		with self._lock:
+			entry = self._getDataset(dataset)
+			entry.add('read', commits, started)
+			entry.pending.append((numAdded, commits))
+		return
+
+	########################################################################
+	# Measures the apply lag of the batches whose changes were saved.
+	#numSaved:	Number of changes that the editor of the pass saved or failed, None when the pass is closed
+	def applied(self, dataset, numSaved = None):
+		with self._lock:
+			entry = self._datasets.get(dataset)
+			if entry is None:
+				return
+			now = time.time()
+			while len(entry.pending) > 0 and (numSaved is None or entry.pending[0][0] <= numSaved):
+				numAdded, commits = entry.pending.pop(0)
+				entry.add('apply', commits, now)
+				entry.applied.extend(commits)
+		return
+
+	########################################################################
+	# Measures the sync lag of the batches that were saved, called when production is synchronized.
+	def synced(self):
+		with self._lock:
+			now = time.time()
+			for entry in self._datasets.values():
+				entry.add('sync', entry.applied, now)
+				entry.applied = []
+		return
+
+	########################################################################
+	# Returns the samples of a dataset and its lag that is not synchronized yet, or None, so that
+	# a worker process can pass them to the tracker of the replica, see addSamples.
+	def getSamples(self, dataset):
+		with self._lock:
+			entry = self._datasets.get(dataset)
+			if entry is None:
+				return None
+			return (entry.samples, entry.applied)
+
+	def addSamples(self, dataset, values):
+		samples, applied = values
+		with self._lock:
+			entry = self._getDataset(dataset)
+			for stage in samples:
+				entry.samples[stage].extend(samples[stage])
+			entry.applied.extend(applied)
+		return
+
+	########################################################################
+	# Adds the lag per dataset and stage to the run report, and to lag_<replica>.jsonl.
+	def finish(self, replicaReport):
+		func = 'LagTracker.finish'
+		if len(self._datasets) == 0:
+			return
+		try:
+			totals = _DatasetLag(None)
+			metrics = []
+			for entry in self._datasets.values():
+				stages = [stage for stage in _STAGES if len(entry.samples[stage]) > 0]
+				if len(stages) == 0:
+					continue
+				values = replicaReport.dataset(str(entry.dataset))
+				values['lag'] = OrderedDict()
+				for stage in stages:
+					totals.samples[stage].extend(entry.samples[stage])
+					summary = self._summarize(entry.samples[stage])
+					values['lag'][stage] = summary
+					metrics.append(self._metric(str(entry.dataset), stage, summary))
+				self._checkFreshness(str(entry.dataset), stages[-1], entry.samples[stages[-1]])
+			section = replicaReport.section('lag')
+			for stage in _STAGES:
+				if len(totals.samples[stage]) > 0:
+					summary = self._summarize(totals.samples[stage])
+					section.append(OrderedDict([('stage', stage)] + summary.items()))
+					metrics.append(self._metric(None, stage, summary))
+			with open(self.path, 'a') as f:
+				for metric in metrics:
+					f.write(json.dumps(metric) + '\n')
+			logging.debug('Wrote ' + str(len(metrics)) + ' lag metrics to ' + self.path)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+
+	def _getDataset(self, dataset):
+		entry = self._datasets.get(dataset)
+		if entry is None:
+			entry = _DatasetLag(dataset)
+			self._datasets[dataset] = entry
+		return entry
+
+	def _summarize(self, samples):
+		samples = sorted(samples)
+		total = sum([weight for lag, weight in samples])
+		summary = OrderedDict()
+		summary['records'] = total
+		for name, fraction in _PERCENTILES:
+			summary[name] = round(_percentile(samples, total, fraction), 1)
+		summary['max'] = round(samples[-1][0], 1)
+		if self.replica.freshnessSeconds is not None:
+			summary['overTarget'] = sum([weight for lag, weight in samples if lag > self.replica.freshnessSeconds])
+		return summary
+
+	def _metric(self, dataset, stage, summary):
+		metric = OrderedDict()
+		metric['time'] = strftime('%Y-%m-%d %H:%M:%S')
+		metric['replica'] = self.replica.name
+		metric['dataset'] = dataset
+		metric['stage'] = stage
+		metric.update(summary)
+		if self.replica.freshnessSeconds is not None:
+			metric['freshnessSeconds'] = self.replica.freshnessSeconds
+		return metric
+
+	########################################################################
+	# Logs a warning when the p95 of the last stage of a dataset is above freshnessSeconds.
+	def _checkFreshness(self, name, stage, samples):
+		if self.replica.freshnessSeconds is None:
+			return
+		samples = sorted(samples)
+		p95 = _percentile(samples, sum([weight for lag, weight in samples]), 0.95)
+		if p95 > self.replica.freshnessSeconds:
+			logging.warn(self.replica.name + ': ' + name + ' is behind, the ' + stage + ' lag p95 of ' + ('%.0f' % p95) + 's is above freshnessSeconds ' + str(self.replica.freshnessSeconds))
+		return
+
+class _DatasetLag(object):
+	def __init__(self, dataset):
+		self.dataset = dataset
+		self.samples = dict((stage, []) for stage in _STAGES)
+		self.pending = []
+		self.applied = []
+		return
+
+	#commits: List of (commit time, number of records)
+	#finished: time.time() at which the stage finished
+	def add(self, stage, commits, finished):
+		self.samples[stage].extend([(max(0.0, finished - committed), numRecords) for committed, numRecords in commits])
+		return
+
+########################################################################
+# Returns the lag below which fraction of the records are.
+# samples: Sorted list of (lag, number of records)
+def _percentile(samples, total, fraction):
+	count = 0
+	for lag, weight in samples:
+		count = count + weight
+		if count >= fraction * total:
+			return lag
+	return samples[-1][0]
@@ -0,0 +1,300 @@
+import os, sys, traceback, logging
+import re, time, threading
+from collections import OrderedDict
+from time import strftime
+
+#Number of rows fetched at once when a cursor is iterated.
+_ITERATION_BLOCK_SIZE = 1000
+
+#Number of characters of a statement that are written to the slow-query log.
+_MAX_SQL_LENGTH = 2000
+
+#String, binary and number literals, replaced by ? in the fingerprint of a statement.
+_LITERALS = re.compile(r"N?'(?:[^']|'')*'|\b0x[0-9A-Fa-f]*\b|\b\d+(?:\.\d+)?\b")
+#Lists of values, e.g. the __$seqval list of a CDC delete, replaced by (?).
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+#Slow-query logs can be shared by replicas that run at the same time.
+_logLock = threading.Lock()
+
+########################################################################
+# Returns the statement without its literals and with collapsed whitespace, so that the
+# executions of the same statement with different values are counted together.
+def fingerprint(sql):
+	sql = _LITERALS.sub('?', sql)
+	sql = _LISTS.sub('(?)', sql)
+	return _SPACES.sub(' ', sql).strip()
+
+###################################################################################################
+###################################################################################################
+#
+# class:	odbc.QueryStats
+# purpose:	Collects the executions of the statements of a replica or a tool by fingerprint: the
+#			number of calls, the time spent executing and fetching, and the rows and bytes
+#			fetched or affected. Executions that take longer than slowSeconds are written to
+#			the log and appended to the slow-query log.
+#
+# notes:	The bytes of a row are estimated from the lengths of its string and binary values,
+#			other values count as 8 bytes.
+#
+###################################################################################################
+
+class QueryStats(object):
+	#name:			Name written to the slow-query log, e.g. the name of the replica
+	#slowSeconds:	Seconds above which an execution is slow, or None
+	#slowLogPath:	File to which the slow executions are appended, or None to only log them
+	def __init__(self, name, slowSeconds = None, slowLogPath = None):
+		self.name = name
+		self.slowSeconds = slowSeconds
+		self.slowLogPath = slowLogPath
+		self.statements = OrderedDict()
+		self.numSlow = 0
+		self._lock = threading.Lock()
+		return
+
+	def __str__(self):
+		return self.name
+
+	def reset(self):
+		with self._lock:
+			self.statements = OrderedDict()
+			self.numSlow = 0
+		return
+
+	########################################################################
+	# Adds an execution to the statistics of its statement.
+	def record(self, execution):
+		key = fingerprint(execution.sql)
+		seconds = execution.executeSeconds + execution.fetchSeconds
+		with self._lock:
+			statement = self.statements.get(key)
+			if statement is None:
+				statement = _Statement(key)
+				self.statements[key] = statement
+			statement.add(execution, seconds)
+			slow = self.slowSeconds is not None and seconds >= self.slowSeconds
+			if slow:
+				self.numSlow = self.numSlow + 1
+		if slow:
+			self._logSlow(execution, seconds)
+		return
+
+	########################################################################
+	# Returns the statistics of the statements as dictionaries, the most time consuming first.
+	def toList(self):
+		with self._lock:
+			statements = sorted(self.statements.values(), key = lambda s: s.seconds, reverse = True)
+			return [statement.toDict() for statement in statements]
+
+	########################################################################
+	# Writes the n most time consuming statements to the log.
+	def log(self, n = 5):
+		for statement in self.toList()[:n]:
+			logging.debug('\t\t' + ('%.1f' % statement['seconds']) + 's in ' + str(statement['calls']) + ' calls, ' + str(statement['rows']) + ' rows: ' + statement['sql'][:200])
+		return
+
+	def _logSlow(self, execution, seconds):
+		func = 'QueryStats._logSlow'
+		sql = _SPACES.sub(' ', execution.sql).strip()[:_MAX_SQL_LENGTH]
+		logging.warn('Slow query on ' + self.name + ' (' + ('%.1f' % seconds) + 's, ' + str(execution.rows) + ' rows): ' + sql[:200])
+		if self.slowLogPath is None:
+			return
+		try:
+			line = '\t'.join([strftime('%Y-%m-%d %H:%M:%S'), self.name, '%.3f' % seconds, '%.3f' % execution.executeSeconds, str(execution.rows), str(execution.bytes), sql])
+			with _logLock:
+				with open(self.slowLogPath, 'a') as f:
+					f.write(line.encode('utf-8') if isinstance(line, unicode) else line)
+					f.write('\n')
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+
+class _Statement(object):
+	__slots__ = ('sql', 'calls', 'errors', 'seconds', 'executeSeconds', 'fetchSeconds', 'maxSeconds', 'rows', 'bytes')
+
+	def __init__(self, sql):
+		self.sql = sql
+		self.calls = 0
+		self.errors = 0
+		self.seconds = 0.0
+		self.executeSeconds = 0.0
+		self.fetchSeconds = 0.0
+		self.maxSeconds = 0.0
+		self.rows = 0
+		self.bytes = 0
+		return
+
+	def add(self, execution, seconds):
+		self.calls = self.calls + 1
+		if execution.failed:
+			self.errors = self.errors + 1
+		self.seconds = self.seconds + seconds
+		self.executeSeconds = self.executeSeconds + execution.executeSeconds
+		self.fetchSeconds = self.fetchSeconds + execution.fetchSeconds
+		self.maxSeconds = max(self.maxSeconds, seconds)
+		self.rows = self.rows + execution.rows
+		self.bytes = self.bytes + execution.bytes
+		return
+
+	def toDict(self):
+		d = OrderedDict()
+		d['sql'] = self.sql
+		d['calls'] = self.calls
+		d['errors'] = self.errors
+		d['seconds'] = round(self.seconds, 3)
+		d['executeSeconds'] = round(self.executeSeconds, 3)
+		d['fetchSeconds'] = round(self.fetchSeconds, 3)
+		d['maxSeconds'] = round(self.maxSeconds, 3)
+		d['rows'] = self.rows
+		d['bytes'] = self.bytes
+		return d
+
+class _Execution(object):
+	__slots__ = ('sql', 'executeSeconds', 'fetchSeconds', 'rows', 'bytes', 'failed')
+
+	def __init__(self, sql):
+		self.sql = sql
+		self.executeSeconds = 0.0
+		self.fetchSeconds = 0.0
+		self.rows = 0
+		self.bytes = 0
+		self.failed = False
+		return
+
+###################################################################################################
+###################################################################################################
+#
+# class:	odbc.InstrumentedConnection
+# purpose:	Wraps a pyodbc connection so that the statements of its cursors are recorded in a
+#			QueryStats. Everything else is passed to the connection.
+#
+###################################################################################################
+
+class InstrumentedConnection(object):
+	#connection:	The pyodbc connection
+	#stats:			QueryStats of the statements
+	def __init__(self, connection, stats):
+		self._connection = connection
+		self.stats = stats
+		return
+
+	def __getattr__(self, name):
+		return getattr(self._connection, name)
+
+	def cursor(self):
+		return InstrumentedCursor(self._connection.cursor(), self.stats)
+
+	def execute(self, sql, *params):
+		return self.cursor().execute(sql, *params)
+
+###################################################################################################
+###################################################################################################
+#
+# class:	odbc.InstrumentedCursor
+# purpose:	Wraps a pyodbc cursor and times its statements. An execution lasts from execute()
+#			until its rows are fetched, the next statement is executed or the cursor is closed,
+#			so the time includes reading the rows.
+#
+# notes:	The rows of statements without a result set are the rows they affected.
+#
+###################################################################################################
+
+class InstrumentedCursor(object):
+	#cursor:	The pyodbc cursor
+	#stats:		QueryStats of the statements
+	def __init__(self, cursor, stats):
+		self._cursor = cursor
+		self._stats = stats
+		self._execution = None
+		return
+
+	def __getattr__(self, name):
+		return getattr(self._cursor, name)
+
+	def __iter__(self):
+		while True:
+			rows = self.fetchmany(_ITERATION_BLOCK_SIZE)
+			if not rows:
+				return
+			for row in rows:
+				yield row
+
+	def execute(self, sql, *params):
+		self._end()
+		execution = _Execution(sql)
+		self._execution = execution
+		started = time.time()
+		try:
+			self._cursor.execute(sql, *params)
+		except:
+			execution.executeSeconds = time.time() - started
+			execution.failed = True
+			self._end()
+			raise
+		execution.executeSeconds = time.time() - started
+		if getattr(self._cursor, 'description', None) is None:
+			execution.rows = max(0, getattr(self._cursor, 'rowcount', 0))
+			self._end()
+		return self
+
+	def fetchone(self):
+		started = time.time()
+		row = self._cursor.fetchone()
+		if row is None:
+			self._fetched([], started, True)
+		else:
+			self._fetched([row], started, False)
+		return row
+
+	def fetchmany(self, size):
+		started = time.time()
+		rows = self._cursor.fetchmany(size)
+		self._fetched(rows, started, len(rows) < size)
+		return rows
+
+	def fetchall(self):
+		started = time.time()
+		rows = self._cursor.fetchall()
+		self._fetched(rows, started, True)
+		return rows
+
+	def close(self):
+		self._end()
+		self._cursor.close()
+		return
+
+	def _fetched(self, rows, started, done):
+		execution = self._execution
+		if execution is None:
+			return
+		execution.fetchSeconds = execution.fetchSeconds + time.time() - started
+		execution.rows = execution.rows + len(rows)
+		for row in rows:
+			execution.bytes = execution.bytes + _rowBytes(row)
+		if done:
+			self._end()
+		return
+
+	def _end(self):
+		if self._execution is not None:
+			execution = self._execution
+			self._execution = None
+			self._stats.record(execution)
+		return
+
+def _rowBytes(row):
+	n = 0
+	for value in row:
+		if value is None:
+			continue
+		if isinstance(value, unicode):
+			n = n + 2 * len(value)
+		elif isinstance(value, (str, bytearray, buffer)):
+			n = n + len(value)
+		else:
+			n = n + 8
+	return n
@@ -0,0 +1,220 @@
+import sys, traceback, logging
+import threading, Queue
+import profiling
+
+#Marker put on a queue by a stage when it has no more work to pass on.
+_END = object()
+
+#Seconds a stage waits on a full or empty queue before checking for cancellation.
+_POLL_INTERVAL = 0.5
+
+class PipelineError(Exception):
+	pass
+
+class _Failure(object):
+	def __init__(self, stage, message):
+		self.stage = stage
+		self.message = message
+
+###################################################################################################
+###################################################################################################
+#
+# class:	pipeline.Pipeline
+# purpose:	Runs a chain of worker threads that are connected by bounded queues.
+#			The first stage is a source that produces work items, every following stage
+#			transforms the items of the stage before it, and the caller consumes the output
+#			of the last stage by iterating over the pipeline.
+#
+# notes:	A full queue blocks the stage that feeds it, so a slow consumer throttles the
+#			producers instead of letting blocks pile up in memory. Items are passed on in
+#			the order they were produced, and the consumer is a single thread, so changes
+#			to the same key are always applied in CDC order.
+#
+###################################################################################################
+
+class Pipeline(object):
+	#name:	Name used in log messages
+	#depth:	Maximum number of items waiting between two stages
+	def __init__(self, name, depth = 2):
+		self.name = name
+		self._depth = max(1, depth)
+		self._threads = []
+		self._output = None
+		self._cancelled = threading.Event()
+		return
+
+	def __str__(self):
+		return self.name
+
+	########################################################################
+	# Adds the producing stage. factory is called on the stage's own thread and must
+	# return an iterable of work items.
+	def addSource(self, name, factory):
+		output = Queue.Queue(self._depth)
+		self._addThread(name, self._runSource, (name, factory, output))
+		self._output = output
+		return
+
+	########################################################################
+	# Adds a stage that calls fn for every item of the previous stage. Items for which
+	# fn returns None are dropped.
+	def addStage(self, name, fn):
+		inbound = self._output
+		output = Queue.Queue(self._depth)
+		self._addThread(name, self._runStage, (name, fn, inbound, output))
+		self._output = output
+		return
+
+	def start(self):
+		logging.debug('Starting pipeline ' + self.name)
+		for thread in self._threads:
+			thread.start()
+		return
+
+	def cancel(self):
+		self._cancelled.set()
+		return
+
+	def cancelled(self):
+		return self._cancelled.is_set()
+
+	########################################################################
+	# Cancels any stage that is still running and waits for all threads to exit.
+	def close(self):
+		self.cancel()
+		for thread in self._threads:
+			if thread.is_alive():
+				thread.join()
+		return
+
+	def __iter__(self):
+		while True:
+			item = self._get(self._output)
+			if item is _END:
+				return
+			if isinstance(item, _Failure):
+				self.cancel()
+				raise PipelineError("Stage '" + item.stage + "' of " + self.name + " failed:\n" + item.message)
+			yield item
+
+	def _addThread(self, name, target, args):
+		thread = threading.Thread(target = target, args = args, name = self.name + ':' + name)
+		thread.daemon = True
+		self._threads.append(thread)
+		return
+
+	def _put(self, queue, item):
+		while not self._cancelled.is_set():
+			try:
+				queue.put(item, True, _POLL_INTERVAL)
+				return True
+			except Queue.Full:
+				continue
+		return False
+
+	def _get(self, queue):
+		while not self._cancelled.is_set():
+			try:
+				return queue.get(True, _POLL_INTERVAL)
+			except Queue.Empty:
+				continue
+		return _END
+
+	def _runSource(self, name, factory, output):
+		items = None
+		try:
+			with profiling.stage(name):
+				items = iter(factory())
+				for item in items:
+					if not self._put(output, item):
+						return
+				self._put(output, _END)
+		except:
+			self._put(output, _Failure(name, self._formatError()))
+		finally:
+			if items is not None and hasattr(items, 'close'):
+				items.close()
+		return
+
+	def _runStage(self, name, fn, inbound, output):
+		try:
+			with profiling.stage(name):
+				while True:
+					item = self._get(inbound)
+					if item is _END or isinstance(item, _Failure):
+						self._put(output, item)
+						return
+					result = fn(item)
+					if result is not None and not self._put(output, result):
+						return
+		except:
+			self._put(output, _Failure(name, self._formatError()))
+		return
+
+	def _formatError(self):
+		tb = sys.exc_info()[2]
+		tbinfo = ''.join(traceback.format_tb(tb))
+		return tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+
+###################################################################################################
+###################################################################################################
+#
+# class:	pipeline.TaskPool
+# purpose:	Runs independent tasks on a bounded number of worker threads and waits for all of
+#			them to finish. With a size of 1 the tasks run one after the other on the calling thread.
+#
+###################################################################################################
+
+class TaskPool(object):
+	#name:	Name used in log messages
+	#size:	Maximum number of tasks that run at the same time
+	def __init__(self, name, size = 1):
+		self.name = name
+		self.size = max(1, size)
+		return
+
+	########################################################################
+	# tasks: List of (name, function) tuples
+	# returns a dictionary of task name to the value returned by the function, or None if it failed
+	def run(self, tasks):
+		results = dict()
+		if self.size == 1 or len(tasks) < 2:
+			for name, fn in tasks:
+				results[name] = self._runTask(name, fn)
+			return results
+
+		pending = Queue.Queue()
+		for task in tasks:
+			pending.put(task)
+		lock = threading.Lock()
+
+		def work():
+			while True:
+				try:
+					name, fn = pending.get_nowait()
+				except Queue.Empty:
+					return
+				result = self._runTask(name, fn)
+				with lock:
+					results[name] = result
+
+		threads = []
+		for i in range(0, min(self.size, len(tasks))):
+			thread = threading.Thread(target = work, name = self.name + ':' + str(i))
+			thread.daemon = True
+			threads.append(thread)
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return results
+
+	def _runTask(self, name, fn):
+		try:
+			with profiling.stage(self.name):
+				return fn()
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in task " + name + " of " + self.name + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return None
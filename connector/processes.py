@@ -0,0 +1,230 @@
+import os, sys, traceback, logging
+import atexit, threading
+import multiprocessing
+import profiling
+
+#Workers that were started and not stopped yet, stopped when the parent exits.
+_workers = set()
+_workersLock = threading.Lock()
+
+class WorkerError(Exception):
+	pass
+
+###################################################################################################
+###################################################################################################
+#
+# class:	processes.Worker
+# purpose:	Builds an object in a process of its own and calls its methods from the parent.
+#			arcpy can't run edit sessions, SynchronizeChanges or Compress on several threads of
+#			one process at the same time, and edit sessions of one process share the workspace,
+#			so the work that runs in parallel and uses arcpy runs in workers. The threads of the
+#			parent only wait for them.
+#
+# notes:	factory is a module level function, so that it can be pickled, that builds the object
+#			from picklable arguments, e.g. the config of a replica. The arguments and results of
+#			the calls are pickled as well. An exception in the worker is raised in the parent as
+#			a WorkerError with the traceback of the worker.
+#
+#			The log records of a worker are sent to the parent over the pipe of the worker and
+#			written by the logging handlers of the parent, so that only the parent writes, and
+#			rotates, the log files. The parent handles them while it waits for a call.
+#
+#			When the run is profiled, every worker is profiled with a profiling.RunProfiler of
+#			its own, whose files are named after the profile of the parent, the name of the
+#			worker and its process id.
+#
+#			Workers aren't daemonic, so that a worker can start workers of its own, e.g. the
+#			shards of a dataset that is imported in a worker. stop() ends a worker, the workers
+#			that are left are stopped when the parent exits.
+#
+###################################################################################################
+
+class Worker(object):
+	#name:		Name of the process, used in log messages
+	#factory:	Module level function that returns the object, called with args in the worker
+	def __init__(self, name, factory, args = ()):
+		self.name = name
+		self._connection, child = multiprocessing.Pipe()
+		profile = None
+		profiler = profiling.getActive()
+		if profiler is not None:
+			profile = (profiler.name + '_' + ''.join([c if c.isalnum() else '_' for c in name]), profiler.path)
+		self._process = multiprocessing.Process(target = _serve, args = (child, factory, args, logging.getLogger('').level, profile), name = name)
+		self._process.start()
+		child.close()
+		with _workersLock:
+			_workers.add(self)
+		try:
+			self._receive()
+		except:
+			self.stop()
+			raise
+		return
+
+	def __str__(self):
+		return self.name
+
+	########################################################################
+	# Calls a method of the object in the worker and returns its result.
+	# method: Name of the method, None to return the object itself
+	def call(self, method, *args):
+		self._connection.send((method, args))
+		return self._receive()
+
+	########################################################################
+	# Returns an attribute of the object in the worker.
+	def get(self, name):
+		return self.call('__getattribute__', name)
+
+	########################################################################
+	# Stops the worker, after it sent the records that it logged until then.
+	def stop(self):
+		if self._process is None:
+			return
+		with _workersLock:
+			_workers.discard(self)
+		try:
+			self._connection.send(None)
+			self._receive()
+		except:
+			None
+		self._process.join()
+		self._connection.close()
+		self._process = None
+		return
+
+	########################################################################
+	# Returns the result of the last call, and handles the records that the worker logged.
+	def _receive(self):
+		while True:
+			try:
+				kind, value = self._connection.recv()
+			except EOFError:
+				raise WorkerError(self.name + ' stopped unexpectedly')
+			if kind == 'log':
+				record = logging.makeLogRecord(value)
+				logging.getLogger(record.name).handle(record)
+			elif kind == 'error':
+				raise WorkerError('Error in ' + self.name + ':\n' + value)
+			else:
+				return value
+
+########################################################################
+# Runs fn(*args) in a worker and returns its result, e.g. on the threads of a pipeline.TaskPool.
+# fn: Module level function whose result can be pickled
+def run(name, fn, args = ()):
+	worker = Worker(name, fn, args)
+	try:
+		return worker.call(None)
+	finally:
+		worker.stop()
+
+########################################################################
+# Runs in the worker: profiles it when the parent is profiled and answers the calls of the parent
+# until it is stopped.
+# profile: (name, path) of the RunProfiler of the worker, or None
+def _serve(connection, factory, args, logLevel, profile):
+	global _workersLock
+	#A forked worker has a copy of the workers of the parent, they aren't its own.
+	_workers.clear()
+	_workersLock = threading.Lock()
+	channel = _Channel(connection)
+	_configureLogging(channel, logLevel)
+	profiler = None
+	if profile is not None:
+		profiler = profiling.RunProfiler(profile[0] + '_' + str(os.getpid()), profile[1])
+		profiler.start()
+	try:
+		_answer(channel, connection, factory, args)
+	finally:
+		if profiler is not None:
+			profiler.stop()
+	try:
+		channel.send('stopped', None)
+	except:
+		None
+	return
+
+########################################################################
+# Builds the object and calls its methods, returns when the parent stops the worker.
+def _answer(channel, connection, factory, args):
+	try:
+		target = factory(*args)
+		channel.send('result', None)
+	except:
+		channel.send('error', _formatError())
+		return
+	while True:
+		try:
+			request = connection.recv()
+		except EOFError:
+			return
+		if request is None:
+			return
+		method, args = request
+		try:
+			if method is None:
+				result = target
+			else:
+				result = getattr(target, method)(*args)
+			channel.send('result', result)
+		except:
+			channel.send('error', _formatError())
+
+#The end of the pipe in the worker, the threads of the worker log on it at the same time.
+class _Channel(object):
+	def __init__(self, connection):
+		self._connection = connection
+		self._lock = threading.Lock()
+		return
+
+	def send(self, kind, value):
+		with self._lock:
+			self._connection.send((kind, value))
+		return
+
+#Logging handler of a worker that sends the records to the parent.
+class _ChannelHandler(logging.Handler):
+	def __init__(self, channel):
+		logging.Handler.__init__(self)
+		self._channel = channel
+		return
+
+	def emit(self, record):
+		try:
+			values = dict(record.__dict__)
+			values['msg'] = record.getMessage()
+			values['args'] = None
+			if record.exc_info:
+				values['msg'] = values['msg'] + '\n' + logging.Formatter().formatException(record.exc_info)
+			values['exc_info'] = None
+			self._channel.send('log', values)
+		except:
+			self.handleError(record)
+		return
+
+########################################################################
+# Sends the log records of the worker to the parent, instead of to the handlers that a forked
+# worker has from the parent.
+def _configureLogging(channel, level):
+	root = logging.getLogger('')
+	root.handlers = []
+	root.setLevel(level)
+	root.addHandler(_ChannelHandler(channel))
+	return
+
+########################################################################
+# Stops the workers that are left when the parent exits, they aren't daemonic.
+def _stopWorkers():
+	with _workersLock:
+		workers = list(_workers)
+	for worker in workers:
+		worker.stop()
+	return
+
+atexit.register(_stopWorkers)
+
+def _formatError():
+	tb = sys.exc_info()[2]
+	tbinfo = ''.join(traceback.format_tb(tb))
+	return tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
@@ -0,0 +1,235 @@
+import os, sys, traceback, logging
+import time, threading, cProfile, pstats
+from cStringIO import StringIO
+from time import strftime
+
+#Seconds between two samples of the stacks of the profiled threads.
+_SAMPLE_SECONDS = 0.01
+
+#Number of functions in the summary that is written to the log.
+_TOP_FUNCTIONS = 25
+
+#The RunProfiler of the run, None when the run isn't profiled.
+_active = None
+
+########################################################################
+# Returns a context manager that profiles the calling thread as the named stage, for example
+#	with profiling.stage('sync'):
+# Does nothing when the run isn't profiled.
+def stage(name):
+	if _active is None:
+		return _NO_STAGE
+	return _Stage(_active, name)
+
+########################################################################
+# Returns the RunProfiler of the run, or None when the run isn't profiled.
+def getActive():
+	return _active
+
+###################################################################################################
+###################################################################################################
+#
+# class:	profiling.RunProfiler
+# purpose:	Profiles a run by stage. Every thread that enters a stage is profiled with cProfile
+#			until it leaves the stage, and a sampler thread records the stacks of the threads that
+#			are in a stage every _SAMPLE_SECONDS. stop() writes the profiles to path:
+#				<name>_<time>.pstats			cProfile statistics of all stages
+#				<name>_<time>_<stage>.pstats	cProfile statistics of one stage
+#				<name>_<time>.collapsed		Sampled stacks in the collapsed format of flamegraph.pl,
+#											the stage is the root frame
+#			and logs the functions with the most cumulative time and the samples per stage.
+#
+# notes:	Stages can be nested, the time of the inner stage is not counted in the outer one.
+#			The pipeline stages and the task pools enter their own stages, so the threads they
+#			start are profiled as well. Threads outside a stage are not profiled. The worker
+#			processes of processes.Worker are profiled by profilers of their own, which write
+#			the same files with the name of the worker.
+#
+###################################################################################################
+
+class RunProfiler(object):
+	#name:	Name of the run, the prefix of the files
+	#path:	Folder of the files, e.g. the tempPath of the replica
+	def __init__(self, name, path):
+		self.name = name
+		self.path = path
+		self.numSamples = 0
+		self._profiles = dict()
+		self._threadStages = dict()
+		self._stacks = dict()
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._sampler = None
+		self._started = None
+		return
+
+	def __str__(self):
+		return self.name
+
+	########################################################################
+	# Makes this the profiler of the run and profiles the calling thread as the "run" stage.
+	def start(self):
+		global _active
+		_active = self
+		self._started = time.time()
+		self._stopped.clear()
+		self._sampler = threading.Thread(target = self._sample, name = 'profiler:' + self.name)
+		self._sampler.daemon = True
+		self._sampler.start()
+		self._enter('run')
+		return
+
+	########################################################################
+	# Stops profiling and writes the profiles.
+	# returns the paths of the files that were written
+	def stop(self):
+		global _active
+		func = 'RunProfiler.stop'
+		self._exit()
+		_active = None
+		self._stopped.set()
+		if self._sampler is not None:
+			self._sampler.join()
+			self._sampler = None
+		paths = []
+		try:
+			prefix = os.path.join(self.path, self.name + '_' + strftime('%Y%m%d_%H%M%S', time.localtime(self._started)))
+			stages = dict()
+			for key, profile in self._profiles.items():
+				stages.setdefault(key[0], []).append(profile)
+			combined = None
+			for name in sorted(stages):
+				stats = self._getStats(stages[name])
+				if stats is None:
+					continue
+				stats.dump_stats(prefix + '_' + name + '.pstats')
+				paths.append(prefix + '_' + name + '.pstats')
+				if combined is None:
+					combined = stats
+				else:
+					combined.add(stats)
+			if combined is not None:
+				combined.dump_stats(prefix + '.pstats')
+				paths.append(prefix + '.pstats')
+			with open(prefix + '.collapsed', 'w') as f:
+				for stack, count in sorted(self._stacks.items()):
+					f.write(stack + ' ' + str(count) + '\n')
+			paths.append(prefix + '.collapsed')
+			self._log(combined)
+			logging.info('Wrote the profile of ' + self.name + ' to ' + prefix + '.*')
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return paths
+
+	def _enter(self, name):
+		stack = self._getStack()
+		if len(stack) > 0:
+			stack[-1][1].disable()
+		ident = threading.current_thread().ident
+		key = (name, ident)
+		with self._lock:
+			profile = self._profiles.get(key)
+			if profile is None:
+				profile = cProfile.Profile()
+				self._profiles[key] = profile
+		stack.append((name, profile))
+		self._threadStages[ident] = name
+		profile.enable()
+		return
+
+	def _exit(self):
+		stack = self._getStack()
+		if len(stack) == 0:
+			return
+		stack.pop()[1].disable()
+		ident = threading.current_thread().ident
+		if len(stack) > 0:
+			self._threadStages[ident] = stack[-1][0]
+			stack[-1][1].enable()
+		else:
+			self._threadStages.pop(ident, None)
+		return
+
+	def _getStack(self):
+		if not hasattr(self._local, 'stack'):
+			self._local.stack = []
+		return self._local.stack
+
+	########################################################################
+	# Runs on the sampler thread, adds the stacks of the threads in a stage to the collapsed stacks.
+	def _sample(self):
+		while not self._stopped.wait(_SAMPLE_SECONDS):
+			frames = sys._current_frames()
+			for ident, name in self._threadStages.items():
+				frame = frames.get(ident)
+				if frame is None:
+					continue
+				names = []
+				while frame is not None:
+					code = frame.f_code
+					names.append(os.path.basename(code.co_filename) + ':' + code.co_name + ':' + str(code.co_firstlineno))
+					frame = frame.f_back
+				names.append(name)
+				names.reverse()
+				stack = ';'.join(names).replace(' ', '_')
+				self._stacks[stack] = self._stacks.get(stack, 0) + 1
+				self.numSamples = self.numSamples + 1
+			del frames
+		return
+
+	def _getStats(self, profiles):
+		stats = None
+		for profile in profiles:
+			#A profile without calls can't be loaded by pstats.
+			profile.create_stats()
+			if len(profile.stats) == 0:
+				continue
+			if stats is None:
+				stats = pstats.Stats(profile)
+			else:
+				stats.add(profile)
+		return stats
+
+	def _log(self, stats):
+		samples = dict()
+		for stack, count in self._stacks.items():
+			name = stack.split(';', 1)[0]
+			samples[name] = samples.get(name, 0) + count
+		total = max(1, self.numSamples)
+		logging.info('Profile of ' + self.name + ': ' + str(self.numSamples) + ' samples in ' + ('%.1f' % (time.time() - self._started)) + 's')
+		for name in sorted(samples, key = lambda name: samples[name], reverse = True):
+			logging.info('\t' + name + ': ' + str(samples[name]) + ' samples (' + ('%.0f' % (100.0 * samples[name] / total)) + '%)')
+		if stats is None:
+			return
+		out = StringIO()
+		stats.stream = out
+		stats.sort_stats('cumulative').print_stats(_TOP_FUNCTIONS)
+		logging.info('Functions with the most cumulative time:\n' + out.getvalue())
+		return
+
+class _Stage(object):
+	def __init__(self, profiler, name):
+		self._profiler = profiler
+		self._name = name
+		return
+
+	def __enter__(self):
+		self._profiler._enter(self._name)
+		return self
+
+	def __exit__(self, kind, value, tb):
+		self._profiler._exit()
+		return False
+
+class _NoStage(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, kind, value, tb):
+		return False
+
+_NO_STAGE = _NoStage()
@@ -0,0 +1,227 @@
+import os, sys, traceback, logging
+import json, sqlite3
+from datetime import datetime, date
+from decimal import Decimal
+
+import util
+
+_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+_DAY_FORMAT = '%Y-%m-%d'
+
+###################################################################################################
+###################################################################################################
+#
+# class:	quarantine.QuarantineEntry
+# purpose:	A change that could not be written to SDE, as it is stored in the quarantine.
+#			row is the list of CDC column values and fields maps the column names to indexes
+#			in row, the same way as for the rows of a db.ChangeBatch.
+#
+###################################################################################################
+
+class QuarantineEntry(object):
+	def __init__(self, record):
+		self.id = record[0]
+		self.dataset = record[1]
+		self.key = _decodeValue(json.loads(record[2]))
+		self.op = record[3]
+		columns = json.loads(record[4])
+		self.fields = dict()
+		for i in range(0, len(columns)):
+			self.fields[columns[i]] = i
+		self.row = [_decodeValue(v) for v in json.loads(record[5])]
+		self.cdcKeys = json.loads(record[6])
+		self.error = record[7]
+		self.attempts = record[8]
+		self.status = record[9]
+		self.firstFailed = record[10]
+		self.lastFailed = record[11]
+		return
+
+	def __str__(self):
+		return str(self.id) + ' ' + self.dataset + ' ' + str(self.key)
+
+	def getColumns(self):
+		columns = [None] * len(self.fields)
+		for name in self.fields:
+			columns[self.fields[name]] = name
+		return columns
+
+###################################################################################################
+###################################################################################################
+#
+# class:	quarantine.QuarantineStore
+# purpose:	SQLite table of changes that failed to be written to SDE, with the error and the
+#			number of runs in which they failed. A change that keeps failing is moved to the
+#			"quarantined" status, its CDC records can then be cleared so that later runs no longer
+#			fetch it, and it can be inspected, fixed and replayed from the quarantine.py script.
+#
+# notes:	There is one entry per dataset and primary key, holding the latest failed state of the record.
+#			Statuses: "retry" (still in the CDC table), "quarantined", "replayed", "superseded"
+#			(a newer change of the record was applied) and "discarded".
+#
+###################################################################################################
+
+class QuarantineStore(object):
+	#path: Path of the SQLite database file, it is created if it doesn't exist.
+	def __init__(self, path):
+		self.path = path
+		self._connection = sqlite3.connect(path)
+		self._connection.execute('''CREATE TABLE IF NOT EXISTS quarantine (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			dataset TEXT NOT NULL,
+			record_key TEXT NOT NULL,
+			op TEXT NOT NULL,
+			columns TEXT NOT NULL,
+			row TEXT NOT NULL,
+			cdc_keys TEXT NOT NULL,
+			error TEXT,
+			attempts INTEGER NOT NULL,
+			status TEXT NOT NULL,
+			first_failed TEXT NOT NULL,
+			last_failed TEXT NOT NULL,
+			UNIQUE (dataset, record_key))''')
+		self._connection.commit()
+		return
+
+	def __del__(self):
+		self.close()
+		return
+
+	def close(self):
+		if self._connection is not None:
+			util.DBUtil().close(self._connection)
+			self._connection = None
+		return
+
+	########################################################################
+	# Records that a change failed. Returns the number of runs in which the record failed.
+	# dataset: Name of the dataset, the CDC table of a db.Dataset
+	# change: The db.Change that failed
+	# fields: Dictionary of column name to index for change.row
+	def recordFailure(self, dataset, change, fields):
+		columns = [None] * len(fields)
+		for name in fields:
+			columns[fields[name]] = name
+		key = json.dumps(_encodeValue(change.key))
+		row = json.dumps([_encodeValue(v) for v in change.row])
+		now = util.DateUtil().now()
+		cursor = self._connection.cursor()
+		cursor.execute('SELECT attempts, status FROM quarantine WHERE dataset = ? AND record_key = ?', (dataset, key))
+		record = cursor.fetchone()
+		if record is None or record[1] != 'retry':
+			attempts = 1
+		else:
+			attempts = record[0] + 1
+		if record is None:
+			cursor.execute('INSERT INTO quarantine (dataset, record_key, op, columns, row, cdc_keys, error, attempts, status, first_failed, last_failed) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+				(dataset, key, change.op, json.dumps(columns), row, json.dumps(change.cdcKeys), change.error, attempts, 'retry', now, now))
+		else:
+			cursor.execute('UPDATE quarantine SET op = ?, columns = ?, row = ?, cdc_keys = ?, error = ?, attempts = ?, status = ?, last_failed = ? WHERE dataset = ? AND record_key = ?',
+				(change.op, json.dumps(columns), row, json.dumps(change.cdcKeys), change.error, attempts, 'retry', now, dataset, key))
+		self._connection.commit()
+		return attempts
+
+	########################################################################
+	# Moves a record that failed too often out of the CDC hot path.
+	def quarantine(self, dataset, change):
+		key = json.dumps(_encodeValue(change.key))
+		self._connection.execute('UPDATE quarantine SET status = ? WHERE dataset = ? AND record_key = ?', ('quarantined', dataset, key))
+		self._connection.commit()
+		return
+
+	########################################################################
+	# Removes retry entries of records that have now been applied, and marks quarantined
+	# entries of those records as superseded.
+	# changes: db.Change objects that were saved to SDE
+	def resolve(self, dataset, changes):
+		keys = self.getKeys(dataset)
+		if len(keys) == 0:
+			return
+		cursor = self._connection.cursor()
+		for change in changes:
+			key = json.dumps(_encodeValue(change.key))
+			if key in keys:
+				cursor.execute("DELETE FROM quarantine WHERE dataset = ? AND record_key = ? AND status = 'retry'", (dataset, key))
+				cursor.execute("UPDATE quarantine SET status = 'superseded' WHERE dataset = ? AND record_key = ? AND status = 'quarantined'", (dataset, key))
+		self._connection.commit()
+		return
+
+	def getKeys(self, dataset):
+		cursor = self._connection.cursor()
+		cursor.execute("SELECT record_key FROM quarantine WHERE dataset = ? AND status IN ('retry','quarantined')", (dataset,))
+		return set(record[0] for record in cursor.fetchall())
+
+	########################################################################
+	# Returns a list of QuarantineEntry objects.
+	# dataset, status: Optional filters
+	# ids: Optional list of entry ids
+	def getEntries(self, dataset = None, status = None, ids = None):
+		sql = 'SELECT id, dataset, record_key, op, columns, row, cdc_keys, error, attempts, status, first_failed, last_failed FROM quarantine'
+		where = []
+		params = []
+		if dataset is not None:
+			where.append('dataset = ?')
+			params.append(dataset)
+		if status is not None:
+			where.append('status = ?')
+			params.append(status)
+		if ids is not None and len(ids) > 0:
+			where.append('id IN (' + ','.join(['?'] * len(ids)) + ')')
+			params.extend(ids)
+		if len(where) > 0:
+			sql = sql + ' WHERE ' + ' AND '.join(where)
+		sql = sql + ' ORDER BY id'
+		cursor = self._connection.cursor()
+		cursor.execute(sql, params)
+		return [QuarantineEntry(record) for record in cursor.fetchall()]
+
+	########################################################################
+	# Changes the value of a column of a quarantined row.
+	def setValue(self, entryId, column, value):
+		entries = self.getEntries(ids = [entryId])
+		if len(entries) == 0 or not column in entries[0].fields:
+			return False
+		entry = entries[0]
+		entry.row[entry.fields[column]] = value
+		self._connection.execute('UPDATE quarantine SET row = ? WHERE id = ?', (json.dumps([_encodeValue(v) for v in entry.row]), entryId))
+		self._connection.commit()
+		return True
+
+	def setStatus(self, entryId, status, error = None):
+		if error is None:
+			self._connection.execute('UPDATE quarantine SET status = ? WHERE id = ?', (status, entryId))
+		else:
+			self._connection.execute('UPDATE quarantine SET status = ?, error = ?, attempts = attempts + 1, last_failed = ? WHERE id = ?', (status, error, util.DateUtil().now(), entryId))
+		self._connection.commit()
+		return
+
+########################################################################
+# JSON encoding of the column values of a CDC row.
+def _encodeValue(value):
+	if isinstance(value, str):
+		#Warehouse varchar columns come back in the Windows code page.
+		try:
+			return value.decode('cp1252')
+		except UnicodeDecodeError:
+			return value.decode('latin-1')
+	if isinstance(value, datetime):
+		return {'$date':value.strftime(_DATE_FORMAT)}
+	if isinstance(value, date):
+		return {'$day':value.strftime(_DAY_FORMAT)}
+	if isinstance(value, Decimal):
+		return {'$decimal':str(value)}
+	if isinstance(value, (bytearray, buffer)):
+		return {'$hex':str(value).encode('hex')}
+	return value
+
+def _decodeValue(value):
+	if isinstance(value, dict):
+		if '$date' in value:
+			return datetime.strptime(value['$date'], _DATE_FORMAT)
+		if '$day' in value:
+			return datetime.strptime(value['$day'], _DAY_FORMAT).date()
+		if '$decimal' in value:
+			return Decimal(value['$decimal'])
+		if '$hex' in value:
+			return bytearray(value['$hex'].decode('hex'))
+	return value
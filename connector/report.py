@@ -0,0 +1,189 @@
+import os, sys, traceback, logging
+import json, time, threading
+from collections import OrderedDict
+from time import strftime
+
+###################################################################################################
+###################################################################################################
+#
+# class:	report.ReplicaReport
+# purpose:	Collects the outcome of processing one replica: a status, counters, timings of
+#			the processing stages, per-dataset values, free-form sections and the statistics
+#			of the SQL Server statements (an odbc.QueryStats).
+#
+###################################################################################################
+
+class ReplicaReport(object):
+	def __init__(self, name):
+		self.name = name
+		self.status = None
+		self.started = None
+		self.finished = None
+		self.counters = OrderedDict()
+		self.timings = OrderedDict()
+		self.datasets = OrderedDict()
+		self.sections = OrderedDict()
+		self.queries = None
+		return
+
+	def start(self):
+		self.started = time.time()
+		return
+
+	def finish(self, status):
+		self.status = status
+		self.finished = time.time()
+		return
+
+	def duration(self):
+		if self.started is None:
+			return 0.0
+		if self.finished is None:
+			return time.time() - self.started
+		return self.finished - self.started
+
+	def add(self, name, n = 1):
+		self.counters[name] = self.counters.get(name, 0) + n
+		return
+
+	def addTime(self, stage, seconds):
+		self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+		return
+
+	########################################################################
+	# Returns the dictionary of values reported for a dataset.
+	def dataset(self, name):
+		if not name in self.datasets:
+			self.datasets[name] = OrderedDict()
+		return self.datasets[name]
+
+	########################################################################
+	# Returns a named list to which a stage can append its own records.
+	def section(self, name):
+		if not name in self.sections:
+			self.sections[name] = []
+		return self.sections[name]
+
+	########################################################################
+	# Sets the values of the report from toDict() of the report of a worker process.
+	def load(self, values):
+		self.status = values['status']
+		self.finished = time.time()
+		self.started = self.finished - values['seconds']
+		self.counters = values['counters']
+		self.timings = values['timings']
+		self.datasets = values['datasets']
+		self.sections = values['sections']
+		if 'queries' in values:
+			self.queries = _Statements(values['queries'])
+		return
+
+	def toDict(self):
+		d = OrderedDict()
+		d['name'] = self.name
+		d['status'] = self.status
+		d['seconds'] = round(self.duration(), 3)
+		d['counters'] = self.counters
+		d['timings'] = OrderedDict((k, round(v, 3)) for k, v in self.timings.items())
+		d['datasets'] = self.datasets
+		d['sections'] = self.sections
+		if self.queries is not None:
+			d['queries'] = self.queries.toList()
+		return d
+
+########################################################################
+# The statistics of the SQL Server statements of a replica that was processed by a worker, with the
+# toList() and log() of odbc.QueryStats.
+class _Statements(list):
+	def toList(self):
+		return self
+
+	def log(self, n = 5):
+		for statement in self[:n]:
+			logging.debug('\t\t' + ('%.1f' % statement['seconds']) + 's in ' + str(statement['calls']) + ' calls, ' + str(statement['rows']) + ' rows: ' + statement['sql'][:200])
+		return
+
+###################################################################################################
+###################################################################################################
+#
+# class:	report.RunReport
+# purpose:	Consolidated result of an import or export run over all replicas. Replicas may be
+#			processed on different threads, each thread only writes to its own ReplicaReport.
+#			The reports of the replicas that were processed by worker processes are loaded.
+#
+###################################################################################################
+
+class RunReport(object):
+	def __init__(self, name):
+		self.name = name
+		self.started = time.time()
+		self.finished = None
+		self.replicas = OrderedDict()
+		self.sections = OrderedDict()
+		self._lock = threading.Lock()
+		return
+
+	def replica(self, name):
+		with self._lock:
+			if not name in self.replicas:
+				self.replicas[name] = ReplicaReport(name)
+			return self.replicas[name]
+
+	def section(self, name):
+		with self._lock:
+			if not name in self.sections:
+				self.sections[name] = []
+			return self.sections[name]
+
+	def finish(self):
+		self.finished = time.time()
+		return
+
+	def duration(self):
+		if self.finished is None:
+			return time.time() - self.started
+		return self.finished - self.started
+
+	def toDict(self):
+		d = OrderedDict()
+		d['name'] = self.name
+		d['started'] = strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))
+		d['seconds'] = round(self.duration(), 3)
+		d['replicas'] = [r.toDict() for r in self.replicas.values()]
+		d['sections'] = self.sections
+		return d
+
+	########################################################################
+	# Writes a summary of the run to the log.
+	def log(self):
+		logging.info('Run report for ' + self.name + ':')
+		total = 0.0
+		for r in self.replicas.values():
+			total = total + r.duration()
+			msg = '\t' + r.name + ': ' + str(r.status) + ' in ' + ('%.1f' % r.duration()) + 's'
+			if len(r.counters) > 0:
+				msg = msg + ' (' + ', '.join([k + ' ' + str(v) for k, v in r.counters.items()]) + ')'
+			logging.info(msg)
+			for stage, seconds in r.timings.items():
+				logging.debug('\t\t' + stage + ': ' + ('%.1f' % seconds) + 's')
+			if r.queries is not None:
+				r.queries.log()
+		logging.info('\tTotal ' + ('%.1f' % self.duration()) + 's for ' + str(len(self.replicas)) + ' replicas (' + ('%.1f' % total) + 's of replica time)')
+		return
+
+	########################################################################
+	# Writes the report as a JSON file to the folder path, and returns the path of the file.
+	def write(self, path):
+		func = 'RunReport.write'
+		fileName = os.path.join(path, self.name + '_' + strftime('%Y%m%d_%H%M%S', time.localtime(self.started)) + '.json')
+		try:
+			with open(fileName, 'w') as f:
+				json.dump(self.toDict(), f, indent = 1, default = str)
+			logging.debug('Wrote run report to ' + fileName)
+			return fileName
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return None
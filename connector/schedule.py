@@ -0,0 +1,245 @@
+import os, sys, traceback, logging
+import time, threading, Queue
+
+###################################################################################################
+###################################################################################################
+#
+# class:	schedule.DatasetScheduler
+# purpose:	Interleaves the imports of the datasets of a replica with weighted round-robin over
+#			their batches. Every cycle of cycleSeconds is shared by the active jobs in proportion
+#			to their priority, highest priority first, and every job gets at least one batch per
+#			cycle. So the changes of a small dataset are applied within a cycle even while a large
+#			backlog of another dataset drains.
+#
+# notes:	A job has a priority and the methods step(), which imports one batch and returns False
+#			when the job has nothing left, pause(), which is called before another job gets its
+#			turn, and poll(), which restarts a finished job when it has new changes, and the
+#			attribute numPasses, the number of times the job was started. Finished jobs are polled
+#			at the start of every cycle while a job is still draining its first pass, so a run
+#			ends once every dataset has caught up with the changes it found at its start.
+#
+#			Without cycleSeconds every job runs until it is finished, highest priority first.
+#
+#			When the deadline passes, the batch that is being imported is finished and interrupt()
+#			is called on every job that is not finished. Jobs with resumed set, the ones a
+#			previous run did not finish, go first among the jobs of the same priority.
+#
+###################################################################################################
+
+class DatasetScheduler(object):
+	#name:			Name used in log messages
+	#cycleSeconds:	Time shared by the jobs in one cycle, or None to run the jobs one after the other
+	#deadline:		time.time() at which the jobs are interrupted, or None
+	def __init__(self, name, cycleSeconds = None, deadline = None):
+		self.name = name
+		self.cycleSeconds = cycleSeconds
+		self.deadline = deadline
+		self.numCycles = 0
+		self.jobs = []
+		self.interrupted = []
+		return
+
+	def __str__(self):
+		return self.name
+
+	def add(self, job):
+		self.jobs.append(job)
+		return
+
+	########################################################################
+	# Runs the jobs until all of them are finished or the deadline passed.
+	def run(self):
+		func = 'DatasetScheduler.run'
+		#sort is stable, jobs with the same priority keep their order.
+		active = sorted(self.jobs, key = self._order, reverse = True)
+		finished = []
+		while len(active) > 0 and not self.expired():
+			self.numCycles = self.numCycles + 1
+			draining = [job for job in active if job.numPasses <= 1]
+			for job in list(finished):
+				if len(draining) > 0 and self._call(job.poll, func):
+					logging.debug(self.name + ': ' + str(job) + ' has new changes')
+					finished.remove(job)
+					active.append(job)
+			active.sort(key = self._order, reverse = True)
+			total = float(sum([job.priority for job in active]))
+			for job in list(active):
+				if self.expired():
+					break
+				if self.cycleSeconds is None:
+					budget = None
+				else:
+					budget = self.cycleSeconds * job.priority / total
+				if not self._turn(job, budget):
+					active.remove(job)
+					finished.append(job)
+				elif len(active) > 1 or len(finished) > 0:
+					self._call(job.pause, func)
+		if len(active) > 0:
+			logging.warn(self.name + ': out of time, ' + ', '.join([str(job) for job in active]) + ' will continue in the next run')
+		for job in active:
+			self._call(job.interrupt, func)
+		self.interrupted = active
+		return
+
+	def expired(self):
+		return self.deadline is not None and time.time() >= self.deadline
+
+	########################################################################
+	# Runs the batches of a job until its budget is used.
+	# returns False if the job is finished
+	def _turn(self, job, budget):
+		started = time.time()
+		while True:
+			if not self._call(job.step, 'DatasetScheduler._turn'):
+				return False
+			if budget is not None and time.time() - started >= budget:
+				return True
+			if self.expired():
+				return True
+
+	def _order(self, job):
+		return (job.priority, job.resumed)
+
+	def _call(self, fn, func):
+		try:
+			return fn()
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return False
+
+###################################################################################################
+###################################################################################################
+#
+# class:	schedule.DependencyScheduler
+# purpose:	Imports the datasets of a replica in the order of their dependencies. The inserts and
+#			updates of a job are imported after its parents finished theirs, then the deletes of
+#			a job are applied after its children applied theirs. Jobs that don't wait for each
+#			other run at the same time on up to maxParallel threads, highest priority first. The
+#			threads only drive the jobs, io.DatasetWorker imports a dataset in a worker process.
+#
+# notes:	A job has a priority, the methods step() and interrupt() of DatasetScheduler, and
+#			applyDeletes(), which applies the deletes that step() held back. The children of a
+#			job that failed are skipped, so their changes stay in CDC for the next run.
+#
+#			When the deadline passes, the jobs that are running are interrupted after their
+#			current batch and the jobs that did not start are interrupted before they start.
+#			The deletes of the jobs that ran are still applied.
+#
+###################################################################################################
+
+class DependencyScheduler(object):
+	#name:			Name used in log messages
+	#maxParallel:	Maximum number of jobs that run at the same time
+	#deadline:		time.time() at which the jobs are interrupted, or None
+	def __init__(self, name, maxParallel = 1, deadline = None):
+		self.name = name
+		self.maxParallel = max(1, maxParallel)
+		self.deadline = deadline
+		self.jobs = []
+		self.parents = dict()
+		self.interrupted = []
+		self.skipped = []
+		return
+
+	def __str__(self):
+		return self.name
+
+	#parents: The jobs that job depends on
+	def add(self, job, parents):
+		self.jobs.append(job)
+		self.parents[job] = list(parents)
+		return
+
+	def run(self):
+		children = dict((job, []) for job in self.jobs)
+		for job in self.jobs:
+			for parent in self.parents[job]:
+				children[parent].append(job)
+		self._runPhase(self.parents, self._import)
+		ran = [job for job in self.jobs if not job in self.skipped]
+		self._runPhase(children, self._applyDeletes, ran)
+		return
+
+	def expired(self):
+		return self.deadline is not None and time.time() >= self.deadline
+
+	########################################################################
+	# Runs fn for every job after fn finished for the jobs it waits for.
+	# waits: Dictionary of job to the jobs it waits for
+	# jobs: The jobs to run, defaults to all jobs
+	def _runPhase(self, waits, fn, jobs = None):
+		func = 'DependencyScheduler._runPhase'
+		if jobs is None:
+			jobs = self.jobs
+		pending = sorted(jobs, key = lambda job: job.priority, reverse = True)
+		done = set([job for job in self.jobs if not job in jobs])
+		finished = Queue.Queue()
+		numRunning = 0
+		while len(pending) > 0 or numRunning > 0:
+			for job in list(pending):
+				if numRunning >= self.maxParallel:
+					break
+				if not True in [wait not in done for wait in waits[job]]:
+					pending.remove(job)
+					numRunning = numRunning + 1
+					self._start(job, fn, finished)
+			if numRunning == 0:
+				logging.error(self.name + ': the dependencies of ' + ', '.join([str(job) for job in pending]) + ' have a cycle, they are skipped')
+				self.skipped.extend(pending)
+				break
+			job = finished.get()
+			numRunning = numRunning - 1
+			done.add(job)
+		return
+
+	def _start(self, job, fn, finished):
+		def work():
+			try:
+				fn(job)
+			finally:
+				finished.put(job)
+		if self.maxParallel == 1:
+			work()
+			return
+		thread = threading.Thread(target = work, name = self.name + ':' + str(job))
+		thread.daemon = True
+		thread.start()
+		return
+
+	def _import(self, job):
+		func = 'DependencyScheduler._import'
+		failed = [parent for parent in self.parents[job] if parent in self.skipped or parent.failed]
+		if len(failed) > 0:
+			logging.warn(self.name + ': ' + str(job) + ' is skipped, because ' + ', '.join([str(parent) for parent in failed]) + ' was not imported')
+			self.skipped.append(job)
+			return
+		if self.expired():
+			logging.warn(self.name + ': out of time, ' + str(job) + ' will be imported in the next run')
+			self._call(job.interrupt, func)
+			self.interrupted.append(job)
+			return
+		while self._call(job.step, func):
+			if self.expired():
+				logging.warn(self.name + ': out of time, ' + str(job) + ' will continue in the next run')
+				self._call(job.interrupt, func)
+				self.interrupted.append(job)
+				return
+		return
+
+	def _applyDeletes(self, job):
+		self._call(job.applyDeletes, 'DependencyScheduler._applyDeletes')
+		return
+
+	def _call(self, fn, func):
+		try:
+			return fn()
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return False
@@ -0,0 +1,290 @@
+import os, sys, traceback, logging
+import sqlite3, struct, threading
+from decimal import Decimal
+from datetime import datetime
+
+#Code page of the varchar values that pyodbc returns as str, SQLite only takes unicode text.
+_TEXT_ENCODING = 'cp1252'
+
+#GeoPackage application_id ('GPKG') and user_version (1.2.0).
+_GPKG_APPLICATION_ID = 0x47504B47
+_GPKG_VERSION = 10200
+
+#Tables that every GeoPackage has, with the spatial reference systems that it must define.
+_GPKG_TABLES = [
+	'''CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+		organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)''',
+	'''CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+		identifier TEXT UNIQUE, description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+		min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+		CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))''',
+	'''CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL,
+		geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+		CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+		CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+		CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))''']
+_GPKG_SPATIAL_REF_SYS = [
+	('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+	('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+	('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]', 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid')]
+
+#Name of the geometry column of the feature tables of a GeoPackage.
+_GEOMETRY_COLUMN = 'geom'
+
+###################################################################################################
+###################################################################################################
+#
+# class:	sink.Sink
+# purpose:	Destination of the changes of an import. apply() writes one batch of changes of a
+#			dataset, the keys of a batch are unique, so the inserts, updates and deletes of a
+#			batch can be written in any order.
+#
+# notes:	apply() is abstract, every sink implements it: io.SdeSink for the geodatabase and
+#			SqliteSink for SQLite and GeoPackage files. It returns the changes it could not write
+#			instead of raising, so that the other changes of the batch are still saved.
+#
+#			The changes are (change, fields) tuples of db.Change objects and the fields of their
+#			rows, as they are passed to the editors of io.DatasetImport.
+#
+###################################################################################################
+
+class Sink(object):
+	def __init__(self, name):
+		self.name = name
+		return
+
+	def __str__(self):
+		return self.name
+
+	########################################################################
+	# Abstract: writes a batch of changes of a dataset.
+	# returns the (change, fields) tuples that could not be written, with their change.error set
+	def apply(self, dataset, inserts, updates, deletes):
+		raise NotImplementedError()
+
+	def close(self):
+		return
+
+###################################################################################################
+###################################################################################################
+#
+# class:	sink.SqliteSink
+# purpose:	Writes the changes to the tables of a SQLite database or a GeoPackage, e.g. a local
+#			read mirror for the field apps, or to measure the import without a geodatabase. The
+#			database is opened in WAL mode and every batch is written with executemany in one
+#			transaction: one UPDATE and one INSERT of the rows that don't exist yet for the
+#			inserts and updates, so an update of a missing row inserts it, and one DELETE for the
+#			deletes. The INSERT checks that the key doesn't exist with a subquery instead of
+#			INSERT OR IGNORE, which would ignore NOT NULL and UNIQUE violations as well. When the
+#			transaction fails, the batch is rolled back and its halves are written again, until
+#			only the changes that fail are left, so one bad row doesn't fail the whole batch.
+#
+# notes:	A table is created for each dataset on its first batch, named like the SDE table and
+#			with the columns of the CDC rows. The rows have an integer fid and the primary key of
+#			the dataset is a unique column. Columns that later batches add are added to the table.
+#
+#			In a GeoPackage, the tables of datasets with xField and yField are feature tables
+#			with a point geometry column in the spatial reference system srid, the others are
+#			attribute tables. srid should be in gpkg_spatial_ref_sys, it is added as undefined
+#			when it isn't.
+#
+###################################################################################################
+
+class SqliteSink(Sink):
+	#path:			The SQLite or GeoPackage file, created when it doesn't exist
+	#geopackage:	Write a GeoPackage instead of plain SQLite tables
+	#srid:			Spatial reference system of the geometries of a GeoPackage
+	def __init__(self, path, geopackage = False, srid = 0):
+		Sink.__init__(self, path)
+		self.path = path
+		self.geopackage = geopackage
+		self.srid = srid
+		self._connection = None
+		self._tables = dict()
+		self._lock = threading.Lock()
+		return
+
+	def apply(self, dataset, inserts, updates, deletes):
+		func = 'SqliteSink.apply'
+		#The datasets of a replica can be written on several threads.
+		with self._lock:
+			try:
+				if self._connection is None:
+					self._open()
+			except:
+				tb = sys.exc_info()[2]
+				tbinfo = traceback.format_tb(tb)[0]
+				msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+				logging.error(msg)
+				failed = inserts + updates + deletes
+				for change, fields in failed:
+					change.error = str(sys.exc_info()[1])
+				return failed
+			return self._apply(dataset, inserts + updates + deletes)
+
+	########################################################################
+	# Writes changes in one transaction. When it fails, the two halves of the changes are
+	# written again, each in a transaction of its own.
+	# returns the changes that could not be written
+	def _apply(self, dataset, changes):
+		func = 'SqliteSink.apply'
+		try:
+			self._write(dataset, [(change, fields) for change, fields in changes if change.op != 'delete'], [(change, fields) for change, fields in changes if change.op == 'delete'])
+			self._connection.commit()
+			return []
+		except:
+			error = str(sys.exc_info()[1])
+			try:
+				self._connection.rollback()
+			except:
+				None
+			if len(changes) == 1:
+				tb = sys.exc_info()[2]
+				tbinfo = traceback.format_tb(tb)[0]
+				msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + error
+				logging.error(msg)
+				changes[0][0].error = error
+				return changes
+			logging.debug('Could not write ' + str(len(changes)) + ' changes of ' + str(dataset) + ' to ' + self.path + ', writing them in halves: ' + error)
+		half = len(changes) // 2
+		return self._apply(dataset, changes[:half]) + self._apply(dataset, changes[half:])
+
+	def close(self):
+		with self._lock:
+			if self._connection is not None:
+				self._connection.close()
+				self._connection = None
+		return
+
+	def _open(self):
+		self._connection = sqlite3.connect(self.path, check_same_thread = False)
+		self._connection.execute('PRAGMA journal_mode=WAL')
+		self._connection.execute('PRAGMA synchronous=NORMAL')
+		if self.geopackage:
+			self._connection.execute('PRAGMA application_id=' + str(_GPKG_APPLICATION_ID))
+			self._connection.execute('PRAGMA user_version=' + str(_GPKG_VERSION))
+			for sql in _GPKG_TABLES:
+				self._connection.execute(sql)
+			self._connection.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', _GPKG_SPATIAL_REF_SYS)
+			self._connection.execute('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', ('SRS ' + str(self.srid), self.srid, 'EPSG', self.srid, 'undefined', None))
+			self._connection.commit()
+		logging.debug('Opened ' + self.path)
+		return
+
+	def _write(self, dataset, upserts, deletes):
+		#The rows of a batch can have different fields, e.g. the repairs of a snapshot.
+		groups = dict()
+		for change, fields in upserts:
+			groups.setdefault(id(fields), (fields, []))[1].append(change)
+		for fields, changes in groups.values():
+			table = self._getTable(dataset, fields, changes)
+			names = [name for name in table.columns if name in fields]
+			values = []
+			for change in changes:
+				row = [_sqliteValue(change.row[fields[name]]) for name in names]
+				if table.hasGeometry:
+					row.append(_pointBlob(change.row, fields, dataset, self.srid))
+				row.append(_sqliteValue(change.row[fields[dataset.cdcPrimaryKey]]))
+				values.append(row)
+			columns = ['"' + name + '"' for name in names]
+			if table.hasGeometry:
+				columns.append('"' + _GEOMETRY_COLUMN + '"')
+			self._connection.executemany('UPDATE "' + table.name + '" SET ' + ', '.join([column + ' = ?' for column in columns]) + ' WHERE "' + table.key + '" = ?', values)
+			#The key is already in the values, at the end, for the WHERE clause of the UPDATE.
+			columns.append('"' + table.key + '"')
+			self._connection.executemany('INSERT INTO "' + table.name + '" (' + ', '.join(columns) + ') SELECT ' + ', '.join(['?'] * len(columns)) + ' WHERE NOT EXISTS (SELECT 1 FROM "' + table.name + '" WHERE "' + table.key + '" = ?)', [row + [row[-1]] for row in values])
+		if len(deletes) > 0:
+			table = self._getTable(dataset, deletes[0][1], [change for change, fields in deletes])
+			self._connection.executemany('DELETE FROM "' + table.name + '" WHERE "' + table.key + '" = ?', [(_sqliteValue(change.row[fields[dataset.cdcPrimaryKey]]),) for change, fields in deletes])
+		if self.geopackage:
+			self._connection.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE table_name = ?", (_tableName(dataset),))
+		return
+
+	########################################################################
+	# Returns the _Table of a dataset, creates it or adds the columns of fields that it doesn't have.
+	def _getTable(self, dataset, fields, changes):
+		table = self._tables.get(dataset.sdeTable)
+		if table is None:
+			table = self._loadTable(dataset, _sqliteType([change.row[fields[dataset.cdcPrimaryKey]] for change in changes]))
+			self._tables[dataset.sdeTable] = table
+		names = sorted([name for name in fields if not name.startswith('__$') and not dataset.columns.isIgnored(name) and name != dataset.cdcPrimaryKey], key = lambda name: fields[name])
+		for name in names:
+			if name in table.columns:
+				continue
+			sql = 'ALTER TABLE "' + table.name + '" ADD COLUMN "' + name + '" ' + _sqliteType([change.row[fields[name]] for change in changes])
+			self._connection.execute(sql)
+			table.columns.append(name)
+		return table
+
+	#keyType: Declared type of the primary key column when the table is created
+	def _loadTable(self, dataset, keyType):
+		name = _tableName(dataset)
+		hasGeometry = self.geopackage and dataset.isSpatial
+		columns = [row[1] for row in self._connection.execute('PRAGMA table_info("' + name + '")')]
+		if len(columns) == 0:
+			logging.info('Creating table ' + name + ' in ' + self.path)
+			sql = 'CREATE TABLE "' + name + '" (fid INTEGER PRIMARY KEY AUTOINCREMENT, "' + dataset.cdcPrimaryKey + '" ' + keyType + ' NOT NULL UNIQUE'
+			if hasGeometry:
+				sql = sql + ', "' + _GEOMETRY_COLUMN + '" POINT'
+			self._connection.execute(sql + ')')
+			if self.geopackage:
+				dataType = 'attributes'
+				if hasGeometry:
+					dataType = 'features'
+				self._connection.execute('INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, ?, ?, ?)', (name, dataType, name, self.srid))
+				if hasGeometry:
+					self._connection.execute('INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, 0, 0)', (name, _GEOMETRY_COLUMN, 'POINT', self.srid))
+			columns = ['fid', dataset.cdcPrimaryKey]
+			if hasGeometry:
+				columns.append(_GEOMETRY_COLUMN)
+		columns = [column for column in columns if not column in ['fid', dataset.cdcPrimaryKey, _GEOMETRY_COLUMN]]
+		return _Table(name, dataset.cdcPrimaryKey, columns, hasGeometry)
+
+class _Table(object):
+	def __init__(self, name, key, columns, hasGeometry):
+		self.name = name
+		self.key = key
+		self.columns = columns
+		self.hasGeometry = hasGeometry
+		return
+
+def _tableName(dataset):
+	return dataset.sdeTable.split('.')[-1]
+
+def _sqliteValue(value):
+	if isinstance(value, Decimal):
+		return float(value)
+	if isinstance(value, str):
+		return value.decode(_TEXT_ENCODING, 'replace')
+	if isinstance(value, bytearray):
+		return buffer(value)
+	return value
+
+########################################################################
+# Returns the declared type of a new column from its values.
+def _sqliteType(values):
+	for value in values:
+		if value is None:
+			continue
+		if isinstance(value, bool) or isinstance(value, (int, long)):
+			return 'INTEGER'
+		if isinstance(value, (float, Decimal)):
+			return 'REAL'
+		if isinstance(value, datetime):
+			return 'DATETIME'
+		if isinstance(value, (bytearray, buffer)):
+			return 'BLOB'
+		return 'TEXT'
+	return 'TEXT'
+
+########################################################################
+# Returns the point of a row as GeoPackage binary: the GP header with the srid and no envelope,
+# followed by the little-endian WKB of the point. None when the row has no coordinates.
+def _pointBlob(row, fields, dataset, srid):
+	if not dataset.xField in fields or not dataset.yField in fields:
+		return None
+	x = row[fields[dataset.xField]]
+	y = row[fields[dataset.yField]]
+	if x is None or y is None:
+		return None
+	return buffer(struct.pack('<2sBBiBIdd', 'GP', 0, 1, srid, 1, 1, float(x), float(y)))
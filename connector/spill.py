@@ -0,0 +1,290 @@
+import os, sys, traceback, logging
+import json, shutil, cPickle
+from decimal import Decimal
+from datetime import datetime, date, timedelta
+from time import strftime
+import util
+numpy = util.LazyModule('numpy')
+
+#Kinds of spilled columns whose values are kept in a string table.
+_STRING_KINDS = ('str', 'unicode', 'binary', 'decimal', 'object')
+
+_EPOCH = datetime(1970, 1, 1)
+
+#File written to a spill folder when all blocks of the CDC query were spilled.
+_COMPLETE = 'complete.json'
+
+###################################################################################################
+###################################################################################################
+#
+# class:	spill.SpillWriter
+# purpose:	Writes the blocks of CDC records read from SQL Server to a folder in the replica's
+#			spillPath, so that an import can be repeated from disk without reading Warehouse again.
+#
+# notes:	Every block is a folder with one NumPy .npy file per column, which SpillReader opens
+#			memory mapped. Numbers are stored as int64 or float64, dates as int64 microseconds,
+#			days of date columns as int64 ordinals, and text and binary values as indexes into a
+#			string table that holds every distinct value once. Decimal values are kept as text
+#			in a string table, and the values of a column whose values are of different types
+#			are pickled, so that every value is read back with the type and value it was read
+#			from SQL Server with. Columns with Null values get a separate boolean mask.
+#
+#			A spill without blocks, of a dataset without changes, is complete as well, so that it
+#			replaces the older spills of the dataset.
+#
+#			A spill is only read once it is complete. When a new spill of a dataset is complete,
+#			the older spills of the dataset are deleted.
+#
+###################################################################################################
+
+class SpillWriter(object):
+	#dataset: The db.Dataset whose CDC records are spilled
+	def __init__(self, dataset):
+		self.dataset = dataset
+		self.folder = getSpillFolder(dataset)
+		self.path = os.path.join(self.folder, strftime('%Y%m%d_%H%M%S'))
+		self.numBlocks = 0
+		self.numRecords = 0
+		return
+
+	def __str__(self):
+		return self.path
+
+	########################################################################
+	# Generator that writes every (rows, fields) block of blocks to disk and passes it on.
+	# The spill is marked complete when blocks is exhausted.
+	def spill(self, blocks):
+		func = 'SpillWriter.spill'
+		for rows, fields in blocks:
+			self.write(rows, fields)
+			yield (rows, fields)
+		try:
+			if not os.path.isdir(self.path):
+				os.makedirs(self.path)
+			with open(os.path.join(self.path, _COMPLETE), 'w') as f:
+				json.dump({'blocks':self.numBlocks, 'records':self.numRecords, 'table':self.dataset.cdcTable}, f)
+			logging.debug('Spilled ' + str(self.numRecords) + ' CDC records of ' + str(self.dataset) + ' to ' + self.path)
+			self._removeOlder()
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+
+	def write(self, rows, fields):
+		folder = os.path.join(self.path, 'block_%06d' % self.numBlocks)
+		os.makedirs(folder)
+		names = [None] * len(fields)
+		for name in fields:
+			names[fields[name]] = name
+		kinds = []
+		for i in xrange(len(names)):
+			values = [row[i] for row in rows]
+			kind = _getKind(values)
+			_writeColumn(os.path.join(folder, 'c%d' % i), kind, values)
+			kinds.append(kind)
+		with open(os.path.join(folder, 'columns.json'), 'w') as f:
+			json.dump({'names':names, 'kinds':kinds, 'rows':len(rows)}, f)
+		self.numBlocks = self.numBlocks + 1
+		self.numRecords = self.numRecords + len(rows)
+		return
+
+	def _removeOlder(self):
+		for name in os.listdir(self.folder):
+			path = os.path.join(self.folder, name)
+			if path != self.path and os.path.isdir(path):
+				shutil.rmtree(path, True)
+		return
+
+###################################################################################################
+###################################################################################################
+#
+# class:	spill.SpillReader
+# purpose:	Reads the blocks of a complete spill, see SpillWriter, in the order they were
+#			read from SQL Server.
+#
+###################################################################################################
+
+class SpillReader(object):
+	#path: Folder of the spill
+	def __init__(self, path):
+		self.path = path
+		return
+
+	def __str__(self):
+		return self.path
+
+	########################################################################
+	# Generator that yields the blocks as (rows, fields) tuples, the same as db.Dataset.getChangeBlocks.
+	def getBlocks(self):
+		names = sorted([name for name in os.listdir(self.path) if name.startswith('block_')])
+		for name in names:
+			yield self.readBlock(os.path.join(self.path, name))
+
+	def readBlock(self, folder):
+		with open(os.path.join(folder, 'columns.json'), 'r') as f:
+			columns = json.load(f)
+		numRows = columns['rows']
+		values = []
+		for i in xrange(len(columns['kinds'])):
+			values.append(_readColumn(os.path.join(folder, 'c%d' % i), columns['kinds'][i], numRows))
+		rows = [list(row) for row in zip(*values)]
+		fields = dict()
+		for i in xrange(len(columns['names'])):
+			fields[columns['names'][i]] = i
+		return (rows, fields)
+
+########################################################################
+# Returns the folder in which the spills of a dataset are kept.
+def getSpillFolder(dataset):
+	name = ''.join([c if c.isalnum() else '_' for c in dataset.cdcTable])
+	return os.path.join(dataset.replica.spillPath, name)
+
+########################################################################
+# Returns the path of the most recent complete spill of a dataset, or None.
+def getLatestSpill(dataset):
+	folder = getSpillFolder(dataset)
+	if not os.path.isdir(folder):
+		return None
+	for name in sorted(os.listdir(folder), reverse = True):
+		if os.path.exists(os.path.join(folder, name, _COMPLETE)):
+			return os.path.join(folder, name)
+	return None
+
+def _getKind(values):
+	kind = None
+	for value in values:
+		if value is None:
+			continue
+		if isinstance(value, bool):
+			valueKind = 'bool'
+		elif isinstance(value, (int, long)):
+			valueKind = 'int'
+		elif isinstance(value, float):
+			valueKind = 'float'
+		elif isinstance(value, Decimal):
+			valueKind = 'decimal'
+		elif isinstance(value, datetime):
+			valueKind = 'date'
+		elif isinstance(value, date):
+			valueKind = 'day'
+		elif isinstance(value, (bytearray, buffer)):
+			valueKind = 'binary'
+		elif isinstance(value, str):
+			valueKind = 'str'
+		else:
+			valueKind = 'unicode'
+		if kind is None or kind == valueKind:
+			kind = valueKind
+		else:
+			return 'object'
+	if kind is None:
+		return 'null'
+	return kind
+
+def _writeColumn(path, kind, values):
+	if kind == 'null':
+		return
+	nulls = [value is None for value in values]
+	if True in nulls:
+		numpy.save(path + '_null.npy', numpy.array(nulls, dtype = numpy.bool_))
+	if kind == 'int':
+		data = numpy.array([0 if value is None else value for value in values], dtype = numpy.int64)
+	elif kind == 'bool':
+		data = numpy.array([0 if value is None else int(value) for value in values], dtype = numpy.int8)
+	elif kind == 'float':
+		data = numpy.array([0.0 if value is None else float(value) for value in values], dtype = numpy.float64)
+	elif kind == 'date':
+		data = numpy.array([0 if value is None else _toMicroseconds(value) for value in values], dtype = numpy.int64)
+	elif kind == 'day':
+		data = numpy.array([0 if value is None else value.toordinal() for value in values], dtype = numpy.int64)
+	else:
+		data = _writeStrings(path, kind, values)
+	numpy.save(path + '.npy', data)
+	return
+
+########################################################################
+# Writes the distinct values of a text or binary column to a string table.
+# returns the array of string table indexes of the values, -1 for Null
+def _writeStrings(path, kind, values):
+	table = dict()
+	strings = []
+	indexes = []
+	for value in values:
+		if value is None:
+			indexes.append(-1)
+			continue
+		if kind == 'binary':
+			value = str(value)
+		elif kind == 'decimal':
+			value = str(value)
+		elif kind == 'object':
+			value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+		elif kind == 'unicode':
+			if isinstance(value, str):
+				value = value.decode('cp1252', 'replace')
+			value = unicode(value).encode('utf-8')
+		index = table.get(value)
+		if index is None:
+			index = len(strings)
+			table[value] = index
+			strings.append(value)
+		indexes.append(index)
+	if len(strings) > 0:
+		offsets = [0]
+		for value in strings:
+			offsets.append(offsets[-1] + len(value))
+		numpy.save(path + '_strings.npy', numpy.array(bytearray(''.join(strings)), dtype = numpy.uint8))
+		numpy.save(path + '_offsets.npy', numpy.array(offsets, dtype = numpy.int64))
+	return numpy.array(indexes, dtype = numpy.int32)
+
+def _readColumn(path, kind, numRows):
+	if kind == 'null':
+		return [None] * numRows
+	data = numpy.load(path + '.npy', mmap_mode = 'r')
+	if kind in _STRING_KINDS:
+		values = _readStrings(path, kind, data)
+	elif kind == 'date':
+		values = [_EPOCH + timedelta(microseconds = value) for value in data.tolist()]
+	elif kind == 'day':
+		values = [date.fromordinal(value) if value > 0 else None for value in data.tolist()]
+	elif kind == 'bool':
+		values = [value != 0 for value in data.tolist()]
+	else:
+		values = data.tolist()
+	if os.path.exists(path + '_null.npy'):
+		nulls = numpy.load(path + '_null.npy', mmap_mode = 'r').tolist()
+		values = [None if nulls[i] else values[i] for i in xrange(numRows)]
+	return values
+
+def _readStrings(path, kind, data):
+	if not os.path.exists(path + '_strings.npy'):
+		return [None] * len(data)
+	strings = numpy.load(path + '_strings.npy', mmap_mode = 'r')
+	offsets = numpy.load(path + '_offsets.npy', mmap_mode = 'r').tolist()
+	table = dict()
+	values = []
+	for index in data.tolist():
+		if index < 0:
+			values.append(None)
+			continue
+		value = table.get(index)
+		if value is None:
+			value = strings[offsets[index]:offsets[index + 1]].tostring()
+			if kind == 'unicode':
+				value = value.decode('utf-8')
+			elif kind == 'decimal':
+				value = Decimal(value)
+			table[index] = value
+		if kind == 'binary':
+			#Every row gets its own bytearray, like the rows that pyodbc returns.
+			values.append(bytearray(value))
+		elif kind == 'object':
+			values.append(cPickle.loads(value))
+		else:
+			values.append(value)
+	return values
+
+def _toMicroseconds(value):
+	delta = value.replace(tzinfo = None) - _EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
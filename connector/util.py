@@ -1,4 +1,5 @@
-import traceback, os, sys, logging
+import traceback, os, sys, logging, errno
+import time, importlib
 from datetime import datetime
 from datetime import timedelta
 
@@ -77,16 +78,28 @@ class LockFile(object):
 	def locked(self):
 		return os.path.exists(self._path)
 		
+	########################################################################
+	# Creates the lock file. The file is created only if it doesn't exist in one step, so two
+	# processes that start at the same time can't both get the lock.
+	# returns False if the lock file exists
 	def lock(self):
 		try:
-			with open(self._path, 'w') as f:
+			fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except OSError as e:
+			if e.errno == errno.EEXIST:
+				return False
+			logging.error('Error writing lock file')
+			logging.exception(e)
+			return True
+		try:
+			with os.fdopen(fd, 'w') as f:
 				logging.info("Writing lock file.")
 				dateutil = DateUtil()
 				f.write(dateutil.now())
 		except Exception as e:
 			logging.error('Error writing lock file')
 			logging.exception(e)
-		return
+		return True
 		
 	def unlock(self):
 		try:
@@ -97,3 +110,33 @@ class LockFile(object):
 			logging.error('Error removing lock file')
 			logging.exception(e)
 		return
+
+###################################################################################################
+###################################################################################################
+#
+# class:	LazyModule
+# purpose:	Stands in for a module that is slow to import, such as arcpy. The module is imported
+#			the first time one of its attributes is used, so runs that exit early, or only read
+#			SQL Server, don't pay for it.
+#
+###################################################################################################
+
+class LazyModule(object):
+	def __init__(self, name):
+		self.__dict__['_name'] = name
+		self.__dict__['_module'] = None
+		
+	def _load(self):
+		module = self.__dict__['_module']
+		if module is None:
+			started = time.time()
+			module = importlib.import_module(self.__dict__['_name'])
+			self.__dict__['_module'] = module
+			logging.debug('Imported ' + self.__dict__['_name'] + ' in ' + ('%.1f' % (time.time() - started)) + 's')
+		return module
+		
+	def __getattr__(self, name):
+		return getattr(self._load(), name)
+		
+	def __setattr__(self, name, value):
+		setattr(self._load(), name, value)
@@ -0,0 +1,126 @@
+import os, sys, traceback, logging
+import json
+import util
+arcpy = util.LazyModule('arcpy')
+
+###################################################################################################
+###################################################################################################
+#
+# class:	versions.VersionState
+# purpose:	The state of a geodatabase version: its state ID in the SDE repository, if known,
+#			and the time of its last modification.
+#
+###################################################################################################
+
+class VersionState(object):
+	def __init__(self, name, stateId, modified):
+		self.name = name
+		self.stateId = stateId
+		self.modified = modified
+		return
+
+	def __str__(self):
+		return self.name
+
+	def toDict(self):
+		return {'stateId':self.stateId, 'modified':self.modified}
+
+###################################################################################################
+###################################################################################################
+#
+# class:	versions.ReconcilePlanner
+# purpose:	Decides which staging edit versions have to be reconciled and posted. A version is
+#			only reconciled when its state changed since it was last reconciled, the states are
+#			saved in a JSON file in the replica's tempPath.
+#
+# notes:	When the replica has a stagingRepository (e.g. "Staging.dbo"), the state IDs are read
+#			from SDE_versions and SDE_states over the replica's ODBC connection. Otherwise only
+#			the lastModified time from arcpy.da.ListVersions is compared.
+#
+#			Versions are reconciled most recently edited first. FAVOR_TARGET_VERSION keeps what
+#			was posted first, so when two versions changed the same row the latest edit is kept.
+#
+###################################################################################################
+
+class ReconcilePlanner(object):
+	#replica: The db.Replica whose staging edit versions are reconciled
+	def __init__(self, replica):
+		self.replica = replica
+		name = ''.join([c if c.isalnum() else '_' for c in replica.name])
+		self.statePath = os.path.join(replica.tempPath, 'versions_' + name + '.json')
+		return
+
+	########################################################################
+	# Returns the VersionState objects of the edit versions that changed since the last
+	# reconcile, in the order in which they should be reconciled, and the list of idle versions.
+	def plan(self):
+		current = self.getStates()
+		previous = self._load()
+		changed = []
+		idle = []
+		for name in self.replica.stagingEditVersions:
+			state = current.get(name.upper())
+			if state is None:
+				logging.warn('Version ' + name + ' was not found in ' + self.replica.stagingWorkspace)
+				continue
+			last = previous.get(name.upper())
+			if last is not None and last['stateId'] == state.stateId and last['modified'] == state.modified:
+				idle.append(state)
+			else:
+				changed.append(state)
+		changed.sort(key = lambda state: state.modified, reverse = True)
+		return (changed, idle)
+
+	########################################################################
+	# Saves the current state of the versions that were reconciled.
+	def save(self, names):
+		func = 'ReconcilePlanner.save'
+		try:
+			current = self.getStates()
+			states = self._load()
+			for name in names:
+				state = current.get(name.upper())
+				if state is not None:
+					states[name.upper()] = state.toDict()
+			with open(self.statePath, 'w') as f:
+				json.dump(states, f, indent = 1)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error in " + func + ":\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg)
+		return
+
+	########################################################################
+	# Returns a dictionary of upper case version name to VersionState.
+	def getStates(self):
+		if self.replica.stagingRepository is not None and self.replica.isConnected():
+			return self._getRepositoryStates()
+		states = dict()
+		for version in arcpy.da.ListVersions(self.replica.stagingWorkspace):
+			states[version.name.upper()] = VersionState(version.name, None, str(version.lastModified))
+		return states
+
+	def _getRepositoryStates(self):
+		repository = self.replica.stagingRepository
+		sql = 'SELECT v.owner, v.name, v.state_id, s.closing_time FROM ' + repository + '.SDE_versions v JOIN ' + repository + '.SDE_states s ON s.state_id = v.state_id'
+		states = dict()
+		cursor = self.replica.getConnection().cursor()
+		try:
+			cursor.execute(sql)
+			for row in cursor.fetchall():
+				name = row[0] + '.' + row[1]
+				states[name.upper()] = VersionState(name, row[2], str(row[3]))
+		finally:
+			self.replica.close(cursor)
+		return states
+
+	def _load(self):
+		if not os.path.exists(self.statePath):
+			return dict()
+		try:
+			with open(self.statePath, 'r') as f:
+				return json.load(f)
+		except:
+			logging.warn('Could not read ' + self.statePath + ', all versions will be reconciled')
+		return dict()
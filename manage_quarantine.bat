@@ -0,0 +1 @@
+C:\Python27\ArcGIS10.1\python.exe "manage_quarantine.py" %*
\ No newline at end of file
@@ -0,0 +1,137 @@
+# notes:	Inspects, fixes and replays the CDC changes that were quarantined by sqlserver_to_sde.py.
+#
+# usage:	manage_quarantine.py list [--dataset TABLE] [--status STATUS]
+#			manage_quarantine.py show ID
+#			manage_quarantine.py set ID COLUMN VALUE [--type str|int|float|date] [--null]
+#			manage_quarantine.py replay [ID ...]
+#			manage_quarantine.py discard ID [ID ...]
+#
+#			--replica NAME limits the command to one replica. Dates are entered as YYYY-MM-DD HH:MM:SS.
+import os, sys, traceback, argparse
+import logging, logging.handlers
+from datetime import datetime
+from connector import util
+from connector import db
+from connector import quarantine
+
+def configure_logger(path):
+	print('Logger writing to ' + path)
+	msg_format = "%(asctime)s %(levelname)s \t %(message)s";
+	logging.basicConfig(level=logging.DEBUG, format=msg_format)
+	handler = logging.handlers.TimedRotatingFileHandler(path, 'D', 1, 30)
+	formatter = logging.Formatter(msg_format);
+	handler.setFormatter(formatter)
+	logging.getLogger('').addHandler(handler);
+	return;
+
+def parse_args():
+	parser = argparse.ArgumentParser(description = 'Inspect, fix and replay quarantined CDC changes.')
+	parser.add_argument('--replica', help = 'Name of the replica, all replicas if omitted')
+	commands = parser.add_subparsers(dest = 'command')
+
+	cmd = commands.add_parser('list', help = 'List quarantine entries')
+	cmd.add_argument('--dataset', help = 'CDC table of the dataset')
+	cmd.add_argument('--status', default = 'quarantined', help = 'retry, quarantined, replayed, superseded, discarded or all')
+
+	cmd = commands.add_parser('show', help = 'Show the column values of an entry')
+	cmd.add_argument('id', type = int)
+
+	cmd = commands.add_parser('set', help = 'Change a column value of an entry')
+	cmd.add_argument('id', type = int)
+	cmd.add_argument('column')
+	cmd.add_argument('value', nargs = '?')
+	cmd.add_argument('--type', default = 'str', choices = ['str', 'int', 'float', 'date'])
+	cmd.add_argument('--null', action = 'store_true', help = 'Set the column to Null')
+
+	cmd = commands.add_parser('replay', help = 'Write quarantined entries to SDE again')
+	cmd.add_argument('ids', type = int, nargs = '*')
+
+	cmd = commands.add_parser('discard', help = 'Mark entries as discarded, they are no longer replayed')
+	cmd.add_argument('ids', type = int, nargs = '+')
+	return parser.parse_args()
+
+def parse_value(args):
+	if args.null:
+		return None
+	if args.type == 'int':
+		return int(args.value)
+	if args.type == 'float':
+		return float(args.value)
+	if args.type == 'date':
+		return datetime.strptime(args.value, '%Y-%m-%d %H:%M:%S')
+	return args.value
+
+def list_entries(store, args):
+	status = args.status
+	if status == 'all':
+		status = None
+	for entry in store.getEntries(args.dataset, status):
+		error = entry.error or ''
+		print('%6d  %-10s %-8s %-40s %-20s attempts: %d, last failed: %s' % (entry.id, entry.status, entry.op, entry.dataset, str(entry.key), entry.attempts, entry.lastFailed))
+		print('        ' + error.strip().replace('\n', ' ')[:200])
+	return
+
+def show_entry(store, args):
+	for entry in store.getEntries(ids = [args.id]):
+		print(str(entry) + ' (' + entry.status + ', ' + entry.op + ')')
+		print('Error: ' + str(entry.error))
+		print('CDC keys: ' + ', '.join(entry.cdcKeys))
+		for column in entry.getColumns():
+			print('\t' + column + ' = ' + repr(entry.row[entry.fields[column]]))
+	return
+
+def run(connectorConfig, args):
+	replicas = db.Replicas(connectorConfig['replicas'])
+	for replica in replicas.replicas:
+		if args.replica is not None and replica.name != args.replica:
+			continue
+		if not os.path.exists(replica.quarantinePath):
+			logging.info('No quarantine for ' + replica.name)
+			continue
+		if args.command == 'replay':
+			from connector import io
+			importer = io.SqlServerImporter(replicas, connectorConfig['clearCdc'])
+			n = importer.replayQuarantine(replica, args.ids)
+			print('Replayed ' + str(n) + ' changes for ' + replica.name)
+			continue
+		store = quarantine.QuarantineStore(replica.quarantinePath)
+		try:
+			if args.command == 'list':
+				list_entries(store, args)
+			elif args.command == 'show':
+				show_entry(store, args)
+			elif args.command == 'set':
+				if store.setValue(args.id, args.column, parse_value(args)):
+					print('Updated ' + args.column + ' of entry ' + str(args.id))
+			elif args.command == 'discard':
+				for entryId in args.ids:
+					store.setStatus(entryId, 'discarded')
+		finally:
+			store.close()
+	return
+
+if __name__ == "__main__":
+	connectorConfig = None
+	args = parse_args()
+
+	try:
+		import config
+		connectorConfig = config.connector
+		configure_logger(connectorConfig['importLogFile'])
+		logging.debug('Config file read successfully')
+	except:
+		tb = sys.exc_info()[2]
+		tbinfo = traceback.format_tb(tb)[0]
+		msg = "Error reading config file:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+		logging.error(msg);
+
+	if connectorConfig is not None:
+		try:
+			run(connectorConfig, args)
+		except:
+			tb = sys.exc_info()[2]
+			tbinfo = traceback.format_tb(tb)[0]
+			msg = "Error managing quarantine:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
+			logging.error(msg);
+	else:
+		print('No config')
@@ -1,9 +1,10 @@
 # notes:	Need to install 32-bit Python ODBC client (pyodbc), 64-bit doesn't work with ESRI's python installation
-import os, sys, traceback
+import os, sys, traceback, argparse
 import logging, logging.handlers
 from connector import util
 from connector import db
 from connector import io
+from connector import profiling
 
 def configure_logger(path):
 	print('Logger writing to ' + path)
@@ -15,13 +16,32 @@ def configure_logger(path):
 	logging.getLogger('').addHandler(handler);
 	return;
 	
-def run(replicas):
-	exporter = io.GeodatabaseExporter(replicas)
-	exporter.run()
+def get_option(connectorConfig, name, default):
+	if name in connectorConfig:
+		return connectorConfig[name]
+	return default
+	
+def parse_args():
+	parser = argparse.ArgumentParser(description = 'Exports the edits of the staging geodatabase to an XML change file for BG-BASE and synchronizes production.')
+	parser.add_argument('--profile', action = 'store_true', help = 'Profile the run and write the profiles to the tempPath of the first replica')
+	return parser.parse_args()
+	
+def run(replicas, connectorConfig, args):
+	exporter = io.GeodatabaseExporter(replicas, get_option(connectorConfig, 'maxParallelReplicas', 1), get_option(connectorConfig, 'reportPath', None))
+	profiler = None
+	if args.profile and len(replicas.replicas) > 0:
+		profiler = profiling.RunProfiler('profile_export', replicas.replicas[0].tempPath)
+		profiler.start()
+	try:
+		exporter.run()
+	finally:
+		if profiler is not None:
+			profiler.stop()
 	return
 		
 if __name__ == "__main__":
 	connectorConfig = None
+	args = parse_args()
 	
 	try:
 		import config
@@ -38,7 +58,7 @@ if __name__ == "__main__":
 		try:
 			replicaConfig = connectorConfig['replicas']
 			replicas = db.Replicas(replicaConfig)
-			run(replicas)
+			run(replicas, connectorConfig, args)
 		except:
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
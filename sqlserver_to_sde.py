@@ -1,9 +1,10 @@
 # notes:	Need to install 32-bit Python ODBC client (pyodbc), 64-bit doesn't work with ESRI's python installation
-import os, sys, traceback
+import os, sys, time, traceback, argparse
 import logging, logging.handlers
 from connector import util
 from connector import db
 from connector import io
+from connector import profiling
 
 def configure_logger(path):
 	print('Logger writing to ' + path)
@@ -15,13 +16,61 @@ def configure_logger(path):
 	logging.getLogger('').addHandler(handler);
 	return;
 	
-def run(replicas):
-	importer = io.SqlServerImporter(replicas)
-	importer.run()
-	return
+def get_option(connectorConfig, name, default):
+	if name in connectorConfig:
+		return connectorConfig[name]
+	return default
+	
+def parse_args():
+	parser = argparse.ArgumentParser(description = 'Imports the SQL Server CDC changes into the staging geodatabase and synchronizes production.')
+	parser.add_argument('--plan', action = 'store_true', help = 'Report what the import would change and how long it would take, without writing to SDE or clearing CDC')
+	parser.add_argument('--from-spill', action = 'store_true', dest = 'fromSpill', help = 'Read the CDC records that the last run spilled to disk instead of reading them from SQL Server')
+	parser.add_argument('--max-runtime', type = float, dest = 'maxRuntime', help = 'Stop importing after this many seconds, the next run continues where this one stopped')
+	parser.add_argument('--profile', action = 'store_true', help = 'Profile the run and write the profiles to the tempPath of the first replica')
+	parser.add_argument('--check', action = 'store_true', help = 'Check the config file and the connection to SQL Server, without loading arcpy')
+	parser.add_argument('--reconcile', action = 'store_true', help = 'Compare the Warehouse tables with the geodatabase and report the rows that differ')
+	parser.add_argument('--repair', action = 'store_true', help = 'Like --reconcile, and write the differences to the geodatabase')
+	return parser.parse_args()
+	
+def check(replicas):
+	started = time.time()
+	num_problems = 0
+	for replica in replicas.replicas:
+		problems = replica.check()
+		for problem in problems:
+			print(replica.name + ': ' + problem)
+		if len(problems) == 0:
+			print(replica.name + ': OK')
+		num_problems = num_problems + len(problems)
+	print('Checked ' + str(len(replicas.replicas)) + ' replicas in ' + ('%.2f' % (time.time() - started)) + 's, ' + str(num_problems) + ' problems')
+	return num_problems == 0
+	
+def run(replicas, connectorConfig, args):
+	if args.check:
+		return check(replicas)
+	maxRuntime = args.maxRuntime
+	if maxRuntime is None:
+		maxRuntime = get_option(connectorConfig, 'maxRuntime', None)
+	importer = io.SqlServerImporter(replicas, connectorConfig['clearCdc'], get_option(connectorConfig, 'maxParallelReplicas', 1), get_option(connectorConfig, 'reportPath', None), args.fromSpill, maxRuntime)
+	profiler = None
+	if args.profile and len(replicas.replicas) > 0:
+		profiler = profiling.RunProfiler('profile_import', replicas.replicas[0].tempPath)
+		profiler.start()
+	try:
+		if args.plan:
+			importer.plan()
+		elif args.reconcile or args.repair:
+			importer.reconcile(args.repair)
+		else:
+			importer.run()
+	finally:
+		if profiler is not None:
+			profiler.stop()
+	return True
 		
 if __name__ == "__main__":
 	connectorConfig = None
+	args = parse_args()
 	
 	try:
 		import config
@@ -34,15 +83,18 @@ if __name__ == "__main__":
 		msg = "Error reading config file:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 		logging.error(msg);
 	
+	succeeded = False
 	if connectorConfig is not None:
 		try:
 			replicaConfig = connectorConfig['replicas']
 			replicas = db.Replicas(replicaConfig)
-			run(replicas)
+			succeeded = run(replicas, connectorConfig, args)
 		except:
 			tb = sys.exc_info()[2]
 			tbinfo = traceback.format_tb(tb)[0]
 			msg = "Error parsing config file:\n" + tbinfo + "\nError Info:\n" + str(sys.exc_info()[1])
 			logging.error(msg);
 	else:
-		print('No config')
\ No newline at end of file
+		print('No config')
+	if args.check and not succeeded:
+		sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,60 @@
+###################################################################################################
+###################################################################################################
+#
+# module:	arcpy
+# purpose:	Stand-in for arcpy in the tests, which run without ArcGIS. It only has the edit
+#			sessions of arcpy.da.Editor, and like arcpy it refuses a second edit session of a
+#			workspace in the same process, so a test fails when jobs that edit run on threads of
+#			one process instead of in worker processes.
+#
+###################################################################################################
+
+import threading
+
+#Workspaces that are being edited in this process.
+_editing = set()
+_lock = threading.Lock()
+
+class ExecuteError(Exception):
+	pass
+
+class _Editor(object):
+	def __init__(self, workspace):
+		self.workspace = workspace
+		self.isEditing = False
+		return
+
+	def startEditing(self, withUndo = True, multiuserMode = False):
+		with _lock:
+			if self.workspace in _editing:
+				raise RuntimeError('The workspace ' + self.workspace + ' is already being edited in this process')
+			_editing.add(self.workspace)
+		self.isEditing = True
+		return
+
+	def startOperation(self):
+		return
+
+	def stopOperation(self):
+		return
+
+	def abortOperation(self):
+		return
+
+	def stopEditing(self, saveChanges):
+		with _lock:
+			_editing.discard(self.workspace)
+		self.isEditing = False
+		return
+
+class da(object):
+	Editor = _Editor
+
+def AddError(msg):
+	return
+
+def AddMessage(msg):
+	return
+
+def GetMessages(severity = 0):
+	return ''
@@ -0,0 +1,14 @@
+###################################################################################################
+###################################################################################################
+#
+# module:	pyodbc
+# purpose:	Stand-in for pyodbc in the tests, which run without SQL Server, so that the connector
+#			modules can be imported. Connecting fails like it does when SQL Server is down.
+#
+###################################################################################################
+
+class Error(Exception):
+	pass
+
+def connect(connectionString, **kwargs):
+	raise Error('There is no SQL Server in the tests')
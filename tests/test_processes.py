@@ -0,0 +1,104 @@
+###################################################################################################
+###################################################################################################
+#
+# purpose:	Tests of processes.Worker: a worker can start workers of its own, like a ShardedEditor
+#			in the worker of an io.DatasetWorker, and the records that workers log are written by
+#			the handlers of the test process.
+#
+#			Run from the folder of the repository with: python -m unittest discover -s tests
+#
+###################################################################################################
+
+import os, sys, logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connector import db, io, processes
+
+_CONFIG = {'name':'test', 'sqlServer':{'server':'test', 'database':'test'}, 'tempPath':'.', 'exportPath':'.', 'lockFilePath':'test.loc',
+	'deleteTempFiles':True, 'autoReconcile':True, 'stagingWorkspace':'staging', 'productionWorkspace':'production', 'sqlserverEditVersion':'test',
+	'stagingEditVersions':[], 'stagingDefaultVersion':'test',
+	'datasets':[{'cdcFunction':'test', 'shards':2, 'sqlserverDataset':{'table':'W.cdc.T_CT', 'primaryKey':'ID'}, 'sdeDataset':{'table':'Staging.dbo.T', 'primaryKey':'ID'}}]}
+
+#Object of a worker that starts a worker of its own and logs in both.
+class _Parent(object):
+	def __init__(self):
+		logging.info('Started the parent worker')
+		return
+
+	def childPid(self):
+		worker = processes.Worker('child', _Child)
+		try:
+			return worker.call('getPid')
+		finally:
+			worker.stop()
+
+class _Child(object):
+	def getPid(self):
+		logging.warn('Started the child worker')
+		return os.getpid()
+
+#Writes changes with a ShardedEditor in a worker, like a DatasetImport in the worker of a DatasetWorker.
+class _ShardedImport(object):
+	def __init__(self, config):
+		replica = db.Replica(config)
+		self.editor = io.ShardedEditor('test', replica.datasets[0], 2, 10, 60)
+		return
+
+	#returns the keys of the changes that were saved and the (key, error) of those that failed
+	def write(self, keys):
+		for key in keys:
+			self.editor.add(db.Change('insert', key, [key], None), {'ID':0})
+		self.editor.close()
+		return ([change.key for change in self.editor.committed], [(change.key, change.error) for change, fields in self.editor.failed])
+
+class _Records(logging.Handler):
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.records = []
+		return
+
+	def emit(self, record):
+		self.records.append((record.processName, record.getMessage()))
+		return
+
+class WorkerTest(unittest.TestCase):
+	def setUp(self):
+		self.records = _Records()
+		self.level = logging.getLogger('').level
+		logging.getLogger('').addHandler(self.records)
+		logging.getLogger('').setLevel(logging.INFO)
+		return
+
+	def tearDown(self):
+		logging.getLogger('').removeHandler(self.records)
+		logging.getLogger('').setLevel(self.level)
+		return
+
+	def test_workerStartsWorker(self):
+		worker = processes.Worker('parent', _Parent)
+		try:
+			pid = worker.call('childPid')
+		finally:
+			worker.stop()
+		self.assertNotEqual(pid, os.getpid())
+		self.assertEqual(self.records.records, [('parent', 'Started the parent worker'), ('child', 'Started the child worker')])
+		return
+
+	def test_shardedEditorInWorker(self):
+		worker = processes.Worker('dataset', _ShardedImport, (_CONFIG,))
+		try:
+			committed, failed = worker.call('write', range(1, 5))
+		finally:
+			worker.stop()
+		#The stand-in of arcpy has edit sessions but no cursors, every change comes back from its shard as failed.
+		self.assertEqual(committed, [])
+		self.assertEqual(sorted([key for key, error in failed]), [1, 2, 3, 4])
+		for key, error in failed:
+			self.assertTrue(error is not None)
+		return
+
+if __name__ == '__main__':
+	unittest.main()
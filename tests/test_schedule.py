@@ -0,0 +1,199 @@
+###################################################################################################
+###################################################################################################
+#
+# purpose:	Tests of schedule.DependencyScheduler: the inserts of the parents are imported before
+#			those of their children, the deletes of the children before those of their parents,
+#			and the children of a dataset that failed are skipped. The jobs edit the workspace of
+#			the arcpy stand-in, serially in the test process, and at the same time in worker
+#			processes like io.DatasetWorker, where independent branches finish faster than
+#			one after the other.
+#
+#			Run from the folder of the repository with: python -m unittest discover -s tests
+#
+###################################################################################################
+
+import os, sys, time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arcpy
+from connector import processes, schedule
+
+#Job that edits the workspace in every batch and in applyDeletes, like io.DatasetImport.
+class _Job(object):
+	def __init__(self, name, numBatches, fail = False):
+		self.name = name
+		self.numBatches = numBatches
+		self.numSteps = 0
+		self.fail = fail
+		self.failed = False
+		self.interrupted = False
+		return
+
+	def step(self):
+		if self.fail:
+			self.failed = True
+			return False
+		if self.numSteps == self.numBatches:
+			return False
+		self._edit()
+		self.numSteps = self.numSteps + 1
+		return True
+
+	def interrupt(self):
+		self.interrupted = True
+		return
+
+	def applyDeletes(self):
+		if not self.failed:
+			self._edit()
+		return
+
+	def _edit(self):
+		editor = arcpy.da.Editor('staging')
+		editor.startEditing(False, True)
+		time.sleep(0.02)
+		editor.stopEditing(True)
+		return
+
+#Job of the scheduler that records when the calls of a _Job start and end, the _Job runs in the
+#test process or in a worker.
+class _RecordedJob(object):
+	def __init__(self, name, events, numBatches = 3, fail = False, inWorker = False):
+		self.name = name
+		self.events = events
+		self.priority = 1
+		self.failed = False
+		self._job = None
+		self._worker = None
+		if inWorker:
+			self._worker = processes.Worker(name, _Job, (name, numBatches, fail))
+		else:
+			self._job = _Job(name, numBatches, fail)
+		return
+
+	def __str__(self):
+		return self.name
+
+	def step(self):
+		return self._call('step', 'insert')
+
+	def interrupt(self):
+		return self._call('interrupt', 'interrupt')
+
+	def applyDeletes(self):
+		return self._call('applyDeletes', 'delete')
+
+	def close(self):
+		if self._worker is not None:
+			self._worker.stop()
+		return
+
+	def _call(self, method, phase):
+		self.events.append((phase, self.name, 'start'))
+		if self._worker is not None:
+			result = self._worker.call(method)
+			self.failed = self._worker.get('failed')
+		else:
+			result = getattr(self._job, method)()
+			self.failed = self._job.failed
+		self.events.append((phase, self.name, 'end'))
+		return result
+
+class DependencySchedulerTest(unittest.TestCase):
+	maxParallel = 1
+	inWorker = False
+
+	def setUp(self):
+		self.events = []
+		self.jobs = []
+		self.scheduler = schedule.DependencyScheduler('test', self.maxParallel)
+		return
+
+	def tearDown(self):
+		for job in self.jobs:
+			job.close()
+		return
+
+	def addJob(self, name, parents = [], fail = False):
+		job = _RecordedJob(name, self.events, fail = fail, inWorker = self.inWorker)
+		self.jobs.append(job)
+		self.scheduler.add(job, parents)
+		return job
+
+	def calls(self, phase, name):
+		return [i for i in range(0, len(self.events)) if self.events[i][0] == phase and self.events[i][1] == name]
+
+	def test_parentsInsertFirst(self):
+		parent = self.addJob('parent')
+		self.addJob('child', [parent])
+		self.addJob('other')
+		self.scheduler.run()
+		self.assertEqual(len(self.calls('insert', 'child')), 8)
+		self.assertTrue(max(self.calls('insert', 'parent')) < min(self.calls('insert', 'child')))
+		self.assertEqual(self.scheduler.skipped, [])
+		return
+
+	def test_childrenDeleteFirst(self):
+		parent = self.addJob('parent')
+		child = self.addJob('child', [parent])
+		self.addJob('grandchild', [child])
+		self.scheduler.run()
+		self.assertTrue(max(self.calls('delete', 'grandchild')) < min(self.calls('delete', 'child')))
+		self.assertTrue(max(self.calls('delete', 'child')) < min(self.calls('delete', 'parent')))
+		self.assertTrue(max(self.calls('insert', 'child')) < min(self.calls('delete', 'child')))
+		return
+
+	def test_childrenOfFailedParentSkipped(self):
+		parent = self.addJob('parent', fail = True)
+		child = self.addJob('child', [parent])
+		grandchild = self.addJob('grandchild', [child])
+		other = self.addJob('other')
+		self.scheduler.run()
+		self.assertEqual(self.scheduler.skipped, [child, grandchild])
+		self.assertEqual(self.calls('insert', 'child') + self.calls('delete', 'child'), [])
+		self.assertEqual(self.calls('insert', 'grandchild') + self.calls('delete', 'grandchild'), [])
+		self.assertTrue(parent.failed)
+		self.assertFalse(other.failed)
+		self.assertEqual(len(self.calls('delete', 'other')), 2)
+		return
+
+	def test_cycleSkipped(self):
+		first = self.addJob('first')
+		second = self.addJob('second', [first])
+		self.scheduler.parents[first] = [second]
+		self.addJob('other')
+		self.scheduler.run()
+		self.assertEqual(sorted([str(job) for job in self.scheduler.skipped]), ['first', 'second'])
+		self.assertEqual(self.calls('insert', 'first'), [])
+		self.assertEqual(len(self.calls('insert', 'other')), 8)
+		return
+
+#The same tests with the branches running at the same time, every job editing in a worker.
+class ParallelDependencySchedulerTest(DependencySchedulerTest):
+	maxParallel = 3
+	inWorker = True
+
+	def test_editsInParallel(self):
+		jobs = [self.addJob('job' + str(i)) for i in range(0, 3)]
+		started = time.time()
+		self.scheduler.run()
+		parallelSeconds = time.time() - started
+		for job in jobs:
+			self.assertFalse(job.failed)
+			self.assertEqual(job._worker.get('numSteps'), 3)
+		#The same branches one after the other, every job edits 4 times for 0.02s.
+		self.scheduler = schedule.DependencyScheduler('test', 1)
+		for i in range(0, 3):
+			self.addJob('serial' + str(i))
+		started = time.time()
+		self.scheduler.run()
+		serialSeconds = time.time() - started
+		self.assertTrue(serialSeconds >= 0.24)
+		self.assertTrue(parallelSeconds < 0.6 * serialSeconds, 'parallel %.3fs, serial %.3fs' % (parallelSeconds, serialSeconds))
+		return
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,96 @@
+###################################################################################################
+###################################################################################################
+#
+# purpose:	Tests of sink.SqliteSink: inserts and updates are written as upserts, deletes remove
+#			the rows, the tables of a GeoPackage are registered with their points, and a change
+#			that violates a constraint fails alone while the other changes of its batch are saved.
+#
+#			Run from the folder of the repository with: python -m unittest discover -s tests
+#
+###################################################################################################
+
+import os, sys, shutil, sqlite3, struct, tempfile
+import unittest
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connector import db, sink
+
+_CONFIG = {'name':'test', 'sqlServer':{'server':'test', 'database':'test'}, 'tempPath':'.', 'exportPath':'.', 'lockFilePath':'test.loc',
+	'deleteTempFiles':True, 'autoReconcile':True, 'stagingWorkspace':'staging', 'productionWorkspace':'production', 'sqlserverEditVersion':'test',
+	'stagingEditVersions':[], 'stagingDefaultVersion':'test',
+	'datasets':[{'cdcFunction':'test', 'sqlserverDataset':{'table':'W.cdc.T_CT', 'primaryKey':'ID', 'xField':'X', 'yField':'Y'}, 'sdeDataset':{'table':'Staging.dbo.T', 'primaryKey':'ID'}}]}
+
+_FIELDS = {'__$operation':0, 'ID':1, 'NAME':2, 'X':3, 'Y':4}
+
+def _change(op, key, name, x = Decimal('1.5'), y = Decimal('2.5')):
+	return (db.Change(op, key, [{'insert':2, 'update':4, 'delete':1}[op], key, name, x, y], None), _FIELDS)
+
+class SqliteSinkTest(unittest.TestCase):
+	geopackage = False
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, 'test.gpkg')
+		self.dataset = db.Replica(_CONFIG).datasets[0]
+		self.sink = sink.SqliteSink(self.path, self.geopackage, 2249)
+		return
+
+	def tearDown(self):
+		self.sink.close()
+		shutil.rmtree(self.folder, True)
+		return
+
+	def rows(self):
+		connection = sqlite3.connect(self.path)
+		try:
+			return connection.execute('SELECT ID, NAME, X, Y FROM T ORDER BY ID').fetchall()
+		finally:
+			connection.close()
+
+	def test_upsert(self):
+		self.assertEqual(self.sink.apply(self.dataset, [_change('insert', 1, 'a'), _change('insert', 2, 'b')], [], []), [])
+		#An update of a missing row inserts it.
+		self.assertEqual(self.sink.apply(self.dataset, [], [_change('update', 2, 'c', 3, 4), _change('update', 3, 'd')], []), [])
+		self.assertEqual(self.rows(), [(1, u'a', 1.5, 2.5), (2, u'c', 3.0, 4.0), (3, u'd', 1.5, 2.5)])
+		return
+
+	def test_delete(self):
+		self.sink.apply(self.dataset, [_change('insert', 1, 'a'), _change('insert', 2, 'b')], [], [])
+		self.assertEqual(self.sink.apply(self.dataset, [], [], [_change('delete', 1, None)]), [])
+		self.assertEqual(self.rows(), [(2, u'b', 1.5, 2.5)])
+		return
+
+	def test_failedChangesIsolated(self):
+		changes = [_change('insert', key, 'n' + str(key)) for key in range(1, 8)]
+		#A row without a key violates NOT NULL, the other changes of the batch are saved.
+		bad = _change('insert', None, 'bad')
+		failed = self.sink.apply(self.dataset, changes[:3] + [bad] + changes[3:], [], [])
+		self.assertEqual(failed, [bad])
+		self.assertTrue(bad[0].error is not None)
+		self.assertEqual([row[0] for row in self.rows()], range(1, 8))
+		return
+
+#The same tests with a GeoPackage.
+class GeoPackageSinkTest(SqliteSinkTest):
+	geopackage = True
+
+	def test_geoPackageTables(self):
+		self.sink.apply(self.dataset, [_change('insert', 1, 'a'), _change('insert', 2, 'b', None, None)], [], [])
+		connection = sqlite3.connect(self.path)
+		try:
+			self.assertEqual(connection.execute('PRAGMA application_id').fetchone()[0], 0x47504B47)
+			self.assertEqual(connection.execute('SELECT table_name, data_type, srs_id FROM gpkg_contents').fetchall(), [(u'T', u'features', 2249)])
+			self.assertEqual(connection.execute('SELECT * FROM gpkg_geometry_columns').fetchall(), [(u'T', u'geom', u'POINT', 2249, 0, 0)])
+			self.assertEqual(connection.execute('SELECT srs_id FROM gpkg_spatial_ref_sys WHERE srs_id = 2249').fetchall(), [(2249,)])
+			geometries = connection.execute('SELECT geom FROM T ORDER BY ID').fetchall()
+		finally:
+			connection.close()
+		self.assertEqual(struct.unpack('<2sBBiBIdd', str(geometries[0][0])), ('GP', 0, 1, 2249, 1, 1, 1.5, 2.5))
+		self.assertEqual(geometries[1][0], None)
+		return
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,81 @@
+###################################################################################################
+###################################################################################################
+#
+# purpose:	Tests of spill.SpillWriter and spill.SpillReader: the values of the CDC records are
+#			read back from a spill with the types and values they were spilled with, and a spill
+#			without blocks is complete and replaces the older spill of the dataset.
+#
+#			Run from the folder of the repository with: python -m unittest discover -s tests
+#
+###################################################################################################
+
+import os, sys, shutil, tempfile
+import unittest
+from decimal import Decimal
+from datetime import datetime, date
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from connector import spill
+
+#Columns of the spilled block, every row has one value per column.
+_FIELDS = ['__$start_lsn', '__$seqval', '__$operation', 'ID', 'NAME', 'LABEL', 'AMOUNT', 'RATIO', 'MIXED', 'TEXTS', 'FLAG', 'CHANGED', 'DAY', 'EMPTY']
+_ROWS = [
+	[bytearray('\x00\x01'), bytearray('\x00\x02'), 2, 1, 'caf\xe9', u'caf\xe9', Decimal('1.50'), 0.25, 1, 'a', True, datetime(2021, 2, 3, 4, 5, 6, 7), date(2021, 2, 3), None],
+	[bytearray('\x00\x01'), bytearray('\x00\x03'), 4, 2, None, None, None, None, 2.5, u'b', False, None, None, None],
+	[bytearray('\x00\x04'), bytearray('\x00\x05'), 1, 3000000000, '', u'', Decimal('-0.001'), -1.0, None, None, None, datetime(1969, 12, 31), date(1, 1, 1), None]]
+
+class _Dataset(object):
+	def __init__(self, spillPath):
+		self.cdcTable = 'W.cdc.T_CT'
+		self.replica = _Replica(spillPath)
+		return
+
+	def __str__(self):
+		return self.cdcTable
+
+class _Replica(object):
+	def __init__(self, spillPath):
+		self.spillPath = spillPath
+		return
+
+class SpillTest(unittest.TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.dataset = _Dataset(self.path)
+		self.fields = dict([(_FIELDS[i], i) for i in range(0, len(_FIELDS))])
+		return
+
+	def tearDown(self):
+		shutil.rmtree(self.path, True)
+		return
+
+	def spill(self, blocks):
+		writer = spill.SpillWriter(self.dataset)
+		self.assertEqual(list(writer.spill(blocks)), blocks)
+		return writer
+
+	def test_roundTrip(self):
+		self.spill([(_ROWS[:2], self.fields), (_ROWS[2:], self.fields)])
+		blocks = list(spill.SpillReader(spill.getLatestSpill(self.dataset)).getBlocks())
+		self.assertEqual([len(rows) for rows, fields in blocks], [2, 1])
+		self.assertEqual(blocks[0][1], self.fields)
+		rows = blocks[0][0] + blocks[1][0]
+		self.assertEqual(rows, _ROWS)
+		for row, expected in zip(rows, _ROWS):
+			self.assertEqual([type(value) for value in row], [type(value) for value in expected])
+		return
+
+	def test_emptySpillReplacesOlder(self):
+		first = self.spill([(_ROWS, self.fields)])
+		#The folders of the spills are named after the second in which they were written.
+		os.rename(first.path, first.path + '_0')
+		empty = self.spill([])
+		self.assertEqual(spill.getLatestSpill(self.dataset), empty.path)
+		self.assertEqual(list(spill.SpillReader(empty.path).getBlocks()), [])
+		self.assertFalse(os.path.exists(first.path + '_0'))
+		return
+
+if __name__ == '__main__':
+	unittest.main()